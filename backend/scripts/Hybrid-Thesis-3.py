@@ -40,6 +40,79 @@ LARAVEL_SETTINGS_API_URL = os.getenv('LARAVEL_SETTINGS_API_URL', 'http://localho
 # URL của API Laravel để lấy dữ liệu thuộc tính sản phẩm (bao gồm EAV)
 LARAVEL_PRODUCT_FEATURES_API_URL = os.getenv('LARAVEL_PRODUCT_FEATURES_API_URL', 'http://localhost:8000/api/product-features')
 
+# === PIPELINE TUNING ===
+# Số item mỗi khối khi tính cosine item-item cho CF (0 = tính cả ma trận một lần như trước)
+CF_SIMILARITY_BLOCK_SIZE = int(os.getenv('CF_SIMILARITY_BLOCK_SIZE', '2048'))
+# Số sản phẩm mỗi chunk khi tìm top-k láng giềng theo embedding nội dung
+CONTENT_SIMILARITY_CHUNK_SIZE = int(os.getenv('CONTENT_SIMILARITY_CHUNK_SIZE', '1024'))
+# Backend tìm láng giềng nội dung: 'exact' (chính xác, theo chunk) hoặc 'hnsw' (xấp xỉ, cần hnswlib)
+CONTENT_SIMILARITY_BACKEND = os.getenv('CONTENT_SIMILARITY_BACKEND', 'exact')
+ANN_INDEX_DIR = os.getenv('ANN_INDEX_DIR', 'ann_index')
+ANN_HNSW_M = int(os.getenv('ANN_HNSW_M', '32'))
+ANN_HNSW_EF_CONSTRUCTION = int(os.getenv('ANN_HNSW_EF_CONSTRUCTION', '200'))
+ANN_HNSW_EF_SEARCH = int(os.getenv('ANN_HNSW_EF_SEARCH', '128'))
+ANN_RECALL_SAMPLE_SIZE = int(os.getenv('ANN_RECALL_SAMPLE_SIZE', '500'))
+ANN_MIN_RECALL = float(os.getenv('ANN_MIN_RECALL', '0.95'))
+# Thư mục lưu embeddings PhoBERT đã tính (memmap .npy + chỉ mục hash của features_text)
+EMBEDDING_CACHE_DIR = os.getenv('EMBEDDING_CACHE_DIR', 'embedding_cache')
+# Batch encode PhoBERT theo độ dài: tổng số token (kể cả padding) tối đa và số câu tối đa mỗi batch
+BERT_TOKEN_BUDGET = int(os.getenv('BERT_TOKEN_BUDGET', '8192'))
+BERT_MAX_BATCH_SIZE = int(os.getenv('BERT_MAX_BATCH_SIZE', '128'))
+# Backend encode nội dung: 'tf' (TFAutoModel) hoặc 'onnx' (onnxruntime trên CPU, lượng tử hóa int8 động)
+CONTENT_ENCODER_BACKEND = os.getenv('CONTENT_ENCODER_BACKEND', 'tf')
+ONNX_MODEL_DIR = os.getenv('ONNX_MODEL_DIR', 'onnx_encoder')
+ONNX_MIN_COSINE_AGREEMENT = float(os.getenv('ONNX_MIN_COSINE_AGREEMENT', '0.99'))
+ONNX_VALIDATION_SAMPLE_SIZE = int(os.getenv('ONNX_VALIDATION_SAMPLE_SIZE', '64'))
+# Song song hóa encode: số luồng tokenize chạy song song với model (fast tokenizer nhả GIL), số văn bản mỗi
+# cửa sổ tokenize (chia batch theo độ dài trong từng cửa sổ), sức chứa hàng đợi batch đã pad chờ model,
+# và ngân sách luồng intra-op/inter-op cho TensorFlow/onnxruntime (0 = để runtime tự chọn)
+BERT_TOKENIZER_WORKERS = int(os.getenv('BERT_TOKENIZER_WORKERS', '1'))
+BERT_TOKENIZE_WINDOW = int(os.getenv('BERT_TOKENIZE_WINDOW', '4096'))
+BERT_PREFETCH_BATCHES = int(os.getenv('BERT_PREFETCH_BATCHES', '4'))
+ENCODER_INTRA_OP_THREADS = int(os.getenv('ENCODER_INTRA_OP_THREADS', '0'))
+ENCODER_INTER_OP_THREADS = int(os.getenv('ENCODER_INTER_OP_THREADS', '0'))
+# Cập nhật CF tăng dần: giữ trạng thái (bảng đếm tương tác, ma trận Gram item-item, top-k) trong CF_STATE_DIR
+# và mỗi lần chạy chỉ áp dụng các sự kiện có id lớn hơn watermark (id lớn nhất đã áp dụng) thay vì tính lại toàn bộ
+CF_INCREMENTAL_MODE = os.getenv('CF_INCREMENTAL_MODE', '0').lower() in ('1', 'true', 'yes')
+CF_STATE_DIR = os.getenv('CF_STATE_DIR', 'cf_state')
+# Số dòng user_events mỗi chunk khi đọc bằng server-side cursor
+USER_EVENTS_CHUNK_SIZE = int(os.getenv('USER_EVENTS_CHUNK_SIZE', '200000'))
+# Chạy benchmark so sánh split_data_time_based với bản cũ ở Cell 3
+RUN_SPLIT_BENCHMARK = os.getenv('RUN_SPLIT_BENCHMARK', '0').lower() in ('1', 'true', 'yes')
+# Bayesian Optimization song song: số tiến trình đánh giá (1 = gp_minimize tuần tự như trước),
+# số điểm ứng viên mỗi vòng ask/tell (0 = bằng BO_N_JOBS) và số luồng BLAS của mỗi tiến trình
+BO_N_JOBS = int(os.getenv('BO_N_JOBS', '1'))
+BO_BATCH_SIZE = int(os.getenv('BO_BATCH_SIZE', '0'))
+BO_WORKER_BLAS_THREADS = int(os.getenv('BO_WORKER_BLAS_THREADS', '1'))
+# Đánh giá đa độ trung thực (successive halving) trong Bayesian Optimization: tỉ lệ người dùng đánh giá ở
+# từng mức (tăng dần, mức cuối luôn là 1.0; "1.0" = tắt), hệ số loại eta (chỉ 1/eta ứng viên tốt nhất được
+# nâng mức), số kết quả tối thiểu của một mức trước khi bắt đầu loại, và seed chọn mẫu người dùng phân tầng
+BO_FIDELITY_FRACTIONS = [float(x) for x in os.getenv('BO_FIDELITY_FRACTIONS', '1.0').split(',') if x.strip()]
+BO_FIDELITY_ETA = float(os.getenv('BO_FIDELITY_ETA', '3'))
+BO_FIDELITY_MIN_HISTORY = int(os.getenv('BO_FIDELITY_MIN_HISTORY', '5'))
+BO_FIDELITY_SEED = int(os.getenv('BO_FIDELITY_SEED', '42'))
+# Các mốc N được báo cáo thêm khi đánh giá (precision/recall/ndcg/map @N), tính cùng một lượt
+EVAL_METRIC_CUTOFFS = [int(x) for x in os.getenv('EVAL_METRIC_CUTOFFS', '5,10,20').split(',') if x.strip()]
+# Thư mục lưu bảng độ tương đồng lai dạng mảng (SimilarityTable, nạp bằng mmap khi tạo đề xuất)
+SIMILARITY_TABLE_DIR = os.getenv('SIMILARITY_TABLE_DIR', 'similarity_table')
+# Ghi user_recommendations theo lô: số người dùng gom lại mỗi lần ghi và số dòng mỗi câu INSERT nhiều dòng
+RECOMMENDATION_SAVE_USERS = int(os.getenv('RECOMMENDATION_SAVE_USERS', '5000'))
+RECOMMENDATION_INSERT_ROWS = int(os.getenv('RECOMMENDATION_INSERT_ROWS', '1000'))
+# Cách ghi item_similarity: 'swap' (nạp vào bảng tạm không có index phụ, tạo index rồi RENAME TABLE nguyên tử)
+# hoặc 'truncate' (TRUNCATE rồi chèn trực tiếp như trước); và số dòng mỗi câu INSERT nhiều dòng
+ITEM_SIMILARITY_PERSIST_MODE = os.getenv('ITEM_SIMILARITY_PERSIST_MODE', 'swap')
+ITEM_SIMILARITY_INSERT_ROWS = int(os.getenv('ITEM_SIMILARITY_INSERT_ROWS', '2000'))
+# Làm mới user_recommendations: 'generation' (ghi cả lượt chạy vào bảng mới gắn run id, chỉ RENAME TABLE vào chỗ
+# bảng đang dùng khi chạy xong; giữ USER_RECS_KEEP_GENERATIONS thế hệ cũ để rollback) hoặc 'in_place' (ghi đè trực tiếp)
+USER_RECS_REFRESH_MODE = os.getenv('USER_RECS_REFRESH_MODE', 'generation')
+USER_RECS_KEEP_GENERATIONS = int(os.getenv('USER_RECS_KEEP_GENERATIONS', '2'))
+# Số dòng item_similarity mỗi lần fetch khi đọc bằng server-side cursor ở bước tạo đề xuất
+SIMILARITY_READ_CHUNK_SIZE = int(os.getenv('SIMILARITY_READ_CHUNK_SIZE', '100000'))
+# Tạo đề xuất theo lô: số người dùng mỗi lô và số ứng viên điểm cao nhất mỗi người dùng đưa vào MMR
+# (0 = mặc định max(top_n * 5, 50); luôn ít nhất top_n để giới hạn bộ nhớ của ma trận ứng viên)
+RECOMMENDATION_USER_BATCH_SIZE = int(os.getenv('RECOMMENDATION_USER_BATCH_SIZE', '2000'))
+RECOMMENDATION_CANDIDATE_POOL = int(os.getenv('RECOMMENDATION_CANDIDATE_POOL', '100'))
+
 # === LOGGING SETUP ===
 # Thiết lập logger để hiển thị thông báo
 logging.basicConfig(
@@ -235,7 +308,7 @@ print(f"Cài đặt hệ thống gợi ý đã tải: {APP_SETTINGS}") # In ra c
 
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Tuple, Set
+from typing import List, Dict, Tuple, Set, Optional, Union
 from collections import defaultdict
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, declarative_base
@@ -248,6 +321,37 @@ import re
 import logging
 import tensorflow as tf
 from transformers import AutoTokenizer, AutoModel, TFAutoModel
+import hashlib
+import time
+import uuid
+import multiprocessing
+import queue
+import threading
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# Ngân sách luồng của TensorFlow phải được đặt trước khi runtime khởi tạo
+try:
+    if ENCODER_INTRA_OP_THREADS > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(ENCODER_INTRA_OP_THREADS)
+    if ENCODER_INTER_OP_THREADS > 0:
+        tf.config.threading.set_inter_op_parallelism_threads(ENCODER_INTER_OP_THREADS)
+except RuntimeError as e:
+    logger.warning(f"Không thể đặt số luồng cho TensorFlow (runtime đã khởi tạo): {e}")
+try:
+    import hnswlib # Tùy chọn: chỉ cần khi CONTENT_SIMILARITY_BACKEND = 'hnsw'
+except ImportError:
+    hnswlib = None
+try:
+    import onnxruntime as ort # Tùy chọn: chỉ cần khi CONTENT_ENCODER_BACKEND = 'onnx'
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    ort = None
+try:
+    import tf2onnx # Tùy chọn: chỉ cần để export model sang ONNX lần đầu
+except ImportError:
+    tf2onnx = None
 
 # === Helper functions for Recommendation Metrics ===
 # (Keep all helper functions as they are, they are not the source of the current issue)
@@ -288,52 +392,1006 @@ def average_precision(recommended_list: List[int], actual_interactions: set) ->
             score += num_hits / (i + 1.0)
     return score / len(actual_interactions)
 
+def compute_ranking_metrics(
+    recommended: np.ndarray,
+    ground_truth: csr_matrix,
+    cutoffs: List[int]
+) -> Dict[int, Dict[str, np.ndarray]]:
+    """
+    Tính precision/recall/ndcg/average precision cho mọi người dùng và mọi mốc N trong một lượt.
+
+    recommended: ma trận [n_users, width] chỉ số cột item theo thứ hạng, đệm -1 ở cuối hàng.
+    ground_truth: ma trận thưa [n_users, n_items], phần tử khác 0 là item thực tế của người dùng.
+    Định nghĩa giống precision_at_n / recall_at_n / ndcg_at_n / average_precision áp dụng cho
+    danh sách gợi ý cắt ở N (precision chia cho số gợi ý thực có trong top-N).
+
+    Returns:
+        {N: {'precision_at_n', 'recall_at_n', 'ndcg_at_n', 'map'}: mảng [n_users] float64}.
+    """
+    recommended = np.asarray(recommended)
+    n_users, width = recommended.shape
+    ground_truth = csr_matrix(ground_truth, copy=True)
+    ground_truth.sum_duplicates()
+    ground_truth.sort_indices()
+    n_items = ground_truth.shape[1]
+    n_actual = np.diff(ground_truth.indptr)
+
+    # Tra hit bằng khóa (hàng, cột) đã sắp xếp của ground truth thay vì giao tập hợp từng người dùng
+    valid = recommended >= 0
+    gt_keys = np.repeat(np.arange(n_users, dtype=np.int64), n_actual) * n_items + ground_truth.indices
+    rec_keys = np.arange(n_users, dtype=np.int64)[:, None] * n_items + np.maximum(recommended, 0)
+    if gt_keys.size:
+        pos = np.minimum(np.searchsorted(gt_keys, rec_keys), gt_keys.size - 1)
+        hits = valid & (gt_keys[pos] == rec_keys)
+    else:
+        hits = np.zeros_like(valid)
+
+    rec_lengths = valid.sum(axis=1)
+    cum_hits = np.cumsum(hits, axis=1)
+    ranks = np.arange(1, width + 1)
+    max_cutoff = max([width] + list(cutoffs))
+    discounts = 1.0 / np.log2(np.arange(2, max_cutoff + 2))
+    ideal_dcg = np.concatenate([[0.0], np.cumsum(discounts)])
+    precision_terms = np.where(hits, cum_hits / ranks, 0.0)
+    dcg_terms = hits * discounts[:width]
+
+    results = {}
+    for n in cutoffs:
+        m = min(n, width)
+        hits_n = cum_hits[:, m - 1] if m > 0 else np.zeros(n_users)
+        shown_n = np.minimum(rec_lengths, n)
+        idcg = ideal_dcg[np.minimum(n, n_actual)]
+        results[n] = {
+            'precision_at_n': np.divide(hits_n, shown_n, out=np.zeros(n_users), where=shown_n > 0),
+            'recall_at_n': np.divide(hits_n, n_actual, out=np.zeros(n_users), where=n_actual > 0),
+            'ndcg_at_n': np.divide(dcg_terms[:, :m].sum(axis=1), idcg, out=np.zeros(n_users), where=(idcg > 0) & (rec_lengths > 0)),
+            'map': np.divide(precision_terms[:, :m].sum(axis=1), n_actual, out=np.zeros(n_users), where=n_actual > 0),
+        }
+    return results
+
+# === Helper functions for Top-K Similarity (vectorized) ===
+def topk_from_csr(
+    sim_matrix: csr_matrix,
+    top_k: int,
+    threshold: float = -np.inf,
+    drop_diagonal: bool = True,
+    row_offset: int = 0,
+    rows_per_block: int = 4096,
+    max_block_cells: int = 1 << 24
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Trích top-k phần tử lớn nhất của mỗi hàng trực tiếp trên các mảng indptr/indices/data
+    của ma trận CSR, không tạo list tuple Python cho từng hàng.
+
+    Ngưỡng (>= threshold) và việc bỏ đường chéo (cột == hàng + row_offset) được áp dụng bằng
+    mask vector hóa. Mỗi khối hàng được trải ra thành ma trận đệm (số hàng x độ dài hàng lớn nhất),
+    chọn top-k bằng argpartition rồi chỉ sắp xếp k phần tử đã chọn. Kích thước khối được thu nhỏ
+    để số ô của ma trận đệm không vượt quá max_block_cells.
+
+    Returns:
+        Tuple gồm (neighbor_idx [n_rows, top_k] int32, đệm -1;
+                   scores [n_rows, top_k] float32, đệm 0.0;
+                   counts [n_rows] int32 - số láng giềng hợp lệ của mỗi hàng).
+    """
+    sim_matrix = sim_matrix.tocsr()
+    n_rows = sim_matrix.shape[0]
+    top_k = max(0, int(top_k))
+    neighbor_idx = np.full((n_rows, top_k), -1, dtype=np.int32)
+    scores = np.zeros((n_rows, top_k), dtype=np.float32)
+    counts = np.zeros(n_rows, dtype=np.int32)
+    if n_rows == 0 or top_k == 0 or sim_matrix.nnz == 0:
+        return neighbor_idx, scores, counts
+
+    indptr, indices, data = sim_matrix.indptr, sim_matrix.indices, sim_matrix.data
+    row_lengths_all = np.diff(indptr)
+
+    start = 0
+    while start < n_rows:
+        stop = min(start + rows_per_block, n_rows)
+        widest_row = int(row_lengths_all[start:stop].max())
+        if widest_row > 0 and (stop - start) * widest_row > max_block_cells:
+            stop = start + max(1, max_block_cells // widest_row)
+
+        lo, hi = indptr[start], indptr[stop]
+        blk_cols = indices[lo:hi]
+        blk_vals = data[lo:hi]
+        blk_rows = np.repeat(np.arange(start, stop), row_lengths_all[start:stop])
+
+        keep = blk_vals >= threshold
+        if drop_diagonal:
+            keep &= blk_cols != (blk_rows + row_offset)
+        blk_rows, blk_cols, blk_vals = blk_rows[keep], blk_cols[keep], blk_vals[keep]
+        if blk_rows.size == 0:
+            start = stop
+            continue
+
+        n_blk = stop - start
+        local_rows = blk_rows - start
+        kept_lengths = np.bincount(local_rows, minlength=n_blk)
+        width = int(kept_lengths.max())
+        # Vị trí của mỗi phần tử trong hàng của nó (CSR giữ các phần tử liền nhau theo hàng)
+        row_starts = np.cumsum(kept_lengths) - kept_lengths
+        pos_in_row = np.arange(blk_rows.size) - np.repeat(row_starts, kept_lengths)
+
+        padded_vals = np.full((n_blk, width), -np.inf, dtype=np.float32)
+        padded_cols = np.full((n_blk, width), -1, dtype=np.int32)
+        padded_vals[local_rows, pos_in_row] = blk_vals
+        padded_cols[local_rows, pos_in_row] = blk_cols
+
+        k = min(top_k, width)
+        if k < width:
+            candidate_pos = np.argpartition(-padded_vals, k - 1, axis=1)[:, :k]
+        else:
+            candidate_pos = np.broadcast_to(np.arange(width), (n_blk, width))
+        candidate_vals = np.take_along_axis(padded_vals, candidate_pos, axis=1)
+        order = np.argsort(-candidate_vals, axis=1, kind='stable')
+        best_pos = np.take_along_axis(candidate_pos, order, axis=1)
+
+        best_vals = np.take_along_axis(padded_vals, best_pos, axis=1)
+        best_cols = np.take_along_axis(padded_cols, best_pos, axis=1)
+        valid = np.isfinite(best_vals)
+        neighbor_idx[start:stop, :k] = np.where(valid, best_cols, -1)
+        scores[start:stop, :k] = np.where(valid, best_vals, 0.0)
+        counts[start:stop] = np.minimum(kept_lengths, top_k)
+        start = stop
+
+    return neighbor_idx, scores, counts
+
+
+def drop_self_similarity(block_sim: csr_matrix, block_rows: np.ndarray) -> csr_matrix:
+    """
+    Bỏ phần tử (i, block_rows[i]) (độ tương đồng của item với chính nó) khỏi các hàng của block_sim, giữ nguyên
+    thứ tự các phần tử còn lại. Dùng khi các hàng là một tập con item bất kỳ (không có row_offset liên tục).
+    Các phần tử còn lại đều dương (cosine trên điểm ngầm dương) nên loại bằng eliminate_zeros là an toàn.
+    """
+    block_sim = block_sim.tocsr()
+    entry_rows = np.repeat(np.arange(block_sim.shape[0]), np.diff(block_sim.indptr))
+    block_sim.data[block_sim.indices == np.asarray(block_rows)[entry_rows]] = 0
+    block_sim.eliminate_zeros()
+    return block_sim
+
+
+def blocked_cosine_topk(
+    item_user: csr_matrix,
+    top_k: int,
+    threshold: float,
+    block_size: int,
+    query_rows: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Tính cosine item-item theo từng khối block_size hàng item và chỉ giữ top-k của mỗi item.
+
+    Mỗi khối chỉ tạo ma trận tương đồng (block_size x n_items) tạm thời rồi được rút gọn ngay
+    bằng topk_from_csr, nên bộ nhớ đỉnh phụ thuộc vào kích thước khối thay vì tổng số cặp
+    item cùng xuất hiện. Kết quả có cùng định dạng với topk_from_csr.
+    Nếu có query_rows thì chỉ tính các hàng đó (kết quả theo thứ tự query_rows), chuẩn hóa vẫn trên mọi item.
+    """
+    item_user = item_user.tocsr().astype(np.float32)
+    n_items = item_user.shape[0]
+    block_size = max(1, int(block_size))
+
+    # Chuẩn hóa L2 từng hàng item để tích vô hướng chính là cosine
+    norms = np.sqrt(np.asarray(item_user.multiply(item_user).sum(axis=1)).ravel())
+    inv_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0).astype(np.float32)
+    normalized = csr_matrix(item_user.multiply(inv_norms[:, None]))
+    normalized_T = normalized.T.tocsr()
+
+    n_rows = n_items if query_rows is None else len(query_rows)
+    neighbor_idx = np.full((n_rows, top_k), -1, dtype=np.int32)
+    scores = np.zeros((n_rows, top_k), dtype=np.float32)
+    counts = np.zeros(n_rows, dtype=np.int32)
+
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        if query_rows is None:
+            block_sim = normalized[start:stop] @ normalized_T
+            neighbor_idx[start:stop], scores[start:stop], counts[start:stop] = topk_from_csr(
+                block_sim, top_k, threshold=threshold, drop_diagonal=True, row_offset=start
+            )
+        else:
+            block_rows = np.asarray(query_rows[start:stop])
+            block_sim = drop_self_similarity(normalized[block_rows] @ normalized_T, block_rows)
+            neighbor_idx[start:stop], scores[start:stop], counts[start:stop] = topk_from_csr(
+                block_sim, top_k, threshold=threshold, drop_diagonal=False
+            )
+        del block_sim
+        logger.debug(f"DEBUG_SIM: Đã xử lý khối item {start}-{stop} / {n_rows}.")
+
+    return neighbor_idx, scores, counts
+
+
+def l2_normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Chuẩn hóa L2 từng hàng (float32). Hàng toàn 0 được giữ nguyên là 0.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def dense_topk_chunked(
+    normalized_embeddings: np.ndarray,
+    top_k: int,
+    min_score: float = 1e-6,
+    chunk_size: int = 1024
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Tìm top-k láng giềng cosine cho mọi hàng của ma trận embedding đã chuẩn hóa L2.
+
+    Mỗi lần chỉ tính một chunk (chunk_size x N) bằng phép nhân ma trận float32, bỏ đường chéo
+    và các điểm <= min_score bằng mask, rồi chọn top-k bằng argpartition. Không bao giờ tạo
+    ma trận N x N. Kết quả có cùng định dạng với topk_from_csr.
+    """
+    n_items = normalized_embeddings.shape[0]
+    top_k = max(0, int(top_k))
+    neighbor_idx = np.full((n_items, top_k), -1, dtype=np.int32)
+    scores = np.zeros((n_items, top_k), dtype=np.float32)
+    counts = np.zeros(n_items, dtype=np.int32)
+    k = min(top_k, n_items)
+    if n_items == 0 or k == 0:
+        return neighbor_idx, scores, counts
+
+    chunk_size = max(1, int(chunk_size))
+    for start in range(0, n_items, chunk_size):
+        stop = min(start + chunk_size, n_items)
+        rows = np.arange(stop - start)
+        chunk_sim = normalized_embeddings[start:stop] @ normalized_embeddings.T
+        chunk_sim[rows, rows + start] = -np.inf # Bỏ độ tương đồng với chính nó
+        chunk_sim[chunk_sim <= min_score] = -np.inf # Ngưỡng nhỏ để loại bỏ noise
+
+        if k < n_items:
+            candidate_pos = np.argpartition(-chunk_sim, k - 1, axis=1)[:, :k]
+        else:
+            candidate_pos = np.broadcast_to(np.arange(n_items), (stop - start, n_items))
+        candidate_vals = np.take_along_axis(chunk_sim, candidate_pos, axis=1)
+        order = np.argsort(-candidate_vals, axis=1, kind='stable')
+        best_pos = np.take_along_axis(candidate_pos, order, axis=1)
+        best_vals = np.take_along_axis(candidate_vals, order, axis=1)
+
+        valid = np.isfinite(best_vals)
+        neighbor_idx[start:stop, :k] = np.where(valid, best_pos, -1)
+        scores[start:stop, :k] = np.where(valid, best_vals, 0.0)
+        counts[start:stop] = valid.sum(axis=1)
+        del chunk_sim
+
+    return neighbor_idx, scores, counts
+
+
+def topk_arrays_to_dict(
+    item_ids: np.ndarray,
+    neighbor_ids: np.ndarray,
+    scores: np.ndarray,
+    counts: np.ndarray
+) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Chuyển kết quả dạng mảng (item_ids, neighbor_ids, scores, counts) về định dạng
+    Dict[int, List[Tuple[int, float]]] mà các bước phía sau đang sử dụng.
+    """
+    item_ids_list = item_ids.tolist()
+    neighbor_ids_list = neighbor_ids.tolist()
+    scores_list = scores.tolist()
+    counts_list = counts.tolist()
+    return {
+        pid: list(zip(neighbor_ids_list[row][:n], scores_list[row][:n]))
+        for row, (pid, n) in enumerate(zip(item_ids_list, counts_list))
+    }
+
+def _csr_entry_keys(matrix: csr_matrix) -> np.ndarray:
+    """Khóa hàng * số_cột + cột của từng phần tử CSR (tăng dần nếu indices đã được sắp xếp)."""
+    rows = np.repeat(np.arange(matrix.shape[0], dtype=np.int64), np.diff(matrix.indptr))
+    return rows * matrix.shape[1] + matrix.indices
+
+
+def sparse_candidate_scores(user_items: csr_matrix, item_similarity: csr_matrix) -> csr_matrix:
+    """
+    Điểm ứng viên của nhiều người dùng bằng phép nhân thưa: scores = user_items @ item_similarity.
+
+    Cấu trúc kết quả là mọi cặp (người dùng, item) có ít nhất một đường nối qua item đã tương tác, kể cả
+    khi tổng điểm bằng 0 (phép nhân thưa bỏ giá trị 0, nên cấu trúc được lấy từ phép nhân của hai ma trận
+    mẫu nhị phân và giá trị được gióng vào theo khóa) - giống cách cộng dồn điểm bằng dict trước đây.
+    """
+    user_items = csr_matrix(user_items, dtype=np.float64)
+    item_similarity = csr_matrix(item_similarity, dtype=np.float64)
+    user_pattern = csr_matrix((np.ones(user_items.nnz), user_items.indices, user_items.indptr), shape=user_items.shape)
+    item_pattern = csr_matrix((np.ones(item_similarity.nnz), item_similarity.indices, item_similarity.indptr), shape=item_similarity.shape)
+    support = (user_pattern @ item_pattern).tocsr()
+    values = (user_items @ item_similarity).tocsr()
+    support.sort_indices()
+    values.sort_indices()
+
+    support_keys, value_keys = _csr_entry_keys(support), _csr_entry_keys(values)
+    data = np.zeros(support.nnz)
+    if value_keys.size:
+        pos = np.minimum(np.searchsorted(value_keys, support_keys), value_keys.size - 1)
+        found = value_keys[pos] == support_keys
+        data[found] = values.data[pos[found]]
+    return csr_matrix((data, support.indices, support.indptr), shape=support.shape)
+
+
+def drop_sparse_entries(matrix: csr_matrix, mask: csr_matrix, keep: Optional[np.ndarray] = None) -> csr_matrix:
+    """
+    Bỏ các phần tử của matrix nằm ở vị trí có phần tử (cấu trúc) trong mask, ví dụ item người dùng đã
+    tương tác. keep (tùy chọn) là mask boolean bổ sung trên matrix.data. Giữ nguyên các giá trị 0 tường minh.
+    """
+    matrix = matrix.tocsr()
+    mask = mask.tocsr()
+    matrix.sort_indices()
+    mask.sort_indices()
+    keep = np.ones(matrix.nnz, dtype=bool) if keep is None else keep.copy()
+    keep &= ~np.isin(_csr_entry_keys(matrix), _csr_entry_keys(mask))
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[keep], minlength=matrix.shape[0]), out=indptr[1:])
+    return csr_matrix((matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+
+# === BẢNG ĐỘ TƯƠNG ĐỒNG DẠNG CỘT (CSR) ===
+class SimilarityTable:
+    """
+    Bảng độ tương đồng item-item dạng CSR thay cho Dict[int, List[Tuple[int, float, float, float]]]:
+    item_ids (int64, tăng dần, id -> hàng bằng searchsorted), indptr (int64), neighbors (int32, chỉ số hàng
+    của láng giềng) và ba cột điểm float32 hybrid/cf/content. Láng giềng của mỗi hàng được sắp xếp giảm dần
+    theo hybrid. Khoảng 16 byte mỗi láng giềng thay vì hơn 100 byte đối tượng Python.
+
+    Bảng có thể lưu ra thư mục các file .npy và nạp lại bằng mmap (không sao chép); các phép biến đổi
+    (threshold, head, take, symmetrized) trả về bảng mới trong bộ nhớ.
+    """
+    COLUMNS = ('hybrid', 'cf', 'content')
+    META_FILE = 'similarity_table_meta.json'
+
+    def __init__(self, item_ids: np.ndarray, indptr: np.ndarray, neighbors: np.ndarray,
+                 hybrid: np.ndarray, cf: np.ndarray, content: np.ndarray):
+        self.item_ids = item_ids
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.hybrid = hybrid
+        self.cf = cf
+        self.content = content
+        self._pair_order = None
+
+    @classmethod
+    def from_pairs(
+        cls,
+        p1: np.ndarray,
+        p2: np.ndarray,
+        hybrid: np.ndarray,
+        cf: Optional[np.ndarray] = None,
+        content: Optional[np.ndarray] = None,
+        item_ids: Optional[np.ndarray] = None
+    ) -> 'SimilarityTable':
+        """
+        Dựng bảng từ các mảng cặp (p1, p2, điểm) theo id sản phẩm. Các cột thiếu nhận 0.
+        item_ids mặc định là hợp của p1 và p2; cặp có id nằm ngoài item_ids bị bỏ qua.
+        """
+        p1 = np.asarray(p1, dtype=np.int64)
+        p2 = np.asarray(p2, dtype=np.int64)
+        columns = [np.asarray(c if c is not None else np.zeros(p1.size), dtype=np.float32) for c in (hybrid, cf, content)]
+        item_ids = np.unique(np.concatenate([p1, p2])) if item_ids is None else np.unique(np.asarray(item_ids, dtype=np.int64))
+        rows, cols = _ids_to_rows(item_ids, p1), _ids_to_rows(item_ids, p2)
+        keep = (rows >= 0) & (cols >= 0)
+        return cls._from_rows(item_ids, rows[keep], cols[keep], *(c[keep] for c in columns))
+
+    @classmethod
+    def empty(cls) -> 'SimilarityTable':
+        """Bảng không có item nào (len = 0, bool = False)."""
+        no_ids = np.empty(0, dtype=np.int64)
+        return cls.from_pairs(no_ids, no_ids, np.empty(0, dtype=np.float32))
+
+    @classmethod
+    def _from_rows(cls, item_ids, rows, cols, hybrid, cf, content) -> 'SimilarityTable':
+        order = np.lexsort((-hybrid, rows))
+        indptr = np.zeros(item_ids.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=item_ids.size), out=indptr[1:])
+        return cls(item_ids, indptr, cols[order].astype(np.int32), hybrid[order], cf[order], content[order])
+
+    @classmethod
+    def concat(cls, tables: List['SimilarityTable']) -> 'SimilarityTable':
+        """
+        Ghép các bảng có tập hàng (sản phẩm có láng giềng) không giao nhau, ví dụ các phần được tính cho những
+        nhóm sản phẩm khác nhau, thành một bảng trên hợp các item_ids. Thứ tự láng giềng trong mỗi hàng giữ nguyên.
+        """
+        if len(tables) == 1:
+            return tables[0]
+        item_ids = np.unique(np.concatenate([np.asarray(t.item_ids) for t in tables] + [np.empty(0, dtype=np.int64)]))
+        p1 = np.concatenate([np.repeat(np.asarray(t.item_ids), t.row_lengths()) for t in tables] + [np.empty(0, dtype=np.int64)])
+        p2 = np.concatenate([np.asarray(t.item_ids)[t.neighbors] for t in tables] + [np.empty(0, dtype=np.int64)])
+        columns = [np.concatenate([np.asarray(getattr(t, c)) for t in tables] + [np.empty(0, dtype=np.float32)]) for c in cls.COLUMNS]
+        return cls.from_pairs(p1, p2, *columns, item_ids=item_ids)
+
+    @classmethod
+    def from_symmetric_pairs(
+        cls,
+        p1: np.ndarray,
+        p2: np.ndarray,
+        hybrid: np.ndarray,
+        cf: np.ndarray,
+        content: np.ndarray
+    ) -> 'SimilarityTable':
+        """
+        Dựng bảng đối xứng từ các cặp duy nhất (mỗi cặp không thứ tự xuất hiện một lần, như trong bảng
+        item_similarity): mỗi cặp được thêm cả hai chiều trong một lượt vector hóa, không cần khử trùng lặp.
+        """
+        p1 = np.asarray(p1, dtype=np.int64)
+        p2 = np.asarray(p2, dtype=np.int64)
+        not_self = p1 != p2
+        if not not_self.all():
+            p1, p2, hybrid, cf, content = (np.asarray(a)[not_self] for a in (p1, p2, hybrid, cf, content))
+        item_ids = np.unique(np.concatenate([p1, p2]))
+        rows, cols = _ids_to_rows(item_ids, p1), _ids_to_rows(item_ids, p2)
+        del p1, p2
+        columns = [np.concatenate([c, c]).astype(np.float32, copy=False) for c in (np.asarray(hybrid), np.asarray(cf), np.asarray(content))]
+        return cls._from_rows(item_ids, np.concatenate([rows, cols]), np.concatenate([cols, rows]), *columns)
+
+    @classmethod
+    def from_dict(cls, sims: Dict[int, List[Tuple[int, float, float, float]]]) -> 'SimilarityTable':
+        """
+        Chuyển định dạng dict cũ (p1 -> [(p2, hybrid, cf, content)]) sang SimilarityTable.
+        """
+        lengths = np.fromiter((len(v) for v in sims.values()), dtype=np.int64, count=len(sims))
+        total = int(lengths.sum())
+        p1 = np.repeat(np.fromiter(sims.keys(), dtype=np.int64, count=len(sims)), lengths)
+        p2 = np.fromiter((t[0] for v in sims.values() for t in v), dtype=np.int64, count=total)
+        scores = [np.fromiter((t[j] for v in sims.values() for t in v), dtype=np.float32, count=total) for j in (1, 2, 3)]
+        return cls.from_pairs(p1, p2, *scores, item_ids=np.concatenate([p1, p2, np.fromiter(sims.keys(), dtype=np.int64, count=len(sims))]))
+
+    @property
+    def n_items(self) -> int:
+        return int(self.item_ids.size)
+
+    @property
+    def nnz(self) -> int:
+        return int(self.indptr[-1])
+
+    def row_lengths(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def __len__(self) -> int:
+        """Số sản phẩm có ít nhất một láng giềng (tương ứng số khóa của dict cũ)."""
+        return int(np.count_nonzero(self.row_lengths()))
+
+    def row_of(self, product_ids) -> np.ndarray:
+        """Chỉ số hàng của các product_id, -1 nếu không có trong bảng."""
+        return _ids_to_rows(self.item_ids, np.atleast_1d(np.asarray(product_ids, dtype=np.int64)))
+
+    def neighbors_of(self, product_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (neighbor_product_ids, hybrid, cf, content) của một sản phẩm (mảng rỗng nếu không có).
+        """
+        row = int(self.row_of(product_id)[0])
+        if row < 0:
+            empty = np.empty(0, dtype=np.float32)
+            return np.empty(0, dtype=np.int64), empty, empty, empty
+        lo, hi = int(self.indptr[row]), int(self.indptr[row + 1])
+        return self.item_ids[self.neighbors[lo:hi]], self.hybrid[lo:hi], self.cf[lo:hi], self.content[lo:hi]
+
+    def get(self, product_id: int, default=None) -> List[Tuple[int, float, float, float]]:
+        """Tương thích với dict cũ: danh sách (p2, hybrid, cf, content) của product_id."""
+        neighbor_ids, hybrid, cf, content = self.neighbors_of(product_id)
+        if neighbor_ids.size == 0:
+            return [] if default is None else default
+        return list(zip(neighbor_ids.tolist(), hybrid.tolist(), cf.tolist(), content.tolist()))
+
+    def items(self):
+        """Duyệt (product_id, danh sách láng giềng) của các sản phẩm có láng giềng, như dict.items()."""
+        for row in np.flatnonzero(self.row_lengths()):
+            yield int(self.item_ids[row]), self.get(int(self.item_ids[row]))
+
+    def _select(self, entry_mask: np.ndarray) -> 'SimilarityTable':
+        indptr = np.zeros_like(self.indptr)
+        entry_rows = np.repeat(np.arange(self.n_items), self.row_lengths())
+        np.cumsum(np.bincount(entry_rows[entry_mask], minlength=self.n_items), out=indptr[1:])
+        return SimilarityTable(self.item_ids, indptr, self.neighbors[entry_mask],
+                               self.hybrid[entry_mask], self.cf[entry_mask], self.content[entry_mask])
+
+    def threshold(self, min_score: float, column: str = 'hybrid') -> 'SimilarityTable':
+        """Chỉ giữ các cặp có điểm (cột column) >= min_score."""
+        return self._select(np.asarray(getattr(self, column)) >= min_score)
+
+    def head(self, top_k: int) -> 'SimilarityTable':
+        """Giữ tối đa top_k láng giềng đầu tiên (hybrid cao nhất) của mỗi hàng."""
+        rank = np.arange(self.nnz) - np.repeat(self.indptr[:-1], self.row_lengths())
+        return self._select(rank < max(0, int(top_k)))
+
+    def take(self, product_ids) -> 'SimilarityTable':
+        """Cắt bảng chỉ còn các hàng của product_ids (giữ nguyên tập item_ids để láng giềng vẫn hợp lệ)."""
+        rows = self.row_of(product_ids)
+        row_mask = np.zeros(self.n_items, dtype=bool)
+        row_mask[rows[rows >= 0]] = True
+        return self._select(np.repeat(row_mask, self.row_lengths()))
+
+    def symmetrized(self) -> 'SimilarityTable':
+        """
+        Bảng đối xứng: mỗi cặp (p1, p2) có thêm chiều (p2, p1); nếu cả hai chiều đã tồn tại thì giữ chiều có sẵn.
+        """
+        rows = np.repeat(np.arange(self.n_items, dtype=np.int64), self.row_lengths())
+        cols = self.neighbors.astype(np.int64)
+        all_rows, all_cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        # Chiều có sẵn đứng trước chiều đảo nên np.unique (lấy lần xuất hiện đầu) ưu tiên nó
+        _, first = np.unique(all_rows * self.n_items + all_cols, return_index=True)
+        source = np.concatenate([np.arange(rows.size), np.arange(rows.size)])[first]
+        return SimilarityTable._from_rows(self.item_ids, all_rows[first], all_cols[first],
+                                          np.asarray(self.hybrid)[source], np.asarray(self.cf)[source], np.asarray(self.content)[source])
+
+    def pair_scores(self, p1, p2, column: str = 'hybrid', symmetric: bool = True) -> np.ndarray:
+        """
+        Tra cứu vector hóa điểm của các cặp (p1[i], p2[i]); 0 nếu cặp không có. Với symmetric=True,
+        cặp không có theo chiều (p1, p2) được tra theo chiều (p2, p1).
+        """
+        rows, cols = self.row_of(p1), self.row_of(p2)
+        scores = self._lookup(rows, cols, column)
+        if symmetric:
+            missing = np.isnan(scores)
+            scores[missing] = self._lookup(cols[missing], rows[missing], column)
+        return np.nan_to_num(scores, nan=0.0)
+
+    def submatrix(self, product_ids, column: str = 'content', symmetric: bool = True) -> np.ndarray:
+        """Ma trận dày điểm giữa mọi cặp trong product_ids (n x n), 0 nếu không có."""
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        n = product_ids.size
+        return self.pair_scores(np.repeat(product_ids, n), np.tile(product_ids, n), column, symmetric).reshape(n, n)
+
+    def submatrices(self, product_ids: np.ndarray, column: str = 'content', symmetric: bool = True) -> np.ndarray:
+        """
+        Ma trận điểm giữa các ứng viên của nhiều danh sách cùng lúc: product_ids [n_lists, n] (đệm -1)
+        -> [n_lists, n, n], 0 ở các vị trí đệm hoặc cặp không có.
+        """
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        n_lists, n = product_ids.shape
+        p1 = np.repeat(product_ids, n, axis=1).ravel()
+        p2 = np.tile(product_ids, (1, n)).ravel()
+        return self.pair_scores(p1, p2, column, symmetric).reshape(n_lists, n, n)
+
+    def _lookup(self, rows: np.ndarray, cols: np.ndarray, column: str) -> np.ndarray:
+        if self._pair_order is None:
+            entry_rows = np.repeat(np.arange(self.n_items, dtype=np.int64), self.row_lengths())
+            keys = entry_rows * self.n_items + self.neighbors
+            self._pair_order = np.argsort(keys, kind='stable')
+            self._pair_keys = keys[self._pair_order]
+        result = np.full(rows.size, np.nan, dtype=np.float32)
+        valid = (rows >= 0) & (cols >= 0)
+        if not valid.any() or self.nnz == 0:
+            return result
+        keys = rows[valid] * self.n_items + cols[valid]
+        pos = np.minimum(np.searchsorted(self._pair_keys, keys), self._pair_keys.size - 1)
+        found = self._pair_keys[pos] == keys
+        values = np.full(keys.size, np.nan, dtype=np.float32)
+        values[found] = np.asarray(getattr(self, column))[self._pair_order[pos[found]]]
+        result[valid] = values
+        return result
+
+    def to_csr(self, column: str = 'hybrid', item_index: Optional[pd.Index] = None) -> csr_matrix:
+        """
+        Ma trận thưa item x item của một cột điểm. Nếu có item_index thì hàng/cột theo item_index
+        (item không có trong item_index bị bỏ qua).
+        """
+        data = np.asarray(getattr(self, column), dtype=np.float64)
+        if item_index is None:
+            return csr_matrix((data, np.asarray(self.neighbors), np.asarray(self.indptr)), shape=(self.n_items, self.n_items))
+        position = item_index.get_indexer(self.item_ids)
+        rows = position[np.repeat(np.arange(self.n_items), self.row_lengths())]
+        cols = position[self.neighbors]
+        keep = (rows >= 0) & (cols >= 0)
+        return csr_matrix((data[keep], (rows[keep], cols[keep])), shape=(len(item_index), len(item_index)))
+
+    def to_dict(self) -> Dict[int, List[Tuple[int, float, float, float]]]:
+        """Chuyển về định dạng dict cũ (chỉ các sản phẩm có láng giềng)."""
+        return dict(self.items())
+
+    def unique_pairs(self) -> Dict[str, np.ndarray]:
+        """
+        Các cặp đã chuẩn hóa (product_id_1 < product_id_2), mỗi cặp một lần (giữ lần xuất hiện đầu
+        theo thứ tự hàng), bỏ cặp một sản phẩm với chính nó.
+        """
+        p1 = np.repeat(self.item_ids, self.row_lengths())
+        p2 = self.item_ids[self.neighbors]
+        lo, hi = np.minimum(p1, p2), np.maximum(p1, p2)
+        not_self = lo != hi
+        _, first = np.unique(np.stack([lo[not_self], hi[not_self]], axis=1), axis=0, return_index=True)
+        source = np.flatnonzero(not_self)[np.sort(first)]
+        return {
+            'product_id_1': lo[source], 'product_id_2': hi[source],
+            'score': np.asarray(self.hybrid)[source], 'cf_score': np.asarray(self.cf)[source],
+            'content_score': np.asarray(self.content)[source],
+        }
+
+    def save(self, directory: str, fingerprint: Optional[Dict] = None):
+        """
+        Lưu bảng ra thư mục (mỗi mảng một file .npy); file meta được ghi sau cùng. fingerprint (nếu có)
+        được ghi vào meta để đối chiếu với lần ghi item_similarity tương ứng trong DB.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in ('item_ids', 'indptr', 'neighbors') + self.COLUMNS:
+            np.save(os.path.join(directory, f"{name}.npy"), np.asarray(getattr(self, name)))
+        tmp_meta_path = os.path.join(directory, self.META_FILE + '.tmp')
+        with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'n_items': self.n_items, 'nnz': self.nnz, 'saved_at': pd.Timestamp.now().isoformat(),
+                       'fingerprint': fingerprint}, f, indent=4)
+        os.replace(tmp_meta_path, os.path.join(directory, self.META_FILE))
+        logger.info(f"Đã lưu SimilarityTable ({self.n_items} sản phẩm, {self.nnz} cặp) vào {directory}.")
+
+    @classmethod
+    def read_meta(cls, directory: str) -> Optional[Dict]:
+        """Đọc file meta của bảng đã lưu, None nếu chưa có hoặc không đọc được."""
+        try:
+            with open(os.path.join(directory, cls.META_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> Optional['SimilarityTable']:
+        """Nạp bảng đã lưu; mmap=True ánh xạ các file .npy vào bộ nhớ thay vì đọc toàn bộ. None nếu chưa có."""
+        if not os.path.exists(os.path.join(directory, cls.META_FILE)):
+            return None
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+                  for name in ('item_ids', 'indptr', 'neighbors') + cls.COLUMNS}
+        return cls(**arrays)
+
+    def memory_bytes(self) -> int:
+        return int(sum(np.asarray(getattr(self, name)).nbytes for name in ('item_ids', 'indptr', 'neighbors') + self.COLUMNS))
+
+
+def _ids_to_rows(sorted_ids: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Vị trí của ids trong mảng sorted_ids đã sắp xếp tăng dần, -1 nếu không có."""
+    if sorted_ids.size == 0:
+        return np.full(ids.shape, -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), sorted_ids.size - 1)
+    return np.where(sorted_ids[pos] == ids, pos, -1).astype(np.int64)
+
+
+# === GHI DỮ LIỆU HÀNG LOẠT VÀO MYSQL (INSERT NHIỀU DÒNG, BẢNG TẠM + RENAME TABLE) ===
+def bulk_insert_rows(
+    conn,
+    table_name: str,
+    columns: List[str],
+    rows: List[Tuple],
+    rows_per_statement: int = 1000,
+    update_columns: Optional[List[str]] = None
+) -> int:
+    """
+    Chèn rows bằng các câu INSERT nhiều dòng (rows_per_statement dòng mỗi câu, tham số ràng buộc).
+    Nếu có update_columns thì thêm ON DUPLICATE KEY UPDATE cho các cột đó. Trả về số dòng đã gửi.
+    """
+    rows_per_statement = max(1, int(rows_per_statement))
+    column_list = ', '.join(f"`{c}`" for c in columns)
+    on_duplicate = ''
+    if update_columns:
+        on_duplicate = ' ON DUPLICATE KEY UPDATE ' + ', '.join(f"`{c}` = VALUES(`{c}`)" for c in update_columns)
+    for start in range(0, len(rows), rows_per_statement):
+        chunk = rows[start:start + rows_per_statement]
+        placeholders = ', '.join('(' + ', '.join(f":c{j}_{i}" for j in range(len(columns))) + ')' for i in range(len(chunk)))
+        params = {f"c{j}_{i}": value for i, row in enumerate(chunk) for j, value in enumerate(row)}
+        conn.execute(text(f"INSERT INTO `{table_name}` ({column_list}) VALUES {placeholders}{on_duplicate}"), params)
+    return len(rows)
+
+
+def create_staging_table(conn, table_name: str, staging_name: str) -> List[str]:
+    """
+    Tạo bảng tạm rỗng cùng cấu trúc với table_name (CREATE TABLE ... LIKE) rồi bỏ các index phụ để nạp
+    nhanh (giữ khóa chính). Trả về các mệnh đề ADD INDEX để tạo lại index sau khi nạp (add_table_indexes).
+    """
+    conn.execute(text(f"DROP TABLE IF EXISTS `{staging_name}`"))
+    conn.execute(text(f"CREATE TABLE `{staging_name}` LIKE `{table_name}`"))
+    index_rows = conn.execute(text(
+        "SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND INDEX_NAME <> 'PRIMARY' "
+        "ORDER BY INDEX_NAME, SEQ_IN_INDEX"
+    ), {'table_name': staging_name}).fetchall()
+    index_columns: Dict[str, List[str]] = defaultdict(list)
+    index_unique: Dict[str, bool] = {}
+    for index_name, non_unique, column_name in index_rows:
+        index_columns[index_name].append(column_name)
+        index_unique[index_name] = not int(non_unique)
+    if index_columns:
+        conn.execute(text(f"ALTER TABLE `{staging_name}` " + ', '.join(f"DROP INDEX `{name}`" for name in index_columns)))
+    return [
+        f"ADD {'UNIQUE ' if index_unique[name] else ''}INDEX `{name}` (" + ', '.join(f"`{c}`" for c in cols) + ")"
+        for name, cols in index_columns.items()
+    ]
+
+
+def add_table_indexes(conn, table_name: str, index_clauses: List[str]):
+    """Tạo lại các index phụ (một câu ALTER TABLE cho tất cả)."""
+    if index_clauses:
+        conn.execute(text(f"ALTER TABLE `{table_name}` " + ', '.join(index_clauses)))
+
+
+def swap_staging_table(conn, table_name: str, staging_name: str, keep_previous: bool = False) -> Optional[str]:
+    """
+    Đưa bảng tạm vào thay table_name bằng một câu RENAME TABLE (nguyên tử: người đọc luôn thấy bảng cũ
+    hoặc bảng mới đầy đủ). Bảng cũ được đổi tên thành <table_name>_previous rồi xóa, trừ khi keep_previous.
+    Trả về tên bảng cũ nếu được giữ lại.
+    """
+    previous_name = f"{table_name}_previous"
+    conn.execute(text(f"DROP TABLE IF EXISTS `{previous_name}`"))
+    conn.execute(text(f"RENAME TABLE `{table_name}` TO `{previous_name}`, `{staging_name}` TO `{table_name}`"))
+    if keep_previous:
+        return previous_name
+    conn.execute(text(f"DROP TABLE IF EXISTS `{previous_name}`"))
+    return None
+
+
+ITEM_SIMILARITY_RUNS_TABLE = 'item_similarity_runs'
+
+
+def record_similarity_fingerprint(engine, row_count: int) -> Dict:
+    """
+    Ghi dấu vân tay (run_id ngẫu nhiên + số dòng) của lần ghi item_similarity vừa hoàn tất vào
+    item_similarity_runs. Bản mảng SimilarityTable lưu cùng dấu vân tay này trong meta.
+    """
+    fingerprint = {'run_id': uuid.uuid4().hex, 'row_count': int(row_count)}
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS `{ITEM_SIMILARITY_RUNS_TABLE}` ("
+            "id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, run_id VARCHAR(32) NOT NULL, "
+            "row_count BIGINT NOT NULL, persisted_at DATETIME(6) NOT NULL)"
+        ))
+        conn.execute(text(
+            f"INSERT INTO `{ITEM_SIMILARITY_RUNS_TABLE}` (run_id, row_count, persisted_at) VALUES (:run_id, :row_count, NOW(6))"
+        ), fingerprint)
+    return fingerprint
+
+
+def read_similarity_fingerprint(engine) -> Optional[Dict]:
+    """
+    Dấu vân tay của lần ghi item_similarity gần nhất, kèm số dòng hiện có trong bảng (current_rows).
+    None nếu chưa có lần ghi nào được ghi nhận.
+    """
+    with engine.connect() as conn:
+        exists = conn.execute(text(
+            "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name"
+        ), {'table_name': ITEM_SIMILARITY_RUNS_TABLE}).scalar()
+        if not exists:
+            return None
+        latest = conn.execute(text(
+            f"SELECT run_id, row_count FROM `{ITEM_SIMILARITY_RUNS_TABLE}` ORDER BY id DESC LIMIT 1"
+        )).fetchone()
+        if latest is None:
+            return None
+        current_rows = conn.execute(text("SELECT COUNT(*) FROM item_similarity")).scalar()
+    return {'run_id': latest[0], 'row_count': int(latest[1]), 'current_rows': int(current_rows or 0)}
+
+
 # === NEW CORE FUNCTIONS FOR IMPLICIT FEEDBACK & OPTIMIZATION ===
 # (Keep these as they are, they are not directly related to content issue)
-def load_all_user_events() -> pd.DataFrame:
-    sql = text("""
+def _compact_event_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ép kiểu một chunk sự kiện về dạng gọn: id int32, event_type categorical, created_at datetime64.
+    """
+    return pd.DataFrame({
+        'user_id': chunk['user_id'].to_numpy(dtype=np.int32),
+        'product_id': chunk['product_id'].to_numpy(dtype=np.int32),
+        'event_type': pd.Categorical(chunk['event_type']),
+        'created_at': pd.to_datetime(chunk['created_at']),
+    })
+
+
+def iter_user_event_chunks(chunksize: int = USER_EVENTS_CHUNK_SIZE, after_id: Optional[int] = None,
+                           until_id: Optional[int] = None):
+    """
+    Đọc user_events theo từng chunk qua server-side cursor (stream_results), không tải toàn bộ
+    kết quả vào bộ nhớ client. after_id/until_id lọc theo khóa chính (after_id < id <= until_id):
+    id tăng dần và duy nhất nên không bỏ sót sự kiện trùng created_at hay có created_at NULL.
+    Mỗi chunk đã được ép về dạng gọn bằng _compact_event_chunk.
+    """
+    conditions = []
+    params = {}
+    if after_id is not None:
+        conditions.append("id > :after_id")
+        params['after_id'] = int(after_id)
+    if until_id is not None:
+        conditions.append("id <= :until_id")
+        params['until_id'] = int(until_id)
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = text(f"""
     SELECT user_id, product_id, event_type, created_at
     FROM user_events
+    {where_clause}
     """)
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for chunk in pd.read_sql(sql, conn, params=params, chunksize=chunksize):
+            yield _compact_event_chunk(chunk)
+
+
+def _collect_event_chunks(chunks, capacity: int = USER_EVENTS_CHUNK_SIZE) -> pd.DataFrame:
+    """
+    Gom các chunk sự kiện vào các mảng NumPy cấp phát trước (mở rộng gấp đôi khi đầy) ngay khi từng chunk
+    được đọc, thay vì giữ danh sách chunk rồi ghép: bộ nhớ đỉnh chỉ là bảng gọn cuối cùng. Mã event_type
+    được đánh chung cho mọi chunk (categories của từng chunk có thể khác nhau).
+    """
+    capacity = max(int(capacity), 1)
+    user_ids = np.empty(capacity, dtype=np.int32)
+    product_ids = np.empty(capacity, dtype=np.int32)
+    event_codes = np.empty(capacity, dtype=np.int16)
+    created_at = np.empty(capacity, dtype='datetime64[ns]')
+    buffers = (user_ids, product_ids, event_codes, created_at)
+    event_type_codes: Dict[str, int] = {}
+    n_rows = 0
+    for chunk in chunks:
+        end = n_rows + len(chunk)
+        if end > user_ids.size:
+            capacity = max(end, 2 * user_ids.size)
+            for buffer in buffers:
+                buffer.resize(capacity, refcheck=False) # Mở rộng tại chỗ: mảng vẫn sở hữu dữ liệu của nó
+        for event_type in chunk['event_type'].cat.categories:
+            event_type_codes.setdefault(event_type, len(event_type_codes))
+        chunk_codes = np.array([event_type_codes[c] for c in chunk['event_type'].cat.categories] + [-1], dtype=np.int16)
+        user_ids[n_rows:end] = chunk['user_id'].to_numpy()
+        product_ids[n_rows:end] = chunk['product_id'].to_numpy()
+        event_codes[n_rows:end] = chunk_codes[chunk['event_type'].cat.codes.to_numpy()] # -1 (NaN) giữ nguyên -1
+        created_at[n_rows:end] = chunk['created_at'].to_numpy(dtype='datetime64[ns]')
+        n_rows = end
+    for buffer in buffers:
+        buffer.resize(n_rows, refcheck=False) # Cắt phần dư tại chỗ, không sao chép
+    return pd.DataFrame({
+        'user_id': user_ids,
+        'product_id': product_ids,
+        'event_type': pd.Categorical.from_codes(event_codes, categories=list(event_type_codes)),
+        'created_at': pd.to_datetime(created_at),
+    }, copy=False)
+
+
+def load_all_user_events() -> pd.DataFrame:
+    df = _collect_event_chunks(iter_user_event_chunks())
+    logger.info(f"Loaded {len(df)} user events from database ({df.memory_usage(deep=True).sum() / 1024**2:.1f} MB).")
+    return df
+
+
+def max_user_event_id() -> Optional[int]:
+    """
+    id lớn nhất hiện có trong user_events (None nếu bảng rỗng), dùng làm watermark.
+    """
     with engine.begin() as conn:
-        df = pd.read_sql(sql, conn)
-    
-    df['created_at'] = pd.to_datetime(df['created_at'])
-    logger.info(f"Loaded {len(df)} user events from database.")
+        max_id = conn.execute(text("SELECT MAX(id) FROM user_events")).scalar()
+    return int(max_id) if max_id is not None else None
+
+
+def load_user_events_since(watermark_id: int, until_id: Optional[int] = None) -> pd.DataFrame:
+    """
+    Tải các sự kiện có watermark_id < id <= until_id (dùng cho cập nhật CF tăng dần).
+    """
+    df = _collect_event_chunks(iter_user_event_chunks(after_id=watermark_id, until_id=until_id))
+    logger.info(f"Loaded {len(df)} user events with id in ({watermark_id}, {until_id}] from database.")
     return df
-    
+
+
+def load_user_event_counts(until_id: Optional[int] = None,
+                           chunksize: int = USER_EVENTS_CHUNK_SIZE) -> Tuple[pd.DataFrame, Optional[int]]:
+    """
+    Đếm số lần tương tác theo (user_id, product_id, event_type) trong lúc stream user_events theo chunk,
+    nên bảng sự kiện thô không bao giờ nằm trọn trong bộ nhớ. Chỉ tính các sự kiện có
+    id <= until_id (mặc định là MAX(id) hiện tại), kể cả sự kiện có created_at NULL.
+
+    Mỗi chunk được gom nhóm ngay; các bảng đếm một phần được gộp lại mỗi khi tổng số dòng
+    vượt quá chunksize, nên bộ nhớ chỉ tỉ lệ với số bộ (user, product, event_type) khác nhau.
+
+    Returns:
+        Tuple (DataFrame [user_id, product_id, event_type, interaction_count], watermark id đã dùng).
+    """
+    if until_id is None:
+        until_id = max_user_event_id()
+    if until_id is None:
+        logger.warning("Bảng user_events rỗng.")
+        return pd.DataFrame(columns=['user_id', 'product_id', 'event_type', 'interaction_count']), None
+
+    # Mã event_type dùng chung cho mọi chunk (categories của từng chunk có thể khác nhau)
+    event_type_codes: Dict[str, int] = {}
+    key_columns = ['user_id', 'product_id', 'event_code']
+    partial_counts: List[pd.DataFrame] = []
+    pending_rows = 0
+    for chunk in iter_user_event_chunks(chunksize=chunksize, until_id=until_id):
+        for event_type in chunk['event_type'].cat.categories:
+            event_type_codes.setdefault(event_type, len(event_type_codes))
+        chunk_codes = np.array([event_type_codes[c] for c in chunk['event_type'].cat.categories], dtype=np.int16)
+        chunk_counts = (chunk[['user_id', 'product_id']]
+                        .assign(event_code=chunk_codes[chunk['event_type'].cat.codes.to_numpy()])
+                        .groupby(key_columns).size().rename('interaction_count').reset_index())
+        partial_counts.append(chunk_counts)
+        pending_rows += len(chunk_counts)
+        if pending_rows > chunksize and len(partial_counts) > 1:
+            partial_counts = [pd.concat(partial_counts, ignore_index=True)
+                              .groupby(key_columns, as_index=False)['interaction_count'].sum()]
+            pending_rows = len(partial_counts[0])
+
+    if not partial_counts:
+        return pd.DataFrame(columns=['user_id', 'product_id', 'event_type', 'interaction_count']), int(until_id)
+    df_counts = pd.concat(partial_counts, ignore_index=True).groupby(key_columns, as_index=False)['interaction_count'].sum()
+    df_counts['event_type'] = pd.Categorical.from_codes(df_counts.pop('event_code'), categories=list(event_type_codes))
+    df_counts = df_counts[['user_id', 'product_id', 'event_type', 'interaction_count']]
+
+    logger.info(f"Aggregated {len(df_counts)} (user, product, event_type) counts up to event id {until_id} from streamed user events.")
+    return df_counts, int(until_id)
+
+
+def build_interaction_count_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bảng đếm (user_id, product_id, event_type, interaction_count) với event_type dạng categorical
+    (mã số nguyên). Chỉ phụ thuộc vào dữ liệu sự kiện, không phụ thuộc trọng số, nên được tạo một lần
+    rồi dùng lại cho mọi bộ trọng số (xem implicit_scores_from_counts).
+    """
+    df_counts = (df[['user_id', 'product_id']]
+                 .assign(event_type=df['event_type'].astype('category'))
+                 .groupby(['user_id', 'product_id', 'event_type'], observed=True).size()
+                 .reset_index(name='interaction_count'))
+    logger.info(f"Đã tạo bảng đếm tương tác: {len(df_counts)} bộ (user, product, event_type) từ {len(df)} sự kiện.")
+    return df_counts
+
+
+def _event_type_base_scores(event_type: pd.Series, weights: Dict[str, float]) -> np.ndarray:
+    """
+    base_score (trọng số / trọng số lớn nhất) cho từng dòng, tra bằng mã số nguyên của event_type
+    thay vì map chuỗi từng dòng. Loại sự kiện không có trọng số nhận 0.
+    """
+    if not isinstance(event_type.dtype, pd.CategoricalDtype):
+        event_type = event_type.astype('category')
+    max_weight = max(weights.values()) if weights else 1.0
+    weight_by_code = np.array([weights.get(action, 0.0) / max_weight for action in event_type.cat.categories] + [0.0], dtype=float)
+    codes = event_type.cat.codes.to_numpy() # -1 (NaN) trỏ tới phần tử 0.0 cuối cùng
+    return weight_by_code[codes]
+
+
+def implicit_scores_from_counts(df_counts: pd.DataFrame, weights: Dict[str, float],
+                                frequency_decay_factor: float = 0.1) -> pd.Series:
+    """
+    Điểm ngầm (đã clip về [0, 1]) của từng dòng (event_type, interaction_count):
+    base_score * (1 + log1p(interaction_count) * frequency_decay_factor), với base_score là
+    trọng số của event_type đã chia cho trọng số lớn nhất.
+    """
+    base_score = _event_type_base_scores(df_counts['event_type'], weights)
+    frequency_score_addition = base_score * np.log1p(df_counts['interaction_count'].to_numpy(dtype=float)) * frequency_decay_factor
+    return pd.Series(np.clip(base_score + frequency_score_addition, 0.0, 1.0), index=df_counts.index)
+
 
 def assign_implicit_feedback_scores(df: pd.DataFrame, weights: Dict[str, float],
                                     frequency_decay_factor: float = 0.1,
                                     max_frequency_cap: int = 5) -> pd.DataFrame:
-    df_copy = df.copy()
+    """
+    Gán implicit_score cho từng sự kiện. Số lần tương tác của nhóm (user, product, event_type) được
+    gắn thẳng vào từng dòng bằng transform('size') nên không cần merge bảng đếm trở lại.
+    """
     logger.debug(f"DEBUG_FUNC: weights in func: {weights}")
     logger.debug(f"DEBUG_FUNC: frequency_decay_factor in func: {frequency_decay_factor}")
-    df_counts = df_copy.groupby(['user_id', 'product_id', 'event_type']).size().reset_index(name='interaction_count')
-    max_weight = max(weights.values()) if weights else 1.0
-    scaled_weights = {action: weight / max_weight for action, weight in weights.items()}
-    df_counts['base_score'] = df_counts['event_type'].map(scaled_weights).fillna(0)
-    df_counts['log_interaction_count'] = np.log1p(df_counts['interaction_count'])
-    df_counts['frequency_score_addition'] = df_counts['base_score'] * df_counts['log_interaction_count'] * frequency_decay_factor
-    df_counts['final_implicit_score'] = df_counts['base_score'] + df_counts['frequency_score_addition']
-    
-    if 'view' in weights and 'view' in df_counts['event_type'].unique():
-        debug_view_rows = df_counts[df_counts['event_type'] == 'view'].head(5)
-        logger.debug(f"DEBUG_FUNC: Debugging 'view' rows (before final clip):")
-        logger.debug(debug_view_rows[['event_type', 'interaction_count', 'base_score', 'log_interaction_count', 'frequency_score_addition', 'final_implicit_score']].to_string(float_format='{:.10f}'.format))
-
-    df_counts['final_implicit_score'] = df_counts['final_implicit_score'].clip(lower=0, upper=1.0)
-    df_copy = df_copy.merge(
-        df_counts[['user_id', 'product_id', 'event_type', 'final_implicit_score']],
-        on=['user_id', 'product_id', 'event_type'],
-        how='left'
-    )
-    df_copy['implicit_score'] = df_copy['final_implicit_score']
-    df_copy.drop(columns=['final_implicit_score'], inplace=True)
-    logger.info(f"Assigned implicit scores considering frequency with log transform. Min score: {df_copy['implicit_score'].min():.4f}, Max score: {df_copy['implicit_score'].max():.4f}")
-    return df_copy
+    interaction_count = df.groupby(['user_id', 'product_id', 'event_type'], observed=True, sort=False)['user_id'].transform('size')
+    base_score = _event_type_base_scores(df['event_type'], weights)
+    implicit_score = np.clip(base_score * (1.0 + np.log1p(interaction_count.to_numpy(dtype=float)) * frequency_decay_factor), 0.0, 1.0)
+    df_scored = df.assign(implicit_score=implicit_score)
+    logger.info(f"Assigned implicit scores considering frequency with log transform. Min score: {implicit_score.min() if len(implicit_score) else 0.0:.4f}, Max score: {implicit_score.max() if len(implicit_score) else 0.0:.4f}")
+    return df_scored
 
 def split_data_time_based(df: pd.DataFrame, train_ratio: float = 0.6, val_ratio: float = 0.2, test_ratio: float = 0.2) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Chia sự kiện của mỗi người dùng theo thời gian: int(n * train_ratio) sự kiện đầu vào Train,
+    đến int(n * (train_ratio + val_ratio)) vào Validation, phần còn lại vào Test.
+
+    Vector hóa hoàn toàn: sau một lần sort (user_id, created_at), thứ hạng của sự kiện trong user
+    (cumcount) và số sự kiện của user (transform('size')) cho ra ba mask trong một lượt.
+    Thứ tự dòng giống hệt bản cũ (_split_data_time_based_legacy); các sự kiện trùng created_at
+    trong cùng user giữ thứ tự ổn định của lần sort.
+    """
+    if not np.isclose(train_ratio + val_ratio + test_ratio, 1.0):
+        raise ValueError("train_ratio + val_ratio + test_ratio must sum to 1.0")
+    df = df.sort_values(by=['user_id', 'created_at'], kind='mergesort').reset_index(drop=True)
+    user_groups = df.groupby('user_id', sort=False)
+    rank_in_user = user_groups.cumcount().to_numpy()
+    total_interactions = user_groups['user_id'].transform('size').to_numpy()
+    train_split_point = (total_interactions * train_ratio).astype(np.int64)
+    val_split_point = (total_interactions * (train_ratio + val_ratio)).astype(np.int64)
+
+    train_mask = rank_in_user < train_split_point
+    test_mask = rank_in_user >= val_split_point
+    val_mask = ~train_mask & ~test_mask
+    df_train = df[train_mask].reset_index(drop=True)
+    df_val = df[val_mask].reset_index(drop=True)
+    df_test = df[test_mask].reset_index(drop=True)
+    logger.info(f"Data split: Train {len(df_train)} events, Validation {len(df_val)} events, Test {len(df_test)} events.")
+    return df_train, df_val, df_test
+
+def _split_data_time_based_legacy(df: pd.DataFrame, train_ratio: float = 0.6, val_ratio: float = 0.2, test_ratio: float = 0.2) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Phiên bản cũ (vòng lặp Python theo từng user), chỉ giữ lại để đối chiếu trong benchmark_split_data_time_based.
+    """
     if not np.isclose(train_ratio + val_ratio + test_ratio, 1.0):
         raise ValueError("train_ratio + val_ratio + test_ratio must sum to 1.0")
     df = df.sort_values(by=['user_id', 'created_at']).reset_index(drop=True)
@@ -354,6 +1412,29 @@ def split_data_time_based(df: pd.DataFrame, train_ratio: float = 0.6, val_ratio:
     logger.info(f"Data split: Train {len(df_train)} events, Validation {len(df_val)} events, Test {len(df_test)} events.")
     return df_train, df_val, df_test
 
+def benchmark_split_data_time_based(df: pd.DataFrame, repeats: int = 3) -> Dict[str, float]:
+    """
+    So sánh thời gian (giây, lấy lần nhanh nhất) giữa split_data_time_based và bản cũ,
+    đồng thời kiểm tra hai bản cho ra cùng kết quả.
+    """
+    timings = {}
+    results = {}
+    for name, split_fn in (('vectorized', split_data_time_based), ('legacy', _split_data_time_based_legacy)):
+        best = float('inf')
+        for _ in range(max(1, repeats)):
+            started = time.perf_counter()
+            results[name] = split_fn(df.copy())
+            best = min(best, time.perf_counter() - started)
+        timings[name] = best
+
+    identical = all(new_part.equals(old_part) for new_part, old_part in zip(results['vectorized'], results['legacy']))
+    timings['speedup'] = timings['legacy'] / max(timings['vectorized'], 1e-12)
+    logger.info(f"Benchmark split_data_time_based trên {len(df)} sự kiện: vectorized {timings['vectorized']:.3f}s, legacy {timings['legacy']:.3f}s (x{timings['speedup']:.1f}). Kết quả giống nhau: {identical}")
+    if not identical:
+        logger.warning("split_data_time_based và bản cũ cho kết quả khác nhau (có thể do sự kiện trùng created_at trong cùng user).")
+    return timings
+
+
 # === FUNCTIONS FOR CONTENT-BASED FILTERING (Item-Item) ===
 # === NEW FUNCTION: Load CATEGORY_SPEC_CONFIG and UNIT_MAP from DB using existing EAV models ===
 def load_eav_configs_from_db() -> Tuple[Dict[str, List[str]], Dict[str, Union[str, List[str]]]]:
@@ -617,12 +1698,21 @@ def get_rich_product_data_from_db() -> pd.DataFrame:
 
 
 # Biến toàn cục cho BERT với TensorFlow
+BERT_MODEL_NAME = "vinai/phobert-base"
+BERT_MAX_LENGTH = 256
 GLOBAL_BERT_TOKENIZER: AutoTokenizer = None
 GLOBAL_BERT_MODEL: TFAutoModel = None # THAY ĐỔI Ở ĐÂY
-GLOBAL_PRODUCT_EMBEDDINGS: tf.Tensor = None # THAY ĐỔI Ở ĐÂY
+GLOBAL_PRODUCT_EMBEDDINGS: np.ndarray = None # float32 [n_products, dim], có thể là memmap từ EMBEDDING_CACHE_DIR
 GLOBAL_PRODUCT_ID_MAP: Dict[int, int] = {}
+GLOBAL_ONNX_SESSION = None # onnxruntime.InferenceSession khi dùng backend 'onnx'
 TOP_K = 10 # Example value, make sure it's defined globally
 
+EMBEDDING_CACHE_VECTORS_FILE = 'embeddings.npy'
+EMBEDDING_CACHE_INDEX_FILE = 'embeddings_index.npz'
+ONNX_FP32_FILE = 'phobert_fp32.onnx'
+ONNX_INT8_FILE = 'phobert_int8.onnx'
+ONNX_META_FILE = 'phobert_onnx_meta.json'
+
 
 def mean_pooling_tf(model_output, attention_mask):
     token_embeddings = model_output.last_hidden_state  # Lấy last_hidden_state từ TFBaseModelOutput
@@ -632,25 +1722,405 @@ def mean_pooling_tf(model_output, attention_mask):
     return sum_embeddings / sum_mask
 
 
-def initialize_global_bert_model(df_products_product_level: pd.DataFrame):
-    global GLOBAL_BERT_TOKENIZER, GLOBAL_BERT_MODEL, GLOBAL_PRODUCT_EMBEDDINGS, GLOBAL_PRODUCT_ID_MAP
-    
-    if GLOBAL_BERT_MODEL is not None:
-        logger.info("BERT model already initialized. Skipping re-initialization.")
-        return
+def mean_pooling_np(token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    """
+    Mean pooling giống mean_pooling_tf nhưng trên mảng NumPy (dùng cho backend ONNX).
+    """
+    input_mask_expanded = attention_mask[..., None].astype(np.float32)
+    sum_embeddings = (token_embeddings * input_mask_expanded).sum(axis=1)
+    sum_mask = np.clip(input_mask_expanded.sum(axis=1), 1e-9, None)
+    return (sum_embeddings / sum_mask).astype(np.float32)
+
+
+def features_text_hash(
+    text: str,
+    model_name: str = BERT_MODEL_NAME,
+    max_length: int = BERT_MAX_LENGTH,
+    encoder_backend: str = CONTENT_ENCODER_BACKEND
+) -> bytes:
+    """
+    Khóa của embedding cache: hash của features_text cùng tên mô hình, max_length và backend encode,
+    để đổi mô hình/cấu hình tokenizer/backend thì cache tự động không còn khớp.
+    """
+    return hashlib.sha1(f"{model_name}|{max_length}|{encoder_backend}|{text}".encode('utf-8')).hexdigest().encode('ascii')
 
-    logger.info("Initializing global Vietnamese-BERT model and generating embeddings (TensorFlow backend)...")
-    
-    # 1. Tải tokenizer và model BERT tiếng Việt
-    # Vẫn dùng cùng tên mô hình, nhưng sẽ tải phiên bản TensorFlow
-    model_name = "vinai/phobert-base" 
+
+def load_embedding_cache(cache_dir: str = EMBEDDING_CACHE_DIR) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Tải embedding cache dạng memmap (không copy vào RAM) cùng mảng hash tương ứng từng hàng.
+    Trả về (None, None) nếu chưa có cache hoặc cache hỏng.
+    """
+    vectors_path = os.path.join(cache_dir, EMBEDDING_CACHE_VECTORS_FILE)
+    index_path = os.path.join(cache_dir, EMBEDDING_CACHE_INDEX_FILE)
+    if not (os.path.exists(vectors_path) and os.path.exists(index_path)):
+        return None, None
+    try:
+        vectors = np.load(vectors_path, mmap_mode='r')
+        with np.load(index_path) as index_file:
+            text_hashes = index_file['text_hashes']
+        if vectors.ndim != 2 or vectors.shape[0] != text_hashes.shape[0]:
+            logger.warning(f"Embedding cache tại {cache_dir} không nhất quán. Bỏ qua cache.")
+            return None, None
+        return vectors, text_hashes
+    except Exception as e:
+        logger.warning(f"Không thể tải embedding cache từ {cache_dir}: {e}")
+        return None, None
+
+
+def save_embedding_cache(
+    embeddings: np.ndarray,
+    text_hashes: np.ndarray,
+    product_ids: np.ndarray,
+    cache_dir: str = EMBEDDING_CACHE_DIR
+) -> np.ndarray:
+    """
+    Ghi embedding cache (ghi ra file tạm rồi os.replace để không để lại cache dở dang)
+    và trả về bản memmap chỉ đọc của embeddings vừa ghi.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    vectors_path = os.path.join(cache_dir, EMBEDDING_CACHE_VECTORS_FILE)
+    index_path = os.path.join(cache_dir, EMBEDDING_CACHE_INDEX_FILE)
+    tmp_vectors_path = vectors_path + '.tmp.npy'
+    tmp_index_path = index_path + '.tmp.npz'
+    np.save(tmp_vectors_path, np.ascontiguousarray(embeddings, dtype=np.float32))
+    np.savez(tmp_index_path, text_hashes=text_hashes, product_ids=np.asarray(product_ids, dtype=np.int64))
+    os.replace(tmp_vectors_path, vectors_path)
+    os.replace(tmp_index_path, index_path)
+    return np.load(vectors_path, mmap_mode='r')
+
+
+def load_bert_encoder(model_name: str = BERT_MODEL_NAME) -> bool:
+    """
+    Tải tokenizer và model BERT (TensorFlow) nếu chưa tải. Chỉ được gọi khi thật sự cần encode.
+    """
+    global GLOBAL_BERT_TOKENIZER, GLOBAL_BERT_MODEL
+    if GLOBAL_BERT_MODEL is not None and GLOBAL_BERT_TOKENIZER is not None:
+        return True
     try:
         GLOBAL_BERT_TOKENIZER = AutoTokenizer.from_pretrained(model_name)
         GLOBAL_BERT_MODEL = TFAutoModel.from_pretrained(model_name) # THAY ĐỔI Ở ĐÂY (TFAutoModel)
         logger.info("BERT model loaded for TensorFlow.")
+        return True
     except Exception as e:
         logger.error(f"Lỗi khi tải tokenizer hoặc model BERT: {e}. Đảm bảo bạn đã cài đặt 'transformers' và 'tensorflow' và có kết nối internet.")
+        return False
+
+
+def export_bert_to_onnx(model_dir: str = ONNX_MODEL_DIR, model_name: str = BERT_MODEL_NAME) -> str:
+    """
+    Export GLOBAL_BERT_MODEL (TensorFlow) sang ONNX rồi lượng tử hóa động int8 cho CPU.
+    Trả về đường dẫn model int8, hoặc None nếu thiếu tf2onnx/onnxruntime hoặc export lỗi.
+    """
+    if tf2onnx is None or ort is None:
+        logger.warning("Thiếu tf2onnx hoặc onnxruntime. Không thể export content encoder sang ONNX.")
+        return None
+    if not load_bert_encoder(model_name):
+        return None
+
+    os.makedirs(model_dir, exist_ok=True)
+    fp32_path = os.path.join(model_dir, ONNX_FP32_FILE)
+    int8_path = os.path.join(model_dir, ONNX_INT8_FILE)
+    input_signature = (
+        tf.TensorSpec((None, None), tf.int32, name='input_ids'),
+        tf.TensorSpec((None, None), tf.int32, name='attention_mask'),
+    )
+
+    @tf.function(input_signature=input_signature)
+    def _last_hidden_state(input_ids, attention_mask):
+        return GLOBAL_BERT_MODEL(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    try:
+        logger.info(f"Đang export {model_name} sang ONNX ({fp32_path})...")
+        tf2onnx.convert.from_function(_last_hidden_state, input_signature=input_signature, opset=14, output_path=fp32_path)
+        logger.info(f"Đang lượng tử hóa động int8 ({int8_path})...")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        return int8_path
+    except Exception as e:
+        logger.error(f"Lỗi khi export/lượng tử hóa content encoder sang ONNX: {e}")
+        return None
+
+
+def create_onnx_session(model_path: str):
+    """
+    Tạo InferenceSession onnxruntime trên CPU với toàn bộ tối ưu hóa đồ thị.
+    """
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if ENCODER_INTRA_OP_THREADS > 0:
+        session_options.intra_op_num_threads = ENCODER_INTRA_OP_THREADS
+    if ENCODER_INTER_OP_THREADS > 0:
+        session_options.inter_op_num_threads = ENCODER_INTER_OP_THREADS
+        session_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(model_path, sess_options=session_options, providers=['CPUExecutionProvider'])
+
+
+def run_onnx_encoder(session, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    """
+    Chạy ONNX encoder cho một batch đã pad và trả về embeddings mean pooling (float32).
+    """
+    feeds = {}
+    for model_input in session.get_inputs():
+        source = attention_mask if 'attention_mask' in model_input.name else input_ids
+        feeds[model_input.name] = np.asarray(source, dtype=np.int32)
+    last_hidden_state = session.run(None, feeds)[0]
+    return mean_pooling_np(last_hidden_state, np.asarray(attention_mask))
+
+
+def validate_onnx_encoder(session, sample_texts: List[str]) -> Dict[str, float]:
+    """
+    So sánh embeddings của ONNX encoder với đường TensorFlow trên một mẫu văn bản
+    bằng cosine giữa hai embedding của cùng một văn bản.
+    """
+    encoded = GLOBAL_BERT_TOKENIZER(sample_texts, padding=True, truncation=True, max_length=BERT_MAX_LENGTH, return_tensors='np')
+    tf_embeddings = mean_pooling_tf(
+        GLOBAL_BERT_MODEL(input_ids=encoded['input_ids'], attention_mask=encoded['attention_mask']),
+        encoded['attention_mask']
+    ).numpy()
+    onnx_embeddings = run_onnx_encoder(session, encoded['input_ids'], encoded['attention_mask'])
+    agreement = (l2_normalize_rows(tf_embeddings) * l2_normalize_rows(onnx_embeddings)).sum(axis=1)
+    return {'min_cosine': float(agreement.min()), 'mean_cosine': float(agreement.mean()), 'sample_size': len(sample_texts)}
+
+
+def load_content_encoder(sample_texts: List[str], model_name: str = BERT_MODEL_NAME) -> Optional[str]:
+    """
+    Chuẩn bị content encoder theo CONTENT_ENCODER_BACKEND. Trả về backend thực sự được dùng
+    ('onnx' hoặc 'tf'), hoặc None nếu không tải được encoder nào.
+
+    Với backend 'onnx': export + lượng tử hóa int8 ở lần đầu, kiểm tra độ khớp cosine với đường
+    TensorFlow trên sample_texts (kết quả được lưu kèm model), sau đó chỉ cần tokenizer và
+    InferenceSession, không giữ TFAutoModel trong bộ nhớ. Nếu ONNX không dùng được hoặc độ khớp
+    thấp hơn ONNX_MIN_COSINE_AGREEMENT thì quay về backend TensorFlow.
+    """
+    global GLOBAL_BERT_TOKENIZER, GLOBAL_BERT_MODEL, GLOBAL_ONNX_SESSION
+    def _load_tf() -> Optional[str]:
+        return 'tf' if load_bert_encoder(model_name) else None
+
+    if CONTENT_ENCODER_BACKEND != 'onnx':
+        return _load_tf()
+    if GLOBAL_ONNX_SESSION is not None:
+        return 'onnx'
+    if ort is None:
+        logger.warning("Chưa cài đặt onnxruntime. Dùng backend TensorFlow cho content encoder.")
+        return _load_tf()
+
+    int8_path = os.path.join(ONNX_MODEL_DIR, ONNX_INT8_FILE)
+    meta_path = os.path.join(ONNX_MODEL_DIR, ONNX_META_FILE)
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+
+    if not (os.path.exists(int8_path) and meta.get('model_name') == model_name and meta.get('max_length') == BERT_MAX_LENGTH):
+        int8_path = export_bert_to_onnx(ONNX_MODEL_DIR, model_name)
+        if int8_path is None:
+            return _load_tf()
+        session = create_onnx_session(int8_path)
+        agreement = validate_onnx_encoder(session, sample_texts[:ONNX_VALIDATION_SAMPLE_SIZE])
+        meta = {'model_name': model_name, 'max_length': BERT_MAX_LENGTH, 'validation': agreement}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=4)
+    else:
+        session = create_onnx_session(int8_path)
+
+    agreement = meta.get('validation', {})
+    logger.info(f"ONNX int8 encoder: cosine so với TensorFlow min={agreement.get('min_cosine', 0.0):.4f}, mean={agreement.get('mean_cosine', 0.0):.4f}.")
+    if agreement.get('min_cosine', 0.0) < ONNX_MIN_COSINE_AGREEMENT:
+        logger.warning(f"Độ khớp cosine của ONNX encoder thấp hơn ONNX_MIN_COSINE_AGREEMENT={ONNX_MIN_COSINE_AGREEMENT}. Dùng backend TensorFlow.")
+        return _load_tf()
+
+    if GLOBAL_BERT_TOKENIZER is None:
+        GLOBAL_BERT_TOKENIZER = AutoTokenizer.from_pretrained(model_name)
+    GLOBAL_ONNX_SESSION = session
+    GLOBAL_BERT_MODEL = None # Giải phóng model TensorFlow (nếu đã tải để export/kiểm tra)
+    gc.collect()
+    logger.info("Content encoder dùng backend ONNX (int8, CPU).")
+    return 'onnx'
+
+
+def plan_length_buckets(
+    token_lengths: np.ndarray,
+    token_budget: int = BERT_TOKEN_BUDGET,
+    max_batch_size: int = BERT_MAX_BATCH_SIZE
+) -> List[np.ndarray]:
+    """
+    Gom các văn bản có độ dài token gần nhau vào cùng batch.
+
+    Văn bản được sắp xếp theo độ dài tăng dần; mỗi batch nhận thêm văn bản cho tới khi
+    (số câu x độ dài dài nhất trong batch) vượt token_budget hoặc đủ max_batch_size câu.
+    Trả về danh sách mảng chỉ số (theo thứ tự gốc) của từng batch.
+    """
+    order = np.argsort(token_lengths, kind='stable')
+    batches: List[np.ndarray] = []
+    batch_start = 0
+    for pos in range(1, len(order) + 1):
+        if pos == len(order):
+            batches.append(order[batch_start:pos])
+            break
+        batch_size_if_added = pos - batch_start + 1
+        longest_if_added = int(token_lengths[order[pos]]) # đã sắp xếp tăng dần
+        if batch_size_if_added > max_batch_size or batch_size_if_added * longest_if_added > token_budget:
+            batches.append(order[batch_start:pos])
+            batch_start = pos
+    return batches
+
+
+def _pad_batch(batch_input_ids: List[List[int]], return_tensors: str):
+    """
+    Pad một batch input_ids đã tokenize thành tensor đầu vào của model.
+    """
+    return GLOBAL_BERT_TOKENIZER.pad({'input_ids': batch_input_ids}, padding=True, return_tensors=return_tensors)
+
+
+def _put_unless_stopped(batch_queue: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """Đưa item vào hàng đợi có giới hạn, chờ khi đầy; bỏ cuộc (False) nếu consumer đã dừng."""
+    while not stop_event.is_set():
+        try:
+            batch_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _produce_padded_batches(texts: List[str], window_starts: List[int], return_tensors: str,
+                            batch_queue: queue.Queue, stop_event: threading.Event):
+    """
+    Luồng producer: tokenize lần lượt từng cửa sổ BERT_TOKENIZE_WINDOW văn bản, chia batch theo độ dài
+    (plan_length_buckets) trong cửa sổ, pad rồi đưa từng batch (chỉ số gốc, số token thật, input) vào
+    hàng đợi. Kết thúc bằng None; lỗi được chuyển qua hàng đợi để consumer raise lại.
+    """
+    try:
+        for window_start in window_starts:
+            window_texts = texts[window_start:window_start + BERT_TOKENIZE_WINDOW]
+            input_ids = GLOBAL_BERT_TOKENIZER(window_texts, truncation=True, max_length=BERT_MAX_LENGTH, padding=False)['input_ids']
+            token_lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+            for rows in plan_length_buckets(token_lengths):
+                encoded_input = _pad_batch([input_ids[row] for row in rows], return_tensors)
+                if not _put_unless_stopped(batch_queue, (window_start + rows, int(token_lengths[rows].sum()), encoded_input), stop_event):
+                    return
+    except Exception as e:
+        _put_unless_stopped(batch_queue, e, stop_event)
         return
+    _put_unless_stopped(batch_queue, None, stop_event)
+
+
+def encode_texts_with_bert(texts: List[str]) -> np.ndarray:
+    """
+    Encode danh sách văn bản thành embeddings (mean pooling) bằng GLOBAL_ONNX_SESSION nếu đang
+    dùng backend ONNX, ngược lại bằng GLOBAL_BERT_MODEL (TensorFlow).
+
+    Producer/consumer: BERT_TOKENIZER_WORKERS luồng tokenize các cửa sổ văn bản, chia batch theo độ dài
+    và pad (_produce_padded_batches), đưa vào hàng đợi tối đa BERT_PREFETCH_BATCHES batch; vòng encode
+    lấy từng batch ra chạy model ngay khi có, nên tokenize và encode chạy chồng lên nhau (fast tokenizer và
+    TF/onnxruntime đều nhả GIL). Dùng luồng thay vì fork tiến trình vì TensorFlow đã được nạp.
+    Trả về mảng float32 [len(texts), dim] theo đúng thứ tự đầu vào.
+    """
+    return_tensors = 'np' if GLOBAL_ONNX_SESSION is not None else 'tf'
+    window_starts = list(range(0, len(texts), max(BERT_TOKENIZE_WINDOW, 1)))
+    n_workers = max(1, min(BERT_TOKENIZER_WORKERS, len(window_starts)))
+    if texts:
+        # Gọi tokenizer một lần trên luồng chính để cấu hình truncation của fast tokenizer trước khi các luồng dùng chung
+        GLOBAL_BERT_TOKENIZER(texts[:1], truncation=True, max_length=BERT_MAX_LENGTH, padding=False)
+
+    batch_queue: queue.Queue = queue.Queue(maxsize=max(BERT_PREFETCH_BATCHES, 1))
+    stop_event = threading.Event()
+    producers = [
+        threading.Thread(target=_produce_padded_batches, daemon=True,
+                         args=(texts, window_starts[worker::n_workers], return_tensors, batch_queue, stop_event))
+        for worker in range(n_workers)
+    ]
+    for producer in producers:
+        producer.start()
+
+    all_embeddings: np.ndarray = None
+    real_tokens = 0
+    padded_tokens = 0
+    n_batches = 0
+    finished_producers = 0
+    try:
+        while finished_producers < n_workers:
+            item = batch_queue.get()
+            if item is None:
+                finished_producers += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+            batch_rows, batch_real_tokens, encoded_input = item
+            real_tokens += batch_real_tokens
+            padded_tokens += int(np.prod(encoded_input['input_ids'].shape))
+            n_batches += 1
+
+            if GLOBAL_ONNX_SESSION is not None:
+                sentence_embeddings = run_onnx_encoder(GLOBAL_ONNX_SESSION, encoded_input['input_ids'], encoded_input['attention_mask'])
+            else:
+                model_output = GLOBAL_BERT_MODEL(**encoded_input)
+                # Thực hiện Mean Pooling để có được embedding của câu
+                sentence_embeddings = mean_pooling_tf(model_output, encoded_input['attention_mask']).numpy()
+            if all_embeddings is None:
+                all_embeddings = np.empty((len(texts), sentence_embeddings.shape[1]), dtype=np.float32)
+            all_embeddings[batch_rows] = sentence_embeddings # Trả về đúng thứ tự gốc
+    finally:
+        stop_event.set()
+        for producer in producers:
+            producer.join()
+
+    logger.info(f"Đã encode {len(texts)} văn bản trong {n_batches} batch theo độ dài ({len(window_starts)} cửa sổ, {n_workers} luồng tokenize). Token thật: {real_tokens}, token sau padding: {padded_tokens} ({real_tokens / max(padded_tokens, 1):.1%} hữu ích).")
+    return all_embeddings
+
+
+def run_in_forked_process(fn, *args):
+    """
+    Chạy fn(*args) trong một tiến trình con (fork) và nhận kết quả qua file pickle tạm. Mọi runtime mà fn
+    khởi tạo (TensorFlow, onnxruntime) kết thúc cùng tiến trình con, nên tiến trình cha vẫn fork worker an toàn
+    về sau (BO song song). Lỗi trong tiến trình con được raise lại ở tiến trình cha dưới dạng RuntimeError.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_path = os.path.join(tmp_dir, 'result.pkl')
+
+        def _child():
+            try:
+                outcome = ('ok', fn(*args))
+            except Exception as e:
+                outcome = ('error', f"{type(e).__name__}: {e}")
+            with open(result_path, 'wb') as f:
+                pickle.dump(outcome, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        process = multiprocessing.get_context('fork').Process(target=_child)
+        process.start()
+        process.join()
+        if not os.path.exists(result_path):
+            raise RuntimeError(f"Tiến trình con kết thúc với mã {process.exitcode} mà không trả về kết quả.")
+        with open(result_path, 'rb') as f:
+            status, value = pickle.load(f)
+    if status != 'ok':
+        raise RuntimeError(value)
+    return value
+
+
+def _encode_missing_embeddings(texts: List[str], match_cache, text_hashes: np.ndarray,
+                               cached_rows: np.ndarray, missing_rows: np.ndarray):
+    """
+    Tải content encoder, đối chiếu lại cache nếu backend thực tế khác CONTENT_ENCODER_BACKEND, rồi encode các
+    văn bản còn thiếu. Trả về (text_hashes, cached_rows, missing_rows, embeddings mới hoặc None), hoặc None nếu
+    không tải được encoder.
+    """
+    encoder_backend = load_content_encoder([texts[row] for row in missing_rows])
+    if encoder_backend is None:
+        return None
+    if encoder_backend != CONTENT_ENCODER_BACKEND:
+        text_hashes, cached_rows, missing_rows = match_cache(encoder_backend)
+    new_embeddings = encode_texts_with_bert([texts[row] for row in missing_rows]) if len(missing_rows) > 0 else None
+    return text_hashes, cached_rows, missing_rows, new_embeddings
+
+
+def initialize_global_bert_model(df_products_product_level: pd.DataFrame):
+    global GLOBAL_PRODUCT_EMBEDDINGS, GLOBAL_PRODUCT_ID_MAP
+    
+    if GLOBAL_PRODUCT_EMBEDDINGS is not None:
+        logger.info("BERT embeddings already initialized. Skipping re-initialization.")
+        return
+
+    logger.info(f"Initializing global Vietnamese-BERT embeddings (encoder backend: {CONTENT_ENCODER_BACKEND}, on-disk embedding cache)...")
 
     if df_products_product_level.empty or 'features_text' not in df_products_product_level.columns:
         logger.warning("No product data or 'features_text' found to generate embeddings.")
@@ -661,92 +2131,378 @@ def initialize_global_bert_model(df_products_product_level: pd.DataFrame):
         logger.warning("All 'features_text' are empty. Cannot generate meaningful BERT embeddings.")
         return
 
-    # 2. Tạo embeddings cho tất cả các features_text
+    # 1. Tính hash của features_text và đối chiếu với embedding cache trên đĩa
     texts = df_products_product_level['features_text'].tolist()
-    
-    # Chia thành các batch để xử lý
-    batch_size = 32 # Tùy chỉnh batch size tùy thuộc vào VRAM GPU hoặc RAM
-    all_embeddings = []
-
-    # Sử dụng tf.data.Dataset để xử lý batching hiệu quả hơn với TensorFlow
-    dataset = tf.data.Dataset.from_tensor_slices(texts).batch(batch_size)
+    product_ids = df_products_product_level['product_id'].to_numpy(dtype=np.int64)
+    cached_vectors, cached_hashes = load_embedding_cache()
+    cached_row_by_hash = {} if cached_hashes is None else {h: row for row, h in enumerate(cached_hashes.tolist())}
+
+    def match_cache(encoder_backend: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        hashes = np.array([features_text_hash(t, encoder_backend=encoder_backend) for t in texts], dtype='S40')
+        rows = np.array([cached_row_by_hash.get(h, -1) for h in hashes.tolist()], dtype=np.int64)
+        return hashes, rows, np.flatnonzero(rows < 0)
+
+    # Khóa cache theo backend đã cấu hình; nếu phải encode và encoder thực sự dùng backend khác
+    # (ví dụ ONNX quay về TensorFlow) thì đối chiếu lại theo backend thực tế trước khi encode
+    text_hashes, cached_rows, missing_rows = match_cache(CONTENT_ENCODER_BACKEND)
+    new_embeddings = None
+    if len(missing_rows) > 0:
+        encode_args = (texts, match_cache, text_hashes, cached_rows, missing_rows)
+        if BO_N_JOBS > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            # BO song song sẽ fork worker: encode trong tiến trình con để tiến trình này không khởi tạo TensorFlow
+            logger.info("Encode content trong tiến trình con (BO_N_JOBS > 1).")
+            encoded = run_in_forked_process(_encode_missing_embeddings, *encode_args)
+        else:
+            encoded = _encode_missing_embeddings(*encode_args)
+        if encoded is None:
+            return
+        text_hashes, cached_rows, missing_rows, new_embeddings = encoded
+    logger.info(f"Embedding cache: {len(texts) - len(missing_rows)} sản phẩm dùng lại, {len(missing_rows)} sản phẩm mới hoặc đã thay đổi cần encode.")
+
+    if len(missing_rows) == 0 and len(cached_rows) == cached_vectors.shape[0] and np.array_equal(cached_rows, np.arange(len(cached_rows))):
+        # Cache khớp hoàn toàn và đúng thứ tự: dùng trực tiếp memmap, không copy
+        GLOBAL_PRODUCT_EMBEDDINGS = cached_vectors
+    else:
+        # 2. Ghép embeddings từ cache với embeddings vừa encode cho các sản phẩm mới hoặc có features_text thay đổi
+        dim = new_embeddings.shape[1] if new_embeddings is not None else cached_vectors.shape[1]
+        embeddings = np.empty((len(texts), dim), dtype=np.float32)
+        reused_rows = np.flatnonzero(cached_rows >= 0)
+        if len(reused_rows) > 0:
+            embeddings[reused_rows] = cached_vectors[cached_rows[reused_rows]]
+        if new_embeddings is not None:
+            embeddings[missing_rows] = new_embeddings
+        cached_vectors = None # Đóng memmap cũ trước khi ghi đè file cache (cần thiết trên Windows)
 
-    for i, batch_texts in enumerate(dataset):
-        # Decode tensor batch_texts to Python list of strings
-        batch_texts_list = [t.decode('utf-8') for t in batch_texts.numpy()]
-        
-        encoded_input = GLOBAL_BERT_TOKENIZER(
-            batch_texts_list, # Truyền list of strings
-            padding=True, 
-            truncation=True, 
-            max_length=256, 
-            return_tensors='tf' # THAY ĐỔI Ở ĐÂY
-        )
-        
-        model_output = GLOBAL_BERT_MODEL(**encoded_input)
-        
-        # Thực hiện Mean Pooling để có được embedding của câu
-        sentence_embeddings = mean_pooling_tf(model_output, encoded_input['attention_mask'])
-        
-        all_embeddings.append(sentence_embeddings)
+        try:
+            GLOBAL_PRODUCT_EMBEDDINGS = save_embedding_cache(embeddings, text_hashes, product_ids)
+            logger.info(f"Đã cập nhật embedding cache tại {EMBEDDING_CACHE_DIR}.")
+        except Exception as e:
+            logger.warning(f"Không thể ghi embedding cache vào {EMBEDDING_CACHE_DIR}: {e}. Dùng embeddings trong bộ nhớ.")
+            GLOBAL_PRODUCT_EMBEDDINGS = embeddings
 
-    GLOBAL_PRODUCT_EMBEDDINGS = tf.concat(all_embeddings, axis=0) # Gộp tất cả embeddings lại
     logger.info(f"Global product embeddings shape: {GLOBAL_PRODUCT_EMBEDDINGS.shape}")
 
     GLOBAL_PRODUCT_ID_MAP = {pid: idx for idx, pid in enumerate(df_products_product_level['product_id'])}
-    logger.info(f"Global BERT model initialized and embeddings generated successfully. Mapped {len(GLOBAL_PRODUCT_ID_MAP)} product IDs.")
+    logger.info(f"Global BERT embeddings initialized successfully. Mapped {len(GLOBAL_PRODUCT_ID_MAP)} product IDs.")
 
 
-def compute_content_similarity(df_products_for_map: pd.DataFrame, top_k: int = TOP_K) -> Dict[int, List[Tuple[int, float]]]:
+# === APPROXIMATE NEAREST NEIGHBOUR (HNSW) CHO EMBEDDINGS SẢN PHẨM ===
+ANN_INDEX_FILE_NAME = 'content_hnsw.bin'
+ANN_META_FILE_NAME = 'content_hnsw_meta.json'
+_ANN_INDEX_CACHE: Dict[str, tuple] = {} # index_dir -> (index, meta) đã dựng/tải trong tiến trình này
+_ANN_QUERY_LOCK = threading.Lock() # hnswlib giữ ef trong index: mỗi truy vấn đặt ef của nó rồi khôi phục dưới khóa này
+
+
+def _ann_fingerprint(product_ids: np.ndarray, embeddings: np.ndarray, m: int, ef_construction: int) -> str:
+    """
+    Dấu vân tay của dữ liệu dựng index: đổi sản phẩm, embedding hoặc tham số dựng thì index phải dựng lại.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(product_ids, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+    digest.update(f"M={m};ef_construction={ef_construction}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_ann_index(index_dir: str = ANN_INDEX_DIR):
+    """
+    Tải index HNSW đã lưu trên đĩa (dùng lại giữa các lần chạy và ở bước serving).
+    Trả về (index, meta) hoặc (None, None) nếu chưa có index hoặc thiếu hnswlib.
+    Nên gọi qua get_ann_index để chỉ tải một lần mỗi tiến trình.
+    """
+    index_path = os.path.join(index_dir, ANN_INDEX_FILE_NAME)
+    meta_path = os.path.join(index_dir, ANN_META_FILE_NAME)
+    if hnswlib is None or not (os.path.exists(index_path) and os.path.exists(meta_path)):
+        return None, None
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        index = hnswlib.Index(space='cosine', dim=int(meta['dim']))
+        index.load_index(index_path, max_elements=int(meta['count']))
+        return index, meta
+    except Exception as e:
+        logger.warning(f"Không thể tải ANN index từ {index_dir}: {e}")
+        return None, None
+
+
+def get_ann_index(index_dir: str = ANN_INDEX_DIR):
+    """
+    Index đã dựng/tải trong tiến trình này (_ANN_INDEX_CACHE); nếu chưa có thì tải từ đĩa một lần rồi giữ lại.
+    Trả về (index, meta) hoặc (None, None).
+    """
+    index, meta = _ANN_INDEX_CACHE.get(index_dir, (None, None))
+    if index is None:
+        index, meta = load_ann_index(index_dir)
+        if index is not None:
+            logger.info(f"Đã tải ANN index ({meta['count']} sản phẩm) từ {index_dir}.")
+            _ANN_INDEX_CACHE[index_dir] = (index, meta)
+    return index, meta
+
+
+def build_or_load_ann_index(
+    normalized_embeddings: np.ndarray,
+    product_ids: np.ndarray,
+    index_dir: str = ANN_INDEX_DIR,
+    m: int = ANN_HNSW_M,
+    ef_construction: int = ANN_HNSW_EF_CONSTRUCTION
+):
+    """
+    Dựng (hoặc tải lại nếu dữ liệu không đổi) index HNSW trên CPU cho embeddings sản phẩm.
+    Nhãn của mỗi vector chính là product_id. Trả về (index, meta) hoặc (None, None) nếu thiếu hnswlib.
+    """
+    if hnswlib is None:
+        logger.warning("Chưa cài đặt hnswlib. Không thể dùng ANN backend cho content similarity.")
+        return None, None
+
+    fingerprint = _ann_fingerprint(product_ids, normalized_embeddings, m, ef_construction)
+    index, meta = get_ann_index(index_dir)
+    if index is not None and meta.get('fingerprint') == fingerprint:
+        return index, meta
+
+    n_items, dim = normalized_embeddings.shape
+    logger.info(f"Đang dựng ANN index HNSW cho {n_items} sản phẩm (dim={dim}, M={m}, ef_construction={ef_construction})...")
+    index = hnswlib.Index(space='cosine', dim=dim)
+    index.init_index(max_elements=n_items, ef_construction=ef_construction, M=m)
+    index.add_items(normalized_embeddings, np.asarray(product_ids, dtype=np.int64))
+
+    meta = {
+        'fingerprint': fingerprint,
+        'dim': int(dim),
+        'count': int(n_items),
+        'M': int(m),
+        'ef_construction': int(ef_construction),
+        'created_at': pd.Timestamp.now().isoformat(),
+    }
+    try:
+        os.makedirs(index_dir, exist_ok=True)
+        index.save_index(os.path.join(index_dir, ANN_INDEX_FILE_NAME))
+        save_ann_meta(meta, index_dir)
+        logger.info(f"Đã lưu ANN index vào {index_dir}.")
+    except Exception as e:
+        logger.warning(f"Không thể lưu ANN index vào {index_dir}: {e}")
+    _ANN_INDEX_CACHE[index_dir] = (index, meta)
+    return index, meta
+
+
+def save_ann_meta(meta: Dict, index_dir: str = ANN_INDEX_DIR):
+    """
+    Ghi metadata của ANN index (fingerprint, tham số dựng, recall đã đo) ra đĩa.
+    """
+    with open(os.path.join(index_dir, ANN_META_FILE_NAME), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+def ann_query_neighbors(
+    index,
+    query_embeddings: np.ndarray,
+    top_k: int,
+    query_product_ids: np.ndarray = None,
+    min_score: float = 1e-6,
+    ef: int = ANN_HNSW_EF_SEARCH
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Truy vấn top-k láng giềng xấp xỉ cho một loạt embedding với ef = max(ef, k) của riêng truy vấn này
+    (ef của index dùng chung được khôi phục sau truy vấn). Nếu có query_product_ids thì loại bỏ chính
+    sản phẩm đó khỏi kết quả.
+
+    Returns:
+        Tuple gồm (neighbor_ids [n, top_k] int64 (đệm -1), scores [n, top_k] float32 (cosine), counts [n]).
+    """
+    query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+    n_queries = query_embeddings.shape[0]
+    neighbor_ids = np.full((n_queries, top_k), -1, dtype=np.int64)
+    scores = np.zeros((n_queries, top_k), dtype=np.float32)
+    counts = np.zeros(n_queries, dtype=np.int32)
+    k = min(top_k + (1 if query_product_ids is not None else 0), index.get_current_count())
+    if n_queries == 0 or k == 0:
+        return neighbor_ids, scores, counts
+    with _ANN_QUERY_LOCK:
+        previous_ef = index.ef
+        index.set_ef(max(int(ef), k))
+        try:
+            labels, distances = index.knn_query(query_embeddings, k=k)
+        finally:
+            index.set_ef(previous_ef)
+    labels = labels.astype(np.int64)
+    sims = (1.0 - distances).astype(np.float32) # khoảng cách cosine của hnswlib là 1 - cos
+
+    valid = sims > min_score
+    if query_product_ids is not None:
+        valid &= labels != np.asarray(query_product_ids, dtype=np.int64)[:, None]
+    # Dồn các phần tử hợp lệ lên đầu (giữ thứ tự giảm dần), rồi cắt còn top_k
+    order = np.argsort(~valid, axis=1, kind='stable')
+    labels = np.take_along_axis(labels, order, axis=1)[:, :top_k]
+    sims = np.take_along_axis(sims, order, axis=1)[:, :top_k]
+    valid = np.take_along_axis(valid, order, axis=1)[:, :top_k]
+
+    width = labels.shape[1]
+    neighbor_ids[:, :width] = np.where(valid, labels, -1)
+    scores[:, :width] = np.where(valid, sims, 0.0)
+    counts[:] = valid.sum(axis=1)
+    return neighbor_ids, scores, counts
+
+
+def evaluate_ann_recall(
+    index,
+    normalized_embeddings: np.ndarray,
+    product_ids: np.ndarray,
+    top_k: int,
+    sample_size: int = ANN_RECALL_SAMPLE_SIZE,
+    random_state: int = 42,
+    ef: int = ANN_HNSW_EF_SEARCH
+) -> float:
+    """
+    Đo recall@top_k của ANN index so với tìm kiếm chính xác trên một mẫu sản phẩm ngẫu nhiên.
+    """
+    n_items = normalized_embeddings.shape[0]
+    if n_items < 2 or top_k <= 0:
+        return 1.0
+    rng = np.random.default_rng(random_state)
+    sample_rows = np.sort(rng.choice(n_items, size=min(sample_size, n_items), replace=False))
+    product_ids = np.asarray(product_ids, dtype=np.int64)
+
+    exact_sim = normalized_embeddings[sample_rows] @ normalized_embeddings.T
+    exact_sim[np.arange(len(sample_rows)), sample_rows] = -np.inf
+    exact_sim[exact_sim <= 1e-6] = -np.inf
+    k = min(top_k, n_items - 1)
+    exact_pos = np.argpartition(-exact_sim, k - 1, axis=1)[:, :k]
+    exact_valid = np.isfinite(np.take_along_axis(exact_sim, exact_pos, axis=1))
+
+    ann_ids, _, _ = ann_query_neighbors(index, normalized_embeddings[sample_rows], k, product_ids[sample_rows], ef=ef)
+
+    hits, total = 0, 0
+    for row in range(len(sample_rows)):
+        expected = set(product_ids[exact_pos[row][exact_valid[row]]].tolist())
+        if expected:
+            hits += len(expected.intersection(ann_ids[row].tolist()))
+            total += len(expected)
+    recall = hits / total if total else 1.0
+    logger.info(f"ANN recall@{k} so với tìm kiếm chính xác trên {len(sample_rows)} sản phẩm mẫu: {recall:.4f}")
+    return recall
+
+
+def find_similar_products_ann(
+    query_embeddings: np.ndarray,
+    top_k: int = TOP_K,
+    index_dir: str = ANN_INDEX_DIR,
+    exclude_product_ids: np.ndarray = None,
+    ef: int = ANN_HNSW_EF_SEARCH
+) -> List[List[Tuple[int, float]]]:
+    """
+    Tìm láng giềng cho sản phẩm mới (hoặc bất kỳ embedding nào) từ ANN index đã lưu,
+    không cần tính lại toàn bộ ma trận tương đồng. Dùng được ở bước serving.
+    Index chỉ được tải từ đĩa ở lần gọi đầu tiên (get_ann_index); ef áp dụng cho riêng truy vấn này.
+    """
+    index, _ = get_ann_index(index_dir)
+    if index is None:
+        logger.warning(f"Không tìm thấy ANN index tại {index_dir}. Hãy chạy compute_content_similarity với backend 'hnsw' trước.")
+        return []
+    neighbor_ids, scores, counts = ann_query_neighbors(
+        index, l2_normalize_rows(np.atleast_2d(query_embeddings)), top_k, exclude_product_ids, ef=ef
+    )
+    return [
+        list(zip(neighbor_ids[row][:n].tolist(), scores[row][:n].tolist()))
+        for row, n in enumerate(counts.tolist())
+    ]
+
+
+def compute_content_similarity_topk(top_k: int = TOP_K) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Top-k láng giềng nội dung (cosine trên GLOBAL_PRODUCT_EMBEDDINGS) của mọi sản phẩm dưới dạng mảng:
+    (product_ids [n], neighbor_ids [n, top_k] (đệm -1), scores [n, top_k] float32, counts [n]).
+    Các láng giềng được sắp giảm dần nên top-k nhỏ hơn chỉ là cắt cột. Trả về None nếu chưa có embeddings.
+    """
     logger.info("Computing content-based item-item similarity at PRODUCT level using BERT embeddings (TensorFlow backend)...")
 
-    if GLOBAL_BERT_MODEL is None or GLOBAL_PRODUCT_EMBEDDINGS is None:
-        logger.error("Global BERT model or product embeddings not initialized. Cannot compute content similarity. Please call initialize_global_bert_model first.")
-        return {}
+    if GLOBAL_PRODUCT_EMBEDDINGS is None:
+        logger.error("Global product embeddings not initialized. Cannot compute content similarity. Please call initialize_global_bert_model first.")
+        return None
     
     if GLOBAL_PRODUCT_EMBEDDINGS.shape[0] == 0:
         logger.warning("GLOBAL_PRODUCT_EMBEDDINGS is empty. Cannot compute content similarity.")
+        return None
+
+    # Chuẩn hóa embeddings (float32) một lần rồi tìm top-k theo từng chunk, không tạo ma trận N x N
+    normalized_embeddings = l2_normalize_rows(np.asarray(GLOBAL_PRODUCT_EMBEDDINGS))
+    logger.info(f"Content embeddings shape: {normalized_embeddings.shape}, chunk size: {CONTENT_SIMILARITY_CHUNK_SIZE}")
+
+    index_to_product_id = np.empty(len(GLOBAL_PRODUCT_ID_MAP), dtype=np.int64)
+    for pid, idx in GLOBAL_PRODUCT_ID_MAP.items():
+        index_to_product_id[idx] = pid
+
+    neighbor_ids = None
+    if CONTENT_SIMILARITY_BACKEND == 'hnsw':
+        ann_index, ann_meta = build_or_load_ann_index(normalized_embeddings, index_to_product_id)
+        if ann_index is not None:
+            # Recall được đo một lần cho mỗi (top_k, ef_search) rồi lưu cùng metadata của index
+            recall_key = f"k={top_k};ef={ANN_HNSW_EF_SEARCH}"
+            recall = ann_meta.get('recall', {}).get(recall_key)
+            if recall is None:
+                recall = evaluate_ann_recall(ann_index, normalized_embeddings, index_to_product_id, top_k, ef=ANN_HNSW_EF_SEARCH)
+                ann_meta.setdefault('recall', {})[recall_key] = recall
+                try:
+                    save_ann_meta(ann_meta)
+                except Exception as e:
+                    logger.warning(f"Không thể lưu recall vào metadata của ANN index: {e}")
+            if recall >= ANN_MIN_RECALL:
+                neighbor_ids, scores, counts = ann_query_neighbors(
+                    ann_index, normalized_embeddings, top_k, index_to_product_id, ef=ANN_HNSW_EF_SEARCH
+                )
+            else:
+                logger.warning(f"ANN recall {recall:.4f} < ANN_MIN_RECALL={ANN_MIN_RECALL}. Chuyển sang tìm kiếm chính xác (hãy tăng ANN_HNSW_EF_SEARCH/ANN_HNSW_M).")
+
+    if neighbor_ids is None:
+        neighbor_idx, scores, counts = dense_topk_chunked(
+            normalized_embeddings, top_k, min_score=1e-6, chunk_size=CONTENT_SIMILARITY_CHUNK_SIZE
+        )
+        neighbor_ids = np.where(neighbor_idx >= 0, index_to_product_id[np.maximum(neighbor_idx, 0)], -1)
+
+    logger.info(f"Finished computing content-based item-item similarity for {len(index_to_product_id)} products.")
+    if counts.any():
+        logger.info(f"Max content similarity score after filtering and top-k: {float(scores[:, 0].max())}")
+    else:
+        logger.warning("No content similarities found after all processing steps.")
+    return index_to_product_id, neighbor_ids, scores, counts
+
+
+def compute_content_similarity(df_products_for_map: pd.DataFrame, top_k: int = TOP_K) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Độ tương đồng nội dung dạng Dict[int, List[Tuple[int, float]]] (xem compute_content_similarity_topk).
+    """
+    content_topk = compute_content_similarity_topk(top_k)
+    if content_topk is None:
         return {}
+    return topk_arrays_to_dict(*content_topk)
 
-    # Chuyển embeddings về dạng numpy array để dùng sklearn's cosine_similarity
-    embeddings_np = GLOBAL_PRODUCT_EMBEDDINGS.numpy()
-    
-    content_sim_matrix = cosine_similarity(embeddings_np, dense_output=True) 
+def _similarity_dict_to_arrays(sims: Dict[int, List[Tuple[int, float]]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Trải Dict[int, List[Tuple[int, float]]] thành ba mảng cột (p1, p2, score).
+    """
+    lengths = np.fromiter((len(v) for v in sims.values()), dtype=np.int64, count=len(sims))
+    total = int(lengths.sum())
+    p1 = np.repeat(np.fromiter(sims.keys(), dtype=np.int64, count=len(sims)), lengths)
+    p2 = np.fromiter((t[0] for v in sims.values() for t in v), dtype=np.int64, count=total)
+    scores = np.fromiter((t[1] for v in sims.values() for t in v), dtype=np.float64, count=total)
+    return p1, p2, scores
 
-    logger.info(f"Content similarity matrix shape: {content_sim_matrix.shape}")
-    
-    content_similarities: Dict[int, List[Tuple[int, float]]] = {}
-    index_to_product_id_map = {idx: pid for pid, idx in GLOBAL_PRODUCT_ID_MAP.items()}
 
-    # Các product_id bạn muốn debug chi tiết (ví dụ: các sản phẩm Xiaomi, iPhone, Samsung từ trước)
-    # target_product_ids = {64, 65, 66, 67, 74, 56, 58, 59, 73, 61} # Thêm các ID liên quan để debug
+def compute_dynamic_alpha(
+    interaction_counts: np.ndarray,
+    alpha_base: float,
+    cold_start_threshold: int,
+    min_alpha_cold_start: float = 0.1
+) -> np.ndarray:
+    """
+    Alpha động cho cả mảng sản phẩm: sản phẩm cold-start (ít hơn cold_start_threshold tương tác) có alpha
+    giảm tuyến tính theo số tương tác, không thấp hơn min_alpha_cold_start; sản phẩm warm-start giữ alpha_base.
+    """
+    interaction_counts = np.asarray(interaction_counts, dtype=np.float64)
+    cold = interaction_counts < cold_start_threshold
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reduction_factor = (cold_start_threshold - interaction_counts) / cold_start_threshold
+    cold_alpha = np.maximum(min_alpha_cold_start, alpha_base * (1 - reduction_factor))
+    return np.where(cold, cold_alpha, alpha_base)
 
-    for i, product_id_i in index_to_product_id_map.items():
-        row = content_sim_matrix[i] 
-        
-        filtered_neighbors = []
-        for j_idx, s in enumerate(row):
-            if j_idx != i and s > 1e-6: # Ngưỡng nhỏ để loại bỏ noise
-                filtered_neighbors.append((j_idx, s))
-
-        if filtered_neighbors:
-            topk_pairs = sorted(filtered_neighbors, key=lambda x: x[1], reverse=True)[:top_k]
-            content_similarities[product_id_i] = [(index_to_product_id_map[j_idx], float(s)) for j_idx, s in topk_pairs]
-            # Debugging cho các sản phẩm cụ thể
-            # if product_id_i in target_product_ids:
-            #     logger.info(f"  Top {len(content_similarities[product_id_i])} content-based similarities for {product_id_i}: {content_similarities[product_id_i]}")
-        else:
-            content_similarities[product_id_i] = []
-            # if product_id_i in target_product_ids:
-            #     logger.info(f"  No content-based similarities found (after filtering) for product {product_id_i}.")
-
-    logger.info(f"Finished computing content-based item-item similarity for {len(content_similarities)} products.")
-    all_scores = [score for sims in content_similarities.values() for _, score in sims]
-    if all_scores:
-        logger.info(f"Max content similarity score after filtering and top-k: {max(all_scores)}")
-    else:
-        logger.warning("No content similarities found after all processing steps.")
-    return content_similarities
 
 def combine_similarities(
     collab_sims: Dict[int, List[Tuple[int, float]]],
@@ -756,51 +2512,67 @@ def combine_similarities(
     cold_start_threshold: int,
     top_k: int = 10,
     min_alpha_cold_start: float = 0.1
-) -> Dict[int, List[Tuple[int, float, float, float]]]:
-    logger.info(f"Combining similarities with base_alpha={alpha_base}, cold_start_threshold={cold_start_threshold}")
-
-    hybrid_similarities_detail: Dict[int, Dict[int, Tuple[float, float, float]]] = defaultdict(lambda: defaultdict(lambda: (0.0, 0.0, 0.0)))
-
-    all_product_ids = set(collab_sims.keys()).union(set(content_sims.keys()))
-
-    for p1 in all_product_ids:
-        p1_interactions = item_interaction_counts.get(p1, 0)
-
-        dynamic_alpha = alpha_base
-        if p1_interactions < cold_start_threshold:
-            reduction_factor = (cold_start_threshold - p1_interactions) / cold_start_threshold
-            dynamic_alpha = alpha_base * (1 - reduction_factor)
-            dynamic_alpha = max(min_alpha_cold_start, dynamic_alpha)
-            logger.debug(f"Product {p1} is cold-start ({p1_interactions} interactions < {cold_start_threshold}). Dynamic alpha adjusted to: {dynamic_alpha:.4f}")
-        else:
-            logger.debug(f"Product {p1} is warm-start ({p1_interactions} interactions >= {cold_start_threshold}). Dynamic alpha: {dynamic_alpha:.4f}")
-        
-        logger.info(f"DEBUGGING ALPHA: For p1={p1} (Interactions: {p1_interactions}), cold_start_threshold={cold_start_threshold}, dynamic_alpha used: {dynamic_alpha:.4f}")
-
-        collab_neighbors_map = {p2: score for p2, score in collab_sims.get(p1, [])}
-        content_neighbors_map = {p2: score for p2, score in content_sims.get(p1, [])}
-
-        all_neighbors_for_p1 = set(collab_neighbors_map.keys()).union(set(content_neighbors_map.keys()))
-
-        for p2 in all_neighbors_for_p1:
-            if p1 == p2:
-                continue
-
-            cf_score = collab_neighbors_map.get(p2, 0.0)
-            content_score = content_neighbors_map.get(p2, 0.0)
-
-            hybrid_score = (dynamic_alpha * cf_score) + ((1 - dynamic_alpha) * content_score)
+) -> 'SimilarityTable':
+    """
+    Kết hợp độ tương đồng CF và nội dung theo dạng cột: hai danh sách top-k được nối theo cặp (p1, p2)
+    trên một chỉ mục sản phẩm chung, alpha động của p1 được tính cho cả mảng (compute_dynamic_alpha)
+    và áp dụng bằng broadcasting, rồi chọn top-k hybrid của mỗi hàng bằng topk_from_csr.
 
-            hybrid_similarities_detail[p1][p2] = (
-                max(0.0, float(hybrid_score)),
-                max(0.0, float(cf_score)),
-                max(0.0, float(content_score))
-            )
+    Kết quả là một SimilarityTable: mỗi cặp giữ (hybrid, cf, content) đã cắt về >= 0, cặp chỉ có ở một nguồn
+    nhận điểm 0 cho nguồn còn lại, bỏ cặp p1 == p2 (như phiên bản dict trước đây).
+    """
+    logger.info(f"Combining similarities with base_alpha={alpha_base}, cold_start_threshold={cold_start_threshold}")
 
-    final_hybrid_sims: Dict[int, List[Tuple[int, float, float, float]]] = {}
-    for p1, p2_scores_detail in hybrid_similarities_detail.items():
-        sorted_neighbors = sorted(p2_scores_detail.items(), key=lambda x: x[1][0], reverse=True)[:top_k]
-        final_hybrid_sims[p1] = [(p2, hs, cfs, cons) for p2, (hs, cfs, cons) in sorted_neighbors]
+    cf_p1, cf_p2, cf_scores = _similarity_dict_to_arrays(collab_sims)
+    ct_p1, ct_p2, ct_scores = _similarity_dict_to_arrays(content_sims)
+    product_index = pd.Index(np.unique(np.concatenate([cf_p1, cf_p2, ct_p1, ct_p2])))
+    n_products = len(product_index)
+    if n_products == 0 or top_k <= 0:
+        return SimilarityTable.from_pairs(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+
+    # Nối hai nguồn theo khóa cặp (p1, p2); trong mỗi nguồn, cặp trùng lặp giữ giá trị cuối như dict cũ
+    cf_keys = product_index.get_indexer(cf_p1) * n_products + product_index.get_indexer(cf_p2)
+    ct_keys = product_index.get_indexer(ct_p1) * n_products + product_index.get_indexer(ct_p2)
+    pair_keys = np.unique(np.concatenate([cf_keys, ct_keys]))
+    pair_cf = np.zeros(pair_keys.size)
+    pair_content = np.zeros(pair_keys.size)
+    pair_cf[np.searchsorted(pair_keys, cf_keys)] = cf_scores
+    pair_content[np.searchsorted(pair_keys, ct_keys)] = ct_scores
+    pair_rows, pair_cols = np.divmod(pair_keys, n_products)
+    not_self = pair_rows != pair_cols
+    pair_keys, pair_rows, pair_cols = pair_keys[not_self], pair_rows[not_self], pair_cols[not_self]
+    pair_cf, pair_content = pair_cf[not_self], pair_content[not_self]
+
+    interaction_counts = pd.Series(item_interaction_counts, dtype='float64').reindex(product_index).fillna(0).to_numpy()
+    dynamic_alpha = compute_dynamic_alpha(interaction_counts, alpha_base, cold_start_threshold, min_alpha_cold_start)
+    n_cold = int((interaction_counts < cold_start_threshold).sum())
+    logger.debug(f"Dynamic alpha: {n_cold}/{n_products} sản phẩm cold-start (< {cold_start_threshold} tương tác), alpha trong [{dynamic_alpha.min():.4f}, {dynamic_alpha.max():.4f}]")
+
+    pair_alpha = dynamic_alpha[pair_rows]
+    pair_hybrid = np.maximum(0.0, pair_alpha * pair_cf + (1 - pair_alpha) * pair_content)
+    pair_cf = np.maximum(0.0, pair_cf)
+    pair_content = np.maximum(0.0, pair_content)
+
+    # pair_keys đã sắp xếp theo (hàng, cột) nên có thể dựng CSR trực tiếp
+    row_lengths = np.bincount(pair_rows, minlength=n_products)
+    hybrid_matrix = csr_matrix(
+        (pair_hybrid, pair_cols, np.concatenate([[0], np.cumsum(row_lengths)])),
+        shape=(n_products, n_products)
+    )
+    neighbor_idx, _, counts = topk_from_csr(hybrid_matrix, top_k, drop_diagonal=False)
+
+    # Lấy lại bộ điểm đầy đủ của các cặp được chọn theo khóa cặp
+    rows_with_neighbors = np.flatnonzero(counts > 0)
+    selected_rows = np.repeat(rows_with_neighbors, counts[rows_with_neighbors])
+    selected_cols = neighbor_idx[rows_with_neighbors][np.arange(top_k) < counts[rows_with_neighbors, None]]
+    selected_pos = np.searchsorted(pair_keys, selected_rows * n_products + selected_cols)
+
+    final_hybrid_sims = SimilarityTable._from_rows(
+        product_index.to_numpy(dtype=np.int64), selected_rows, selected_cols,
+        pair_hybrid[selected_pos].astype(np.float32),
+        pair_cf[selected_pos].astype(np.float32),
+        pair_content[selected_pos].astype(np.float32)
+    )
 
     logger.info(f"Finished combining similarities for {len(final_hybrid_sims)} products, now including detailed scores and dynamic alpha.")
     return final_hybrid_sims
@@ -823,6 +2595,96 @@ def load_product_features() -> pd.DataFrame:
         logger.error(f"Lỗi khi tải dữ liệu thuộc tính sản phẩm: {e}")
         return pd.DataFrame()
         
+def mmr_select_batch(
+    relevance: np.ndarray,
+    similarity: np.ndarray,
+    lambda_diversity: float,
+    top_n: int,
+    min_mmr_score: float = -np.inf
+) -> np.ndarray:
+    """
+    Maximal Marginal Relevance cho nhiều danh sách ứng viên cùng lúc.
+
+    relevance [n_lists, n] là điểm liên quan theo thứ tự ứng viên (NaN/-inf ở vị trí đệm), similarity
+    [n_lists, n, n] là độ tương đồng nội dung giữa các ứng viên. Ứng viên ở vị trí 0 được chọn đầu tiên
+    (danh sách đã sắp xếp giảm dần theo relevance); mỗi bước sau là một argmax của
+    lambda * relevance - (1 - lambda) * max_sim, với max_sim là độ tương đồng lớn nhất (>= 0) tới các
+    ứng viên đã chọn, được cập nhật dần thay vì tính lại. Một danh sách dừng khi hết ứng viên hoặc điểm
+    MMR tốt nhất không lớn hơn min_mmr_score.
+
+    Returns:
+        selected [n_lists, top_n] int64: vị trí ứng viên theo thứ tự được chọn, đệm -1.
+    """
+    relevance = np.asarray(relevance, dtype=np.float64)
+    n_lists, n_candidates = relevance.shape
+    top_n = max(0, int(top_n))
+    selected = np.full((n_lists, top_n), -1, dtype=np.int64)
+    if n_lists == 0 or n_candidates == 0 or top_n == 0:
+        return selected
+
+    available = np.isfinite(relevance)
+    active = available[:, 0].copy()
+    list_rows = np.arange(n_lists)
+    max_similarity = np.zeros((n_lists, n_candidates))
+    relevance_term = lambda_diversity * np.where(available, relevance, 0.0)
+
+    choice = np.zeros(n_lists, dtype=np.int64)
+    for step in range(top_n):
+        if step > 0:
+            mmr_scores = np.where(available, relevance_term - (1 - lambda_diversity) * max_similarity, -np.inf)
+            choice = np.argmax(mmr_scores, axis=1)
+            active &= mmr_scores[list_rows, choice] > min_mmr_score
+        if not active.any():
+            break
+        selected[active, step] = choice[active]
+        available[list_rows[active], choice[active]] = False
+        chosen_similarity = similarity[list_rows, :, choice]
+        max_similarity[active] = np.maximum(max_similarity[active], chosen_similarity[active])
+    return selected
+
+
+def mmr_select(
+    relevance: np.ndarray,
+    similarity: np.ndarray,
+    lambda_diversity: float,
+    top_n: int,
+    min_mmr_score: float = -np.inf
+) -> np.ndarray:
+    """
+    MMR cho một danh sách ứng viên (xem mmr_select_batch). Trả về vị trí các ứng viên theo thứ tự được chọn.
+    """
+    selected = mmr_select_batch(np.asarray(relevance, dtype=np.float64)[None, :], np.asarray(similarity)[None, :, :],
+                                lambda_diversity, top_n, min_mmr_score)[0]
+    return selected[selected >= 0]
+
+
+def mmr_diversity_batch(
+    candidate_ids: np.ndarray,
+    relevance: np.ndarray,
+    content_table: 'SimilarityTable',
+    lambda_diversity: float,
+    top_n: int,
+    min_mmr_score: float = -np.inf
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Đa dạng hóa danh sách ứng viên của nhiều người dùng cùng lúc. candidate_ids [n_users, n] (đệm -1) và
+    relevance [n_users, n] đã sắp xếp giảm dần theo relevance trên mỗi hàng; độ tương đồng nội dung giữa
+    các ứng viên được lấy một lần từ content_table (SimilarityTable, cột content).
+
+    Returns:
+        Tuple (selected_ids [n_users, top_n] đệm -1, selected_scores [n_users, top_n] relevance gốc, đệm 0).
+    """
+    candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+    relevance = np.where(candidate_ids >= 0, np.asarray(relevance, dtype=np.float64), -np.inf)
+    similarity = content_table.submatrices(candidate_ids, column='content')
+    positions = mmr_select_batch(relevance, similarity, lambda_diversity, top_n, min_mmr_score)
+    has_choice = positions >= 0
+    user_rows = np.arange(candidate_ids.shape[0])[:, None]
+    selected_ids = np.where(has_choice, candidate_ids[user_rows, np.maximum(positions, 0)], -1)
+    selected_scores = np.where(has_choice, relevance[user_rows, np.maximum(positions, 0)], 0.0)
+    return selected_ids, selected_scores
+
+
 def prepare_content_sim_for_lookup(content_sims: Dict[int, List[Tuple[int, float]]]) -> Dict[int, Dict[int, float]]:
     """
     Chuyển đổi Dict[int, List[Tuple[int, float]]] thành Dict[int, Dict[int, float]]
@@ -838,7 +2700,7 @@ def prepare_content_sim_for_lookup(content_sims: Dict[int, List[Tuple[int, float
 
 def mmr_diversity(
     candidate_items_with_scores: List[Tuple[int, float]],
-    content_sim_lookup: Dict[int, Dict[int, float]],
+    content_sim_lookup: Union[Dict[int, Dict[int, float]], 'SimilarityTable'],
     lambda_diversity: float,
     top_n: int
 ) -> List[Tuple[int, float]]:
@@ -850,8 +2712,8 @@ def mmr_diversity(
         candidate_items_with_scores (List[Tuple[int, float]]): Danh sách các sản phẩm ứng viên
             và điểm số tương ứng của chúng (ví dụ: điểm hybrid score), đã được sắp xếp giảm dần
             theo điểm số.
-        content_sim_lookup (Dict[int, Dict[int, float]]): Bảng tra cứu độ tương đồng nội dung
-            giữa các cặp sản phẩm.
+        content_sim_lookup (Dict[int, Dict[int, float]] | SimilarityTable): Bảng tra cứu độ tương đồng
+            nội dung giữa các cặp sản phẩm.
         lambda_diversity (float): Tham số cân bằng giữa sự liên quan (relevance) và đa dạng (diversity).
             Giá trị từ 0.0 (chỉ đa dạng) đến 1.0 (chỉ liên quan).
         top_n (int): Số lượng sản phẩm cuối cùng muốn đề xuất.
@@ -864,54 +2726,19 @@ def mmr_diversity(
         logger.warning("Danh sách sản phẩm ứng viên rỗng. Không thể áp dụng MMR.")
         return []
 
-    selected_recommendations: List[Tuple[int, float]] = []
-    selected_items_ids: Set[int] = set()
-    
-    unselected_candidates = list(candidate_items_with_scores)
+    candidate_ids = [item_id for item_id, _ in candidate_items_with_scores]
+    relevance = np.array([score for _, score in candidate_items_with_scores], dtype=np.float64)
+    # Ma trận độ tương đồng nội dung giữa các ứng viên, tra cứu một lần
+    if isinstance(content_sim_lookup, SimilarityTable):
+        similarity = content_sim_lookup.submatrix(candidate_ids, column='content')
+    else:
+        similarity = np.array([[content_sim_lookup.get(c, {}).get(sel, 0.0) for sel in candidate_ids] for c in candidate_ids], dtype=np.float64)
 
-    # Bước 1: Chọn sản phẩm đầu tiên có điểm số cao nhất (relevance cao nhất)
-    # Giả định `candidate_items_with_scores` đã được sắp xếp theo điểm relevance
-    if not unselected_candidates:
-        return []
-
-    first_item = unselected_candidates[0]
-    selected_recommendations.append(first_item)
-    selected_items_ids.add(first_item[0])
-    unselected_candidates.pop(0)
-
-    logger.info(f"MMR: Đã chọn sản phẩm đầu tiên: {first_item[0]} với điểm {first_item[1]:.4f}")
-
-    # Bước 2: Lặp lại cho đến khi đủ top_n sản phẩm
-    while len(selected_recommendations) < top_n and unselected_candidates:
-        best_mmr_score = -np.inf
-        best_item_for_this_iteration = None
-        index_to_remove = -1
-
-        for idx, (candidate_item_id, relevance_score) in enumerate(unselected_candidates):
-            # Tính max_similarity_to_selected_items
-            max_sim_to_selected = 0.0
-            for selected_item_id in selected_items_ids:
-                sim = content_sim_lookup.get(candidate_item_id, {}).get(selected_item_id, 0.0)
-                max_sim_to_selected = max(max_sim_to_selected, sim)
-            
-            # Tính điểm MMR
-            # MMR = lambda * Relevance - (1 - lambda) * Max_Similarity_to_Selected
-            mmr_score = (lambda_diversity * relevance_score) - ((1 - lambda_diversity) * max_sim_to_selected)
-            
-            # Chọn sản phẩm có điểm MMR cao nhất
-            if mmr_score > best_mmr_score:
-                best_mmr_score = mmr_score
-                best_item_for_this_iteration = (candidate_item_id, relevance_score)
-                index_to_remove = idx
-        
-        if best_item_for_this_iteration:
-            selected_recommendations.append(best_item_for_this_iteration)
-            selected_items_ids.add(best_item_for_this_iteration[0])
-            unselected_candidates.pop(index_to_remove)
-            logger.debug(f"MMR: Đã chọn sản phẩm {best_item_for_this_iteration[0]} (score: {best_item_for_this_iteration[1]:.4f}, MMR: {best_mmr_score:.4f})")
-        else:
-            logger.warning("MMR: Không tìm thấy sản phẩm ứng viên nào có điểm MMR dương hoặc không còn ứng viên. Dừng quá trình đa dạng hóa.")
-            break
+    # Ứng viên đầu tiên (relevance cao nhất) được chọn trước, sau đó mỗi bước là một argmax trên điểm MMR
+    # MMR = lambda * Relevance - (1 - lambda) * Max_Similarity_to_Selected
+    logger.info(f"MMR: Đã chọn sản phẩm đầu tiên: {candidate_ids[0]} với điểm {relevance[0]:.4f}")
+    selected_positions = mmr_select(relevance, similarity, lambda_diversity, max(1, top_n))
+    selected_recommendations = [candidate_items_with_scores[pos] for pos in selected_positions.tolist()]
 
     logger.info(f"MMR: Hoàn tất đa dạng hóa. Đã chọn {len(selected_recommendations)} sản phẩm.")
     return selected_recommendations[:top_n]
@@ -971,6 +2798,8 @@ else:
 # 2. Chia dữ liệu thành tập Train, Validation và Test dựa trên thời gian
 print("\n--- Bắt đầu chia tập dữ liệu thành Train, Validation, Test ---")
 df_train_raw, df_val_raw, df_test_raw = split_data_time_based(df_raw_events.copy(), train_ratio=0.6, val_ratio=0.2, test_ratio=0.2)
+if RUN_SPLIT_BENCHMARK:
+    benchmark_split_data_time_based(df_raw_events)
 
 print("\n--- Thống kê sau khi chia tập dữ liệu ---")
 print(f"Kích thước tập Train: {len(df_train_raw)} sự kiện")
@@ -1041,7 +2870,8 @@ plt.show()
 
 
 # Cell 4 Bayesian Optimization 
-from skopt import gp_minimize
+from skopt import gp_minimize, Optimizer
+from functools import partial
 from skopt.space import Real, Integer
 from skopt.utils import use_named_args
 from skopt.plots import plot_convergence, plot_evaluations, plot_objective
@@ -1054,6 +2884,7 @@ from sklearn.metrics.pairwise import cosine_similarity
 from collections import defaultdict
 import numpy as np
 import pandas as pd # Import pandas nếu chưa có (đảm bảo nó được import)
+from scipy.sparse import save_npz, load_npz
 import logging # Đảm bảo logging được import nếu bạn sử dụng logger
 
 # Cấu hình logger (Nếu chưa có ở các cell trước)
@@ -1079,7 +2910,7 @@ if 'df_product_features' not in locals() or df_product_features.empty:
     # Các hàm liên quan đến BERT cần được đảm bảo đã chạy ở Cell 1 hoặc Cell 2
 else:
     # Đảm bảo BERT model và embeddings đã được tải/khởi tạo
-    if 'GLOBAL_BERT_MODEL' not in globals() or GLOBAL_BERT_MODEL is None or 'GLOBAL_PRODUCT_EMBEDDINGS' not in globals() or GLOBAL_PRODUCT_EMBEDDINGS is None:
+    if 'GLOBAL_PRODUCT_EMBEDDINGS' not in globals() or GLOBAL_PRODUCT_EMBEDDINGS is None:
         logger.error("Mô hình BERT hoặc embeddings không được khởi tạo thành công. Content-based Filtering sẽ không hoạt động.")
         # content_similarities_global = {} # Không cần biến này nữa
 
@@ -1090,115 +2921,524 @@ else:
     logger.error("df_train_raw không tồn tại hoặc rỗng. Không thể tính item_interaction_counts_global.")
     item_interaction_counts_global = {} # Đặt rỗng để tránh lỗi
 
-# --- HÀM compute_sparse_similarity ĐÃ ĐƯỢC THÊM VÀO ĐÂY ---
-def compute_sparse_similarity(
-    df: pd.DataFrame,
-    top_k: int, # Tham số top_k sẽ được truyền từ objective
-    threshold: float # Tham số threshold (cosine_threshold) sẽ được truyền từ objective
-) -> Dict[int, List[Tuple[int, float]]]:
+
+# --- HÀM compute_sparse_similarity ĐÃ ĐƯỢC THÊM VÀO ĐÂY ---
+def compute_sparse_similarity_topk(
+    df: pd.DataFrame,
+    top_k: int,
+    threshold: float,
+    block_size: int = None,
+    query_items: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Tính toán độ tương đồng item-item cosine từ DataFrame với điểm phản hồi ngầm và
+    trả về top-k láng giềng của mỗi item dưới dạng mảng NumPy gọn nhẹ.
+    df có thể là sự kiện thô hoặc bảng đếm (có cột interaction_count, xem build_interaction_count_table).
+    block_size > 0 bật chế độ tính theo khối (mặc định lấy CF_SIMILARITY_BLOCK_SIZE),
+    block_size = 0 tính toàn bộ ma trận cosine một lần.
+    Nếu có query_items thì chỉ tính top-k cho các item đó (láng giềng vẫn lấy trong mọi item): mỗi hàng
+    giống hệt hàng tương ứng khi tính toàn bộ.
+
+    Returns:
+        Tuple gồm (item_ids [n_items], neighbor_ids [n_items, top_k] int32 (đệm -1),
+                   scores [n_items, top_k] float32 (đệm 0.0), counts [n_items] int32).
+    """
+    logger.info(f"Đang tính toán ma trận độ tương đồng item-item thưa thớt sử dụng điểm ngầm với top_k={top_k}, threshold={threshold:.4f}...")
+    empty_result = (
+        np.empty(0, dtype=np.int32),
+        np.empty((0, top_k), dtype=np.int32),
+        np.empty((0, top_k), dtype=np.float32),
+        np.empty(0, dtype=np.int32),
+    )
+
+    if 'implicit_score' not in df.columns:
+        raise ValueError("DataFrame phải chứa cột 'implicit_score'.")
+
+    df_filtered = df[df['implicit_score'] > 0]
+
+    logger.debug(f"DEBUG_SIM: Kích thước DataFrame đã lọc (implicit_score > 0): {len(df_filtered)} dòng")
+    if df_filtered.empty:
+        logger.warning("Không tìm thấy điểm ngầm dương nào để tính độ tương đồng. Trả về kết quả rỗng.")
+        return empty_result
+
+    # Mã hóa user/item thành chỉ số liên tục (giữ thứ tự xuất hiện như trước đây)
+    rows, active_users = pd.factorize(df_filtered['user_id'])
+    cols, active_items = pd.factorize(df_filtered['product_id'])
+    data = df_filtered['implicit_score'].to_numpy(dtype=float)
+    if 'interaction_count' in df_filtered.columns:
+        # Bảng đếm: mỗi dòng đại diện cho interaction_count sự kiện giống nhau (csr_matrix cộng dồn như khi dùng sự kiện thô)
+        data = data * df_filtered['interaction_count'].to_numpy(dtype=float)
+    logger.debug(f"DEBUG_SIM: Số lượng người dùng hoạt động duy nhất sau khi lọc: {len(active_users)}")
+    logger.debug(f"DEBUG_SIM: Số lượng item hoạt động duy nhất sau khi lọc: {len(active_items)}")
+
+    if len(active_users) == 0 or len(active_items) == 0:
+        logger.warning("Không đủ người dùng hoặc item duy nhất có điểm ngầm dương để tính toán độ tương đồng. Trả về kết quả rỗng.")
+        return empty_result
+
+    sparse_ui = csr_matrix((data, (rows, cols)), shape=(len(active_users), len(active_items)))
+    logger.debug(f"DEBUG_SIM: Hình dạng ma trận User-Item thưa thớt: {sparse_ui.shape}, số lượng phần tử khác không (nnz): {sparse_ui.nnz}")
+
+    # Chuyển đổi sang float32 để tránh lỗi bộ nhớ với ma trận lớn
+    sparse_ui_T = sparse_ui.T.astype(np.float32)
+
+    query_rows = None
+    if query_items is not None:
+        query_rows = np.unique(pd.Index(active_items).get_indexer(np.asarray(query_items)))
+        query_rows = query_rows[query_rows >= 0]
+        logger.debug(f"DEBUG_SIM: Chỉ tính top-k cho {len(query_rows)}/{len(active_items)} item được yêu cầu.")
+
+    if block_size is None:
+        block_size = CF_SIMILARITY_BLOCK_SIZE
+    if block_size and block_size > 0:
+        logger.debug(f"DEBUG_SIM: Tính cosine item-item theo khối {block_size} item.")
+        neighbor_idx, scores, counts = blocked_cosine_topk(sparse_ui_T, top_k, threshold, block_size, query_rows=query_rows)
+    elif query_rows is not None:
+        sim_matrix = drop_self_similarity(cosine_similarity(sparse_ui_T[query_rows], sparse_ui_T, dense_output=False), query_rows)
+        neighbor_idx, scores, counts = topk_from_csr(sim_matrix, top_k, threshold=threshold, drop_diagonal=False)
+        del sim_matrix
+    else:
+        sim_matrix = cosine_similarity(sparse_ui_T, dense_output=False)
+        logger.debug(f"DEBUG_SIM: Hình dạng ma trận độ tương đồng Item-Item thưa thớt: {sim_matrix.shape}, số lượng phần tử khác không (nnz): {sim_matrix.nnz}")
+        neighbor_idx, scores, counts = topk_from_csr(sim_matrix, top_k, threshold=threshold, drop_diagonal=True)
+        del sim_matrix
+
+    all_item_ids = np.asarray(active_items, dtype=np.int32)
+    item_ids = all_item_ids if query_rows is None else all_item_ids[query_rows]
+    neighbor_ids = np.where(neighbor_idx >= 0, all_item_ids[np.maximum(neighbor_idx, 0)], -1).astype(np.int32)
+
+    logger.info(f"DEBUG_SIM: Tổng số item (original_product_id) có ít nhất MỘT độ tương đồng HỢP LỆ (khác nó và >= ngưỡng): {int(np.count_nonzero(counts))}")
+    logger.info("Hoàn tất tính toán độ tương đồng thưa thớt.")
+    return item_ids, neighbor_ids, scores, counts
+
+
+def compute_sparse_similarity(
+    df: pd.DataFrame,
+    top_k: int, # Tham số top_k sẽ được truyền từ objective
+    threshold: float, # Tham số threshold (cosine_threshold) sẽ được truyền từ objective
+    query_items: Optional[np.ndarray] = None # Chỉ tính cho các item này (mặc định: mọi item)
+) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Tính toán độ tương đồng item-item cosine từ DataFrame với điểm phản hồi ngầm,
+    trả về một từ điển chứa top-k item tương đồng cho mỗi item.
+    Phần tính toán được thực hiện bởi compute_sparse_similarity_topk (dạng mảng).
+    """
+    return topk_arrays_to_dict(*compute_sparse_similarity_topk(df, top_k, threshold, query_items=query_items))
+
+
+# === CẬP NHẬT CF TĂNG DẦN (INCREMENTAL) ===
+# Trạng thái được lưu trong CF_STATE_DIR theo từng "thế hệ" (generation): các file dữ liệu mang số thế hệ
+# và cf_state_meta.json được ghi sau cùng, nên một lần chạy bị ngắt giữa chừng không làm hỏng trạng thái cũ.
+CF_STATE_META_FILE = 'cf_state_meta.json'
+
+
+def _cf_state_fingerprint(weights: Dict[str, float], frequency_decay_factor: float) -> str:
+    """
+    Dấu vân tay của các tham số quyết định giá trị user-item; đổi tham số thì ma trận Gram phải tính lại.
+    """
+    payload = json.dumps({'weights': {k: float(v) for k, v in sorted(weights.items())},
+                          'frequency_decay_factor': float(frequency_decay_factor)}, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _user_item_values(df_counts: pd.DataFrame, weights: Dict[str, float], frequency_decay_factor: float) -> pd.DataFrame:
+    """
+    Giá trị user-item dùng cho cosine, giống hệt compute_sparse_similarity trên dữ liệu sự kiện:
+    mỗi sự kiện đóng góp điểm ngầm của nhóm (user, product, event_type) của nó, và csr_matrix cộng dồn
+    các đóng góp trùng (user, product). Vì vậy giá trị = sum(interaction_count * implicit_score).
+    """
+    values = df_counts['interaction_count'].to_numpy(dtype=float) * implicit_scores_from_counts(
+        df_counts, weights, frequency_decay_factor).to_numpy()
+    df_values = df_counts[['user_id', 'product_id']].assign(value=values)
+    return df_values[df_values['value'] > 0]
+
+
+def _user_item_matrix(df_values: pd.DataFrame, user_index: pd.Index, item_index: pd.Index) -> csr_matrix:
     """
-    Tính toán độ tương đồng item-item cosine từ DataFrame với điểm phản hồi ngầm,
-    trả về một từ điển chứa top-k item tương đồng cho mỗi item.
+    Ma trận thưa (user x item) float64 theo thứ tự user_index / item_index cho trước.
     """
-    logger.info(f"Đang tính toán ma trận độ tương đồng item-item thưa thớt sử dụng điểm ngầm với top_k={top_k}, threshold={threshold:.4f}...")
+    rows = user_index.get_indexer(df_values['user_id'])
+    cols = item_index.get_indexer(df_values['product_id'])
+    return csr_matrix((df_values['value'].to_numpy(dtype=np.float64), (rows, cols)),
+                      shape=(len(user_index), len(item_index)))
+
+
+def _cosine_topk_rows_from_gram(
+    gram: csr_matrix,
+    rows: np.ndarray,
+    top_k: int,
+    threshold: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Top-k cosine cho các hàng item được chọn, đọc trực tiếp từ ma trận Gram G = X^T X:
+    cos(i, j) = G[i, j] / (||x_i|| * ||x_j||). Không cần nhân ma trận, chỉ cắt hàng và chia chuẩn.
+    """
+    norms = np.sqrt(np.maximum(gram.diagonal(), 0.0))
+    inv_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    sub = gram[rows].tocsr()
+    sub = csr_matrix(sub.multiply(inv_norms[rows][:, None]).multiply(inv_norms[None, :]))
+    # Bỏ đường chéo (cột == item của hàng) vì các hàng không liên tục
+    row_of_entry = np.repeat(rows, np.diff(sub.indptr))
+    sub.data[sub.indices == row_of_entry] = 0.0
+    sub.eliminate_zeros()
+    return topk_from_csr(sub.astype(np.float32), top_k, threshold=threshold, drop_diagonal=False)
+
+
+def load_cf_state(state_dir: str = CF_STATE_DIR) -> Dict:
+    """
+    Tải trạng thái CF tăng dần (nếu có). Trả về None nếu chưa có hoặc bị lỗi.
+    """
+    meta_path = os.path.join(state_dir, CF_STATE_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        generation = meta['generation']
+        counts_npz = np.load(os.path.join(state_dir, f"counts_{generation}.npz"), allow_pickle=False)
+        topk_npz = np.load(os.path.join(state_dir, f"topk_{generation}.npz"), allow_pickle=False)
+        event_types = counts_npz['event_types']
+        df_counts = pd.DataFrame({
+            'user_id': counts_npz['user_id'],
+            'product_id': counts_npz['product_id'],
+            'event_type': pd.Categorical.from_codes(counts_npz['event_code'], categories=event_types).astype(str),
+            'interaction_count': counts_npz['interaction_count'],
+        })
+        return {
+            'meta': meta,
+            'counts': df_counts,
+            'gram': load_npz(os.path.join(state_dir, f"gram_{generation}.npz")).tocsr(),
+            'item_ids': topk_npz['item_ids'],
+            'neighbor_idx': topk_npz['neighbor_idx'],
+            'scores': topk_npz['scores'],
+            'topk_counts': topk_npz['topk_counts'],
+        }
+    except Exception as e:
+        logger.error(f"Lỗi khi tải trạng thái CF tăng dần từ {state_dir}: {e}. Sẽ tính lại toàn bộ.")
+        return None
 
-    if 'implicit_score' not in df.columns:
-        raise ValueError("DataFrame phải chứa cột 'implicit_score'.")
 
-    df_filtered = df[df['implicit_score'] > 0].copy()
+def save_cf_state(state: Dict, state_dir: str = CF_STATE_DIR):
+    """
+    Lưu trạng thái CF thành một thế hệ mới rồi mới ghi đè cf_state_meta.json; xóa thế hệ cũ sau đó.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    meta = state['meta']
+    previous_generation = meta.get('generation')
+    generation = int(previous_generation or 0) + 1
+
+    df_counts = state['counts']
+    event_codes, event_types = pd.factorize(df_counts['event_type'])
+    np.savez(os.path.join(state_dir, f"counts_{generation}.npz"),
+             user_id=df_counts['user_id'].to_numpy(dtype=np.int64),
+             product_id=df_counts['product_id'].to_numpy(dtype=np.int64),
+             event_code=event_codes.astype(np.int16),
+             event_types=np.asarray(event_types, dtype=str),
+             interaction_count=df_counts['interaction_count'].to_numpy(dtype=np.int64))
+    save_npz(os.path.join(state_dir, f"gram_{generation}.npz"), state['gram'])
+    np.savez(os.path.join(state_dir, f"topk_{generation}.npz"),
+             item_ids=state['item_ids'], neighbor_idx=state['neighbor_idx'],
+             scores=state['scores'], topk_counts=state['topk_counts'])
+
+    meta = {**meta, 'generation': generation, 'saved_at': pd.Timestamp.now().isoformat()}
+    tmp_meta_path = os.path.join(state_dir, CF_STATE_META_FILE + '.tmp')
+    with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_meta_path, os.path.join(state_dir, CF_STATE_META_FILE))
+    state['meta'] = meta
+
+    if previous_generation is not None:
+        for prefix in ('counts', 'gram', 'topk'):
+            old_path = os.path.join(state_dir, f"{prefix}_{previous_generation}.npz")
+            if os.path.exists(old_path):
+                os.remove(old_path)
+    logger.info(f"Đã lưu trạng thái CF tăng dần (thế hệ {generation}, watermark id {meta['watermark_id']}) vào {state_dir}.")
+
+
+def build_cf_state(
+    weights: Dict[str, float],
+    top_k: int,
+    threshold: float,
+    frequency_decay_factor: float = 0.1
+) -> Dict:
+    """
+    Khởi tạo trạng thái CF từ toàn bộ user_events: bảng đếm, ma trận Gram item-item G = X^T X
+    (float64 để cộng/trừ tăng dần không bị trôi số) và top-k của mọi item.
+    """
+    df_counts, watermark_id = load_user_event_counts()
+    df_values = _user_item_values(df_counts, weights, frequency_decay_factor)
+    user_index = pd.Index(df_values['user_id'].unique())
+    item_ids = np.asarray(df_values['product_id'].unique(), dtype=np.int64)
+    user_item = _user_item_matrix(df_values, user_index, pd.Index(item_ids))
+    gram = (user_item.T @ user_item).tocsr()
+    neighbor_idx, scores, topk_counts = _cosine_topk_rows_from_gram(gram, np.arange(len(item_ids)), top_k, threshold)
+    logger.info(f"Đã khởi tạo trạng thái CF: {len(user_index)} người dùng, {len(item_ids)} item, nnz(G)={gram.nnz}.")
+    return {
+        'meta': {
+            'watermark_id': watermark_id,
+            'fingerprint': _cf_state_fingerprint(weights, frequency_decay_factor),
+            'top_k': int(top_k),
+            'threshold': float(threshold),
+        },
+        'counts': df_counts,
+        'gram': gram,
+        'item_ids': item_ids,
+        'neighbor_idx': neighbor_idx,
+        'scores': scores,
+        'topk_counts': topk_counts,
+    }
 
-    logger.debug(f"DEBUG_SIM: Kích thước DataFrame đã lọc (implicit_score > 0): {len(df_filtered)} dòng")
-    if df_filtered.empty:
-        logger.warning("Không tìm thấy điểm ngầm dương nào để tính độ tương đồng. Trả về từ điển rỗng.")
-        return {}
 
-    active_users = df_filtered['user_id'].unique()
-    active_items = df_filtered['product_id'].unique()
-    logger.debug(f"DEBUG_SIM: Số lượng người dùng hoạt động duy nhất sau khi lọc: {len(active_users)}")
-    logger.debug(f"DEBUG_SIM: Số lượng item hoạt động duy nhất sau khi lọc: {len(active_items)}")
+def apply_new_events_to_cf_state(
+    state: Dict,
+    df_new_events: pd.DataFrame,
+    weights: Dict[str, float],
+    top_k: int,
+    threshold: float,
+    frequency_decay_factor: float = 0.1
+) -> Dict:
+    """
+    Áp dụng các sự kiện mới vào trạng thái CF:
+    - Cộng số đếm mới vào bảng đếm; chỉ những người dùng có sự kiện mới bị ảnh hưởng.
+    - Với các người dùng đó: G += X_new^T X_new - X_old^T X_old (tính trên vài hàng, không phải toàn bộ).
+    - Chỉ làm mới top-k cho các item bị chạm và các item đồng xuất hiện với chúng trong G
+      (chuẩn của item bị chạm thay đổi nên cosine của các láng giềng cũng đổi).
+    top_k/threshold khác lần trước thì làm mới top-k của mọi item (vẫn không cần tính lại G).
+    """
+    if df_new_events.empty and state['meta']['top_k'] == top_k and state['meta']['threshold'] == threshold:
+        logger.info("Không có sự kiện mới. Giữ nguyên trạng thái CF.")
+        return state
+
+    df_counts = state['counts']
+    gram = state['gram']
+    item_ids = state['item_ids']
+    changed_items = np.empty(0, dtype=np.int64)
+
+    if not df_new_events.empty:
+        df_new_counts = df_new_events.groupby(['user_id', 'product_id', 'event_type'], observed=True).size().reset_index(name='interaction_count')
+        touched_users = pd.Index(df_new_counts['user_id'].unique())
+        touched_mask = df_counts['user_id'].isin(touched_users).to_numpy()
+        df_old_touched = df_counts[touched_mask]
+        df_new_touched = (pd.concat([df_old_touched, df_new_counts], ignore_index=True)
+                          .groupby(['user_id', 'product_id', 'event_type'], as_index=False, observed=True)['interaction_count'].sum())
+
+        # Item mới xuất hiện được nối vào cuối chỉ mục item
+        new_values = _user_item_values(df_new_touched, weights, frequency_decay_factor)
+        unseen_items = np.setdiff1d(new_values['product_id'].unique(), item_ids)
+        if unseen_items.size:
+            item_ids = np.concatenate([item_ids, unseen_items.astype(np.int64)])
+            gram = gram.tocsr(copy=True)
+            gram.resize((len(item_ids), len(item_ids)))
+            pad_rows = unseen_items.size
+            state['neighbor_idx'] = np.vstack([state['neighbor_idx'], np.full((pad_rows, state['neighbor_idx'].shape[1]), -1, dtype=np.int32)])
+            state['scores'] = np.vstack([state['scores'], np.zeros((pad_rows, state['scores'].shape[1]), dtype=np.float32)])
+            state['topk_counts'] = np.concatenate([state['topk_counts'], np.zeros(pad_rows, dtype=np.int32)])
+        item_index = pd.Index(item_ids)
+
+        x_old = _user_item_matrix(_user_item_values(df_old_touched, weights, frequency_decay_factor), touched_users, item_index)
+        x_new = _user_item_matrix(new_values, touched_users, item_index)
+        gram_old_part = (x_old.T @ x_old).tocsr()
+        gram = (gram + (x_new.T @ x_new) - gram_old_part).tocsr()
+        gram.data[np.abs(gram.data) < 1e-9] = 0.0 # Loại bỏ phần dư do trừ số thực
+        gram.eliminate_zeros()
+
+        changed_items = np.unique((x_new - x_old).tocsc().nonzero()[1])
+        df_counts = pd.concat([df_counts[~touched_mask], df_new_touched], ignore_index=True)
+        logger.info(f"CF tăng dần: {len(df_new_events)} sự kiện mới từ {len(touched_users)} người dùng, {changed_items.size} item bị chạm, {unseen_items.size} item mới.")
+
+    if state['meta']['top_k'] != top_k or state['meta']['threshold'] != threshold:
+        logger.info(f"top_k/threshold thay đổi ({state['meta']['top_k']}/{state['meta']['threshold']} -> {top_k}/{threshold}). Làm mới top-k cho mọi item.")
+        rows_to_refresh = np.arange(len(item_ids))
+        state['neighbor_idx'] = np.full((len(item_ids), top_k), -1, dtype=np.int32)
+        state['scores'] = np.zeros((len(item_ids), top_k), dtype=np.float32)
+        state['topk_counts'] = np.zeros(len(item_ids), dtype=np.int32)
+    else:
+        # Láng giềng trong G mới và trong phần bị trừ đi (cặp có thể đã về 0)
+        neighbours = np.concatenate([gram[changed_items].indices, gram_old_part[changed_items].indices]) if changed_items.size else changed_items
+        rows_to_refresh = np.union1d(changed_items, neighbours)
+
+    if rows_to_refresh.size:
+        neighbor_idx, scores, topk_counts = _cosine_topk_rows_from_gram(gram, rows_to_refresh, top_k, threshold)
+        state['neighbor_idx'][rows_to_refresh] = neighbor_idx
+        state['scores'][rows_to_refresh] = scores
+        state['topk_counts'][rows_to_refresh] = topk_counts
+    logger.info(f"CF tăng dần: đã làm mới top-k cho {rows_to_refresh.size}/{len(item_ids)} item.")
+
+    state['meta']['top_k'] = int(top_k)
+    state['meta']['threshold'] = float(threshold)
+    state.update({'counts': df_counts, 'gram': gram, 'item_ids': item_ids})
+    return state
+
+
+def update_cf_state_incremental(
+    weights: Dict[str, float],
+    top_k: int,
+    threshold: float,
+    frequency_decay_factor: float = 0.1,
+    state_dir: str = CF_STATE_DIR
+) -> Dict:
+    """
+    Cập nhật trạng thái CF theo chế độ tăng dần: tải trạng thái đã lưu, áp dụng các sự kiện có
+    watermark_id < id <= MAX(id) hiện tại và chỉ lưu lại khi trạng thái thực sự thay đổi.
+    Chưa có trạng thái (hoặc trạng thái cũ chưa có watermark_id) hay trọng số/frequency_decay_factor
+    thay đổi thì khởi tạo lại từ đầu.
+    """
+    fingerprint = _cf_state_fingerprint(weights, frequency_decay_factor)
+    state = load_cf_state(state_dir)
+    if state is not None and state['meta'].get('fingerprint') != fingerprint:
+        logger.info("Trọng số sự kiện đã thay đổi so với trạng thái CF đã lưu. Khởi tạo lại trạng thái.")
+        state = None
+
+    if state is None or state['meta'].get('watermark_id') is None:
+        state = build_cf_state(weights, top_k, threshold, frequency_decay_factor)
+        state_changed = state['meta']['watermark_id'] is not None
+    else:
+        until_id = max_user_event_id()
+        df_new_events = load_user_events_since(state['meta']['watermark_id'], until_id)
+        state_changed = (not df_new_events.empty or state['meta']['top_k'] != top_k
+                         or state['meta']['threshold'] != threshold)
+        state = apply_new_events_to_cf_state(state, df_new_events, weights, top_k, threshold, frequency_decay_factor)
+        if not df_new_events.empty:
+            state['meta']['watermark_id'] = until_id
+    if state_changed:
+        save_cf_state(state, state_dir)
+    else:
+        logger.info("Trạng thái CF không thay đổi. Bỏ qua bước lưu.")
+    return state
 
-    user_to_idx = {u: i for i, u in enumerate(active_users)}
-    item_to_idx = {p: i for i, p in enumerate(active_items)}
-    idx_to_item = {i: p for p, i in item_to_idx.items()}
 
-    rows = df_filtered['user_id'].map(user_to_idx)
-    cols = df_filtered['product_id'].map(item_to_idx)
-    data = df_filtered['implicit_score'].astype(float).to_numpy()
+def cf_similarities_from_state(state: Dict) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Độ tương đồng CF (cùng định dạng với compute_sparse_similarity) đọc từ trạng thái CF.
+    Chỉ trả về các item có tương tác dương (giống compute_sparse_similarity).
+    """
+    item_ids = state['item_ids']
+    active = state['gram'].diagonal() > 0
+    neighbor_ids = np.where(state['neighbor_idx'] >= 0, item_ids[np.maximum(state['neighbor_idx'], 0)], -1)
+    return topk_arrays_to_dict(item_ids[active], neighbor_ids[active], state['scores'][active], state['topk_counts'][active])
+
+
+def update_cf_similarity_incremental(
+    weights: Dict[str, float],
+    top_k: int,
+    threshold: float,
+    frequency_decay_factor: float = 0.1,
+    state_dir: str = CF_STATE_DIR
+) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Độ tương đồng CF tính theo chế độ tăng dần (xem update_cf_state_incremental).
+    """
+    state = update_cf_state_incremental(weights, top_k, threshold, frequency_decay_factor, state_dir)
+    return cf_similarities_from_state(state)
 
-    logger.debug(f"DEBUG_SIM: Kích thước của rows: {len(rows)}, cols: {len(cols)}, data: {len(data)}")
 
-    if len(active_users) == 0 or len(active_items) == 0:
-        logger.warning("Không đủ người dùng hoặc item duy nhất có điểm ngầm dương để tính toán độ tương đồng. Trả về từ điển rỗng.")
-        return {}
+# === DỮ LIỆU DÙNG CHUNG CHO CÁC LẦN THỬ CỦA BAYESIAN OPTIMIZATION ===
+# Giá trị lớn nhất của num_similar_items trong không gian tìm kiếm
+BO_MAX_NUM_SIMILAR_ITEMS = 100
 
-    sparse_ui = csr_matrix((data, (rows, cols)), shape=(len(active_users), len(active_items)))
-    logger.debug(f"DEBUG_SIM: Hình dạng ma trận User-Item thưa thớt: {sparse_ui.shape}, số lượng phần tử khác không (nnz): {sparse_ui.nnz}")
 
-    # Chuyển đổi sang float32 để tránh lỗi bộ nhớ với ma trận lớn
-    sparse_ui_T = sparse_ui.T.astype(np.float32)
-    sim_matrix = cosine_similarity(sparse_ui_T, dense_output=False)
-    logger.debug(f"DEBUG_SIM: Hình dạng ma trận độ tương đồng Item-Item thưa thớt: {sim_matrix.shape}, số lượng phần tử khác không (nnz): {sim_matrix.nnz}")
-
-    item_similarities: Dict[int, List[Tuple[int, float]]] = {}
-    count_items_with_any_similarity_after_threshold = 0
-
-    for i, item_idx_i in enumerate(active_items):
-        original_product_id = item_idx_i
-        row = sim_matrix.getrow(i)
-
-        if row.nnz:
-            idxs = row.indices
-            vals = row.data
-
-            filtered_similarities = [
-                (j_idx, s) for j_idx, s in zip(idxs, vals)
-                if j_idx != i and s >= threshold
-            ]
-
-            if filtered_similarities:
-                count_items_with_any_similarity_after_threshold += 1
-                # Sử dụng top_k được truyền vào
-                topk_pairs = sorted(filtered_similarities, key=lambda x: x[1], reverse=True)[:top_k]
-                item_similarities[original_product_id] = [(idx_to_item[j_idx], float(s)) for j_idx, s in topk_pairs]
-            else:
-                item_similarities[original_product_id] = []
-        else:
-            item_similarities[original_product_id] = []
+class TrialContext:
+    """
+    Các kết quả không phụ thuộc tham số đang tối ưu, được tính một lần và dùng chung cho mọi lần gọi objective:
+    - train_counts: bảng đếm (user, product, event_type) của tập Train (build_interaction_count_table).
+    - user_train_purchases_map / user_eval_actual_interactions / users_to_evaluate.
+    - item_index: chỉ mục item (Train, tập đánh giá, content) dùng chung cho evaluate_hybrid_recommendations.
+    - content_topk: top-k nội dung ở k lớn nhất; mỗi lần thử chỉ cắt lấy num_similar_items cột đầu.
+    - stratified_users(fraction): mẫu người dùng phân tầng cho đánh giá đa độ trung thực.
+    """
 
-    logger.info(f"DEBUG_SIM: Tổng số item (original_product_id) có ít nhất MỘT độ tương đồng HỢP LỆ (khác nó và >= ngưỡng): {count_items_with_any_similarity_after_threshold}")
-    logger.info("Hoàn tất tính toán độ tương đồng thưa thớt.")
-    return item_similarities
+    def __init__(self, df_train_raw: pd.DataFrame, df_eval_raw: pd.DataFrame,
+                 max_num_similar_items: int = BO_MAX_NUM_SIMILAR_ITEMS, with_content: bool = True,
+                 fidelity_seed: int = BO_FIDELITY_SEED):
+        self.train_counts = build_interaction_count_table(df_train_raw)
+
+        self.user_train_purchases_map = df_train_raw[df_train_raw['event_type'] == 'purchase'] \
+                                            .groupby('user_id')['product_id'].apply(set).to_dict()
+        self.user_eval_actual_interactions = df_eval_raw.groupby('user_id')['product_id'].apply(set).to_dict()
+        self.users_to_evaluate = [u for u in self.user_eval_actual_interactions.keys() if u in self.user_train_purchases_map]
+
+        self.max_num_similar_items = int(max_num_similar_items)
+        self.content_topk = compute_content_similarity_topk(self.max_num_similar_items) if with_content else None
+
+        item_ids = [self.train_counts['product_id'].to_numpy(), df_eval_raw['product_id'].to_numpy()]
+        if self.content_topk is not None:
+            item_ids.append(self.content_topk[0])
+        self.item_index = pd.Index(np.unique(np.concatenate(item_ids).astype(np.int64)))
+
+        # Tầng theo mức hoạt động (log2 số item tương tác trong tập đánh giá) và khóa ngẫu nhiên cố định cho
+        # mỗi người dùng: mẫu ở tỉ lệ nhỏ luôn là tập con của mẫu ở tỉ lệ lớn hơn
+        eval_sizes = np.array([len(self.user_eval_actual_interactions[u]) for u in self.users_to_evaluate], dtype=float)
+        self._user_strata = pd.DataFrame({
+            'stratum': np.floor(np.log2(np.maximum(eval_sizes, 1.0))).astype(int),
+            'sampling_key': np.random.default_rng(fidelity_seed).random(len(self.users_to_evaluate)),
+        })
+        logger.info(f"TrialContext: {len(self.train_counts)} dòng bảng đếm, {len(self.users_to_evaluate)} người dùng đánh giá, {len(self.item_index)} item, content top-k tối đa {self.max_num_similar_items}.")
+
+    def stratified_users(self, fraction: float) -> List[int]:
+        """
+        Lấy khoảng fraction người dùng đánh giá, giữ tỉ lệ từng tầng hoạt động (ít nhất 1 người mỗi tầng).
+        Thứ tự giữ nguyên như users_to_evaluate.
+        """
+        if fraction >= 1.0 or not self.users_to_evaluate:
+            return self.users_to_evaluate
+        strata = self._user_strata.groupby('stratum')['sampling_key']
+        rank_in_stratum = strata.rank(method='first').to_numpy()
+        stratum_size = strata.transform('size').to_numpy()
+        keep = rank_in_stratum <= np.maximum(np.ceil(stratum_size * fraction), 1)
+        return [u for u, k in zip(self.users_to_evaluate, keep) if k]
+
+    def content_similarities(self, top_k: int, query_items: Optional[np.ndarray] = None) -> Dict[int, List[Tuple[int, float]]]:
+        """
+        Top-k nội dung cho một lần thử, cắt từ kết quả đã tính ở k lớn nhất.
+        Nếu có query_items thì chỉ lấy các hàng của những sản phẩm đó.
+        """
+        if self.content_topk is None:
+            return {}
+        if top_k > self.max_num_similar_items:
+            logger.warning(f"top_k={top_k} lớn hơn k đã tính sẵn ({self.max_num_similar_items}). Tính lại content similarity.")
+            product_ids, neighbor_ids, scores, counts = compute_content_similarity_topk(top_k)
+        else:
+            product_ids, neighbor_ids, scores, counts = self.content_topk
+            neighbor_ids, scores, counts = neighbor_ids[:, :top_k], scores[:, :top_k], np.minimum(counts, top_k)
+        if query_items is not None:
+            rows = np.flatnonzero(np.isin(product_ids, np.asarray(query_items)))
+            product_ids, neighbor_ids, scores, counts = product_ids[rows], neighbor_ids[rows], scores[rows], counts[rows]
+        return topk_arrays_to_dict(product_ids, neighbor_ids, scores, counts)
 
 
 # --- ĐỊNH NGHĨA LẠI HÀM ĐÁNH GIÁ ĐỂ NHẬN THAM SỐ TỐI ƯU HÓA ---
-def evaluate_weights_for_similarity(
+def build_trial_hybrid_similarities(
     df_train_raw: pd.DataFrame,
-    df_eval_raw: pd.DataFrame,
     current_weights: Dict[str, float],
     hybrid_alpha: float,
     cold_start_threshold: int,
     item_interaction_counts: Dict[int, int],
     frequency_decay_factor: float,
     final_hybrid_threshold: float,
-    # --- THAM SỐ MỚI ĐƯỢC THÊM VÀO ĐÂY ---
-    cosine_threshold: float, # Thêm tham số ngưỡng cosine
-    num_similar_items: int, # Thêm tham số top_k cho content/CF
-    top_n_recommendations: int, # Thêm tham số top_n_recommendations
-    min_alpha_cold_start: float # <--- THAM SỐ MỚI ĐƯỢC THÊM VÀO
-) -> Dict[str, float]:
+    cosine_threshold: float,
+    num_similar_items: int,
+    min_alpha_cold_start: float,
+    df_train_counts: pd.DataFrame = None, # Bảng đếm của df_train_raw (build_interaction_count_table) nếu đã tạo sẵn
+    trial_context: TrialContext = None, # Dữ liệu dùng chung giữa các lần thử (bảng đếm, content top-k, map người dùng)
+    query_items: Optional[np.ndarray] = None # Chỉ tính các hàng của những sản phẩm này (mặc định: mọi sản phẩm)
+) -> SimilarityTable:
     """
-    Đánh giá chất lượng gợi ý (NDCG, Precision, Recall, MAP)
-    cho một tập hợp trọng số phản hồi ngầm và trọng số lai (alpha) đã cho,
-    sử dụng cả Collaborative Filtering và Content-based Filtering.
+    Tính độ tương đồng lai (CF + Content-based, đã lọc final_hybrid_threshold) cho một bộ tham số.
+    Đây là phần tốn kém của mỗi lần đánh giá. Mỗi hàng chỉ phụ thuộc vào CF/content của chính sản phẩm đó,
+    nên với query_items chỉ các hàng cần cho việc chấm điểm (sản phẩm người dùng đã mua) được tính, và mỗi
+    hàng giống hệt khi tính toàn bộ.
+    Nếu có df_train_counts, điểm ngầm được tính trên bảng đếm thay vì trên từng sự kiện thô.
+    Trả về SimilarityTable (rỗng nếu không thể tạo độ tương đồng lai).
     """
     logger.debug(f"Đánh giá với trọng số: {current_weights}, alpha lai: {hybrid_alpha}, cold_start_threshold: {cold_start_threshold}")
-    logger.debug(f" cosine_threshold={cosine_threshold}, num_similar_items={num_similar_items}, top_n_recommendations={top_n_recommendations}")
+    logger.debug(f" cosine_threshold={cosine_threshold}, num_similar_items={num_similar_items}")
 
 
-    df_train_weighted = assign_implicit_feedback_scores(
-        df_train_raw.copy(),
-        current_weights,
-        frequency_decay_factor=frequency_decay_factor,
+    if trial_context is not None:
+        df_train_counts = trial_context.train_counts
+    elif df_train_counts is None:
+        df_train_counts = build_interaction_count_table(df_train_raw)
+    df_train_weighted = df_train_counts.assign(
+        implicit_score=implicit_scores_from_counts(df_train_counts, current_weights, frequency_decay_factor)
     )
 
     df_positive_scores = df_train_weighted[df_train_weighted['implicit_score'] > 0]
@@ -1208,13 +3448,13 @@ def evaluate_weights_for_similarity(
 
     if df_train_weighted.empty or df_train_weighted['implicit_score'].sum() == 0:
         logger.warning("Không có dữ liệu huấn luyện có trọng số ý nghĩa cho CF. Trả về các số liệu bằng không.")
-        return {'precision_at_n': 0.0, 'recall_at_n': 0.0, 'ndcg_at_n': 0.0, 'map': 0.0}
+        return SimilarityTable.empty()
     logger.info(f"DF_TRAIN_WEIGHTED cho CF: {len(df_train_weighted)} dòng, min_score={df_train_weighted['implicit_score'].min():.2f}, max_score={df_train_weighted['implicit_score'].max():.2f}")
 
     # --- 1. Tính toán độ tương đồng Collaborative Filtering (CF) ---
     # Sử dụng num_similar_items và cosine_threshold từ tham số
     collab_similarities = compute_sparse_similarity(
-        df_train_weighted, top_k=num_similar_items, threshold=cosine_threshold
+        df_train_weighted, top_k=num_similar_items, threshold=cosine_threshold, query_items=query_items
     )
     logger.info(f"Số lượng item có độ tương đồng CF: {len(collab_similarities)}")
 
@@ -1233,20 +3473,25 @@ def evaluate_weights_for_similarity(
     else:
         logger.info(f"DEBUG_EVAL: df_product_features có {len(df_product_features)} dòng và {df_product_features['features_text'].count()} features_text không rỗng.")
 
-    # Kiểm tra sự tồn tại của biến toàn cục GLOBAL_BERT_MODEL và GLOBAL_PRODUCT_EMBEDDINGS
-    if 'GLOBAL_BERT_MODEL' not in globals() or GLOBAL_BERT_MODEL is None or 'GLOBAL_PRODUCT_EMBEDDINGS' not in globals() or GLOBAL_PRODUCT_EMBEDDINGS is None:
-        logger.error("DEBUG_EVAL: GLOBAL_BERT_MODEL HOẶC GLOBAL_PRODUCT_EMBEDDINGS KHÔNG ĐƯỢC KHỞI TẠO. Content-based sẽ bị ảnh hưởng.")
+    # Kiểm tra sự tồn tại của biến toàn cục GLOBAL_PRODUCT_EMBEDDINGS (có thể được tải từ embedding cache mà không cần model)
+    if 'GLOBAL_PRODUCT_EMBEDDINGS' not in globals() or GLOBAL_PRODUCT_EMBEDDINGS is None:
+        logger.error("DEBUG_EVAL: GLOBAL_PRODUCT_EMBEDDINGS KHÔNG ĐƯỢC KHỞI TẠO. Content-based sẽ bị ảnh hưởng.")
     else:
         logger.info(f"DEBUG_EVAL: GLOBAL_PRODUCT_EMBEDDINGS có kích thước: {GLOBAL_PRODUCT_EMBEDDINGS.shape}.")
-        if GLOBAL_PRODUCT_EMBEDDINGS.shape[0] > 0 and np.all(GLOBAL_PRODUCT_EMBEDDINGS[0].numpy() == 0): # Giả sử embeddings là tensor
+        if GLOBAL_PRODUCT_EMBEDDINGS.shape[0] > 0 and np.all(GLOBAL_PRODUCT_EMBEDDINGS[0] == 0): # embeddings là mảng numpy (memmap)
             logger.error("DEBUG_EVAL: Embedding đầu tiên của sản phẩm là toàn số 0! Khả năng cao Content Score sẽ là 0.")
         elif GLOBAL_PRODUCT_EMBEDDINGS.shape[0] > 0:
-            # Chuyển đổi tensor sang numpy để in ra
-            logger.info(f"DEBUG_EVAL: 5 giá trị đầu của embedding sản phẩm đầu tiên: {GLOBAL_PRODUCT_EMBEDDINGS[0, :5].numpy().tolist()}")
+            logger.info(f"DEBUG_EVAL: 5 giá trị đầu của embedding sản phẩm đầu tiên: {GLOBAL_PRODUCT_EMBEDDINGS[0, :5].tolist()}")
 
-    if 'df_product_features' in globals() and not df_product_features.empty and \
+    if trial_context is not None and trial_context.content_topk is not None:
+        content_sims = trial_context.content_similarities(num_similar_items, query_items)
+        logger.info(f"Đã cắt content top-{num_similar_items} từ kết quả tính sẵn cho {len(content_sims)} sản phẩm.")
+    elif 'df_product_features' in globals() and not df_product_features.empty and \
        'GLOBAL_PRODUCT_EMBEDDINGS' in globals() and GLOBAL_PRODUCT_EMBEDDINGS is not None:
         content_sims = compute_content_similarity(df_product_features, top_k=num_similar_items)
+        if query_items is not None:
+            query_set = set(np.asarray(query_items).tolist())
+            content_sims = {pid: sims for pid, sims in content_sims.items() if pid in query_set}
         logger.info(f"Hoàn tất tính toán độ tương đồng Content-based cho {len(content_sims)} sản phẩm.")
     else:
         logger.warning("Không có dữ liệu thuộc tính sản phẩm hoặc embeddings. Content-based Filtering không khả dụng.")
@@ -1276,7 +3521,7 @@ def evaluate_weights_for_similarity(
     # --- 2. Kết hợp độ tương đồng CF và Content-based ---
     if not collab_similarities and not content_sims:
         logger.warning("Không có độ tương đồng CF hoặc Content-based. Không thể tạo gợi ý lai. Trả về các số liệu bằng không.")
-        return {'precision_at_n': 0.0, 'recall_at_n': 0.0, 'ndcg_at_n': 0.0, 'map': 0.0}
+        return SimilarityTable.empty()
 
     # Đảm bảo hàm combine_similarities có thể xử lý khi một trong hai dict rỗng
     # Hàm combine_similarities sẽ tự động bỏ qua các trường hợp không có dữ liệu
@@ -1294,74 +3539,237 @@ def evaluate_weights_for_similarity(
 
     # <--- THÊM LOGIC LỌC FINAL_HYBRID_THRESHOLD TẠI ĐÂY ---
     if final_hybrid_threshold > 0: # Chỉ lọc nếu ngưỡng > 0
-        filtered_hybrid_similarities = {}
-        for p1, neighbours in hybrid_similarities.items():
-            filtered_neighbours_for_p1 = []
-            for p2, hybrid_score, cf_score, content_score in neighbours:
-                if hybrid_score >= final_hybrid_threshold:
-                    filtered_neighbours_for_p1.append((p2, hybrid_score, cf_score, content_score))
-            if filtered_neighbours_for_p1:
-                filtered_hybrid_similarities[p1] = filtered_neighbours_for_p1
-            else: # Đảm bảo item vẫn có entry dù rỗng nếu không tìm được láng giềng
-                filtered_hybrid_similarities[p1] = []
-        hybrid_similarities = filtered_hybrid_similarities
+        hybrid_similarities = hybrid_similarities.threshold(final_hybrid_threshold)
         logger.info(f"Số lượng item có độ tương đồng lai (sau khi lọc final_hybrid_threshold): {len(hybrid_similarities)}")
     # --- KẾT THÚC LOGIC LỌC ---
     
     if not hybrid_similarities:
         logger.warning("Ma trận độ tương đồng lai rỗng. Trả về các số liệu bằng không.")
-        return {'precision_at_n': 0.0, 'recall_at_n': 0.0, 'ndcg_at_n': 0.0, 'map': 0.0}
+        return SimilarityTable.empty()
 
-    # --- 3. Đánh giá hệ thống gợi ý lai ---
-    user_train_purchases_map = df_train_raw[df_train_raw['event_type'] == 'purchase'] \
-                                   .groupby('user_id')['product_id'].apply(set).to_dict()
+    return hybrid_similarities
 
-    user_eval_actual_interactions = df_eval_raw.groupby('user_id')['product_id'].apply(set).to_dict()
 
-    users_to_evaluate = [u for u in user_eval_actual_interactions.keys() if u in user_train_purchases_map]
+def score_users_sparse(
+    user_items: csr_matrix,
+    item_similarity: csr_matrix,
+    top_n: int,
+    user_block_size: int = 4096
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Chấm điểm ứng viên cho mọi người dùng bằng phép nhân ma trận thưa: điểm[u, q] = sum_p U[u, p] * H[p, q]
+    (U nhị phân: item đã mua) qua sparse_candidate_scores, bỏ các item người dùng đã mua (drop_sparse_entries)
+    rồi lấy top_n mỗi hàng bằng topk_from_csr. Tính theo khối user_block_size người dùng để giới hạn bộ nhớ.
+    Ứng viên có tổng điểm bằng 0 vẫn được giữ (giống vòng lặp dict trước đây).
 
-    precisions, recalls, ndcgs, maps = [], [], [], []
+    Returns:
+        Tuple (recommended [n_users, top_n] chỉ số cột item, đệm -1; counts [n_users]).
+    """
+    user_items = csr_matrix(user_items, dtype=np.float64)
+    user_items.data[:] = 1.0
+    item_similarity = csr_matrix(item_similarity, dtype=np.float64)
+
+    n_users = user_items.shape[0]
+    recommended = np.full((n_users, top_n), -1, dtype=np.int32)
+    counts = np.zeros(n_users, dtype=np.int32)
+    for start in range(0, n_users, max(1, int(user_block_size))):
+        stop = min(start + max(1, int(user_block_size)), n_users)
+        block_users = user_items[start:stop]
+        candidate_scores = drop_sparse_entries(sparse_candidate_scores(block_users, item_similarity), block_users)
+        recommended[start:stop], _, counts[start:stop] = topk_from_csr(candidate_scores, top_n, drop_diagonal=False)
+    return recommended, counts
+
+
+def evaluate_hybrid_recommendations(
+    hybrid_similarities: SimilarityTable,
+    user_train_purchases_map: Dict[int, set],
+    user_eval_actual_interactions: Dict[int, set],
+    users_to_evaluate: List[int],
+    top_n_recommendations: int,
+    cutoffs: List[int] = EVAL_METRIC_CUTOFFS,
+    item_index: Optional[pd.Index] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Tạo gợi ý từ độ tương đồng lai cho mọi người dùng cùng lúc và trả về chỉ số của từng người dùng
+    (chưa lấy trung bình), để có thể gộp kết quả của nhiều tập người dùng con.
+
+    Điểm ứng viên = ma trận người dùng x item đã mua nhân ma trận độ tương đồng lai (score_users_sparse),
+    các chỉ số được tính một lượt bằng compute_ranking_metrics. Khóa 'precision_at_n', 'recall_at_n',
+    'ndcg_at_n', 'map' ứng với top_n_recommendations; các khóa dạng 'ndcg@10' ứng với từng mốc trong cutoffs.
+    Người dùng không có gợi ý nào bị bỏ qua (như trước đây).
+    item_index (ví dụ TrialContext.item_index) được dùng lại nếu chứa mọi item cần thiết, thay vì tạo lại ở mỗi lần gọi.
+    """
+    cutoffs = sorted(set(int(n) for n in cutoffs) | {int(top_n_recommendations)})
+    max_n = max(cutoffs)
     logger.info(f"Số lượng người dùng đủ điều kiện để đánh giá: {len(users_to_evaluate)}")
 
-    for user_id in users_to_evaluate:
-        train_purchased_items = user_train_purchases_map.get(user_id, set())
-        actual_items = user_eval_actual_interactions.get(user_id, set())
+    metric_names = ['precision_at_n', 'recall_at_n', 'ndcg_at_n', 'map']
+    empty = {name: np.empty(0) for name in metric_names}
+    empty.update({f"{name.replace('_at_n', '')}@{n}": np.empty(0) for n in cutoffs for name in metric_names})
+
+    users = [u for u in users_to_evaluate if user_train_purchases_map.get(u) and user_eval_actual_interactions.get(u)]
+    if not users or not hybrid_similarities:
+        return empty
+
+    purchased_lists = [list(user_train_purchases_map[u]) for u in users]
+    actual_lists = [list(user_eval_actual_interactions[u]) for u in users]
+    purchased_lengths = np.fromiter((len(x) for x in purchased_lists), dtype=np.int64, count=len(users))
+    actual_lengths = np.fromiter((len(x) for x in actual_lists), dtype=np.int64, count=len(users))
+    purchased_flat = np.fromiter((i for x in purchased_lists for i in x), dtype=np.int64, count=int(purchased_lengths.sum()))
+    actual_flat = np.fromiter((i for x in actual_lists for i in x), dtype=np.int64, count=int(actual_lengths.sum()))
+    if item_index is not None:
+        purchased_cols, actual_cols = item_index.get_indexer(purchased_flat), item_index.get_indexer(actual_flat)
+        if (purchased_cols < 0).any() or (actual_cols < 0).any() or (item_index.get_indexer(hybrid_similarities.item_ids) < 0).any():
+            logger.warning("item_index truyền vào không chứa mọi item cần đánh giá. Tạo lại chỉ mục item.")
+            item_index = None
+    if item_index is None:
+        item_index = pd.Index(np.unique(np.concatenate([
+            purchased_flat, actual_flat, np.asarray(hybrid_similarities.item_ids, dtype=np.int64)
+        ])))
+        purchased_cols, actual_cols = item_index.get_indexer(purchased_flat), item_index.get_indexer(actual_flat)
+
+    n_users = len(users)
+    user_rows = np.arange(n_users)
+    purchases = csr_matrix(
+        (np.ones(purchased_flat.size), (np.repeat(user_rows, purchased_lengths), purchased_cols)),
+        shape=(n_users, len(item_index))
+    )
+    ground_truth = csr_matrix(
+        (np.ones(actual_flat.size, dtype=np.float32), (np.repeat(user_rows, actual_lengths), actual_cols)),
+        shape=(n_users, len(item_index))
+    )
+    recommended, rec_counts = score_users_sparse(purchases, hybrid_similarities.to_csr('hybrid', item_index), max_n)
 
-        if not train_purchased_items or not actual_items:
-            continue
+    has_recommendations = rec_counts > 0
+    if not has_recommendations.any():
+        return empty
+    metrics_by_cutoff = compute_ranking_metrics(recommended[has_recommendations], ground_truth[has_recommendations], cutoffs)
+    per_user_metrics = dict(metrics_by_cutoff[int(top_n_recommendations)])
+    for n in cutoffs:
+        for name in metric_names:
+            per_user_metrics[f"{name.replace('_at_n', '')}@{n}"] = metrics_by_cutoff[n][name]
+    return per_user_metrics
+
+
+def average_user_metrics(per_user_metrics: Dict[str, List[float]]) -> Dict[str, float]:
+    """
+    Trung bình các chỉ số theo người dùng (0.0 nếu không có người dùng nào).
+    """
+    return {name: float(np.mean(values)) if len(values) else 0.0 for name, values in per_user_metrics.items()}
+
+
+def evaluate_weights_for_similarity(
+    df_train_raw: pd.DataFrame,
+    df_eval_raw: pd.DataFrame,
+    current_weights: Dict[str, float],
+    hybrid_alpha: float,
+    cold_start_threshold: int,
+    item_interaction_counts: Dict[int, int],
+    frequency_decay_factor: float,
+    final_hybrid_threshold: float,
+    # --- THAM SỐ MỚI ĐƯỢC THÊM VÀO ĐÂY ---
+    cosine_threshold: float, # Thêm tham số ngưỡng cosine
+    num_similar_items: int, # Thêm tham số top_k cho content/CF
+    top_n_recommendations: int, # Thêm tham số top_n_recommendations
+    min_alpha_cold_start: float, # <--- THAM SỐ MỚI ĐƯỢC THÊM VÀO
+    df_train_counts: pd.DataFrame = None, # Bảng đếm của df_train_raw (build_interaction_count_table) nếu đã tạo sẵn
+    trial_context: TrialContext = None, # Dữ liệu dùng chung giữa các lần thử (bảng đếm, content top-k, map người dùng)
+    evaluation_users: List[int] = None # Chỉ đánh giá trên các người dùng này (mặc định: mọi người dùng đủ điều kiện)
+) -> Dict[str, float]:
+    """
+    Đánh giá chất lượng gợi ý (NDCG, Precision, Recall, MAP)
+    cho một tập hợp trọng số phản hồi ngầm và trọng số lai (alpha) đã cho,
+    sử dụng cả Collaborative Filtering và Content-based Filtering.
+    Gồm hai bước: build_trial_hybrid_similarities và evaluate_hybrid_recommendations.
+    """
+    hybrid_similarities = build_trial_hybrid_similarities(
+        df_train_raw,
+        current_weights,
+        hybrid_alpha,
+        cold_start_threshold,
+        item_interaction_counts,
+        frequency_decay_factor,
+        final_hybrid_threshold,
+        cosine_threshold,
+        num_similar_items,
+        min_alpha_cold_start,
+        df_train_counts=df_train_counts,
+        trial_context=trial_context
+    )
+    if not hybrid_similarities:
+        return {'precision_at_n': 0.0, 'recall_at_n': 0.0, 'ndcg_at_n': 0.0, 'map': 0.0}
 
-        scores: Dict[int, float] = defaultdict(float)
+    # --- 3. Đánh giá hệ thống gợi ý lai ---
+    if trial_context is not None:
+        user_train_purchases_map = trial_context.user_train_purchases_map
+        user_eval_actual_interactions = trial_context.user_eval_actual_interactions
+        users_to_evaluate = trial_context.users_to_evaluate
+    else:
+        user_train_purchases_map = df_train_raw[df_train_raw['event_type'] == 'purchase'] \
+                                       .groupby('user_id')['product_id'].apply(set).to_dict()
 
-        # Aggregate scores from hybrid similar items
-        for p in train_purchased_items:
-            # Lấy hybrid_score từ tuple trả về của combine_similarities
-            for q, hybrid_score, cf_score, content_score in hybrid_similarities.get(p, []):
-                # Đảm bảo không gợi ý lại sản phẩm đã tương tác trong quá khứ
-                if q not in train_purchased_items:
-                    scores[q] += float(hybrid_score)
+        user_eval_actual_interactions = df_eval_raw.groupby('user_id')['product_id'].apply(set).to_dict()
 
-        # Sử dụng top_n_recommendations từ tham số mới
-        recommended_items_list = [item for item, score in sorted(scores.items(), key=lambda x: x[1], reverse=True)][:top_n_recommendations]
+        users_to_evaluate = [u for u in user_eval_actual_interactions.keys() if u in user_train_purchases_map]
+    if evaluation_users is not None:
+        users_to_evaluate = evaluation_users
 
-        if recommended_items_list and actual_items:
-            precisions.append(precision_at_n(recommended_items_list, actual_items, top_n_recommendations))
-            recalls.append(recall_at_n(recommended_items_list, actual_items, top_n_recommendations))
-            ndcgs.append(ndcg_at_n(recommended_items_list, actual_items, top_n_recommendations))
-            maps.append(average_precision(recommended_items_list, actual_items))
+    metrics = average_user_metrics(evaluate_hybrid_recommendations(
+        hybrid_similarities, user_train_purchases_map, user_eval_actual_interactions, users_to_evaluate, top_n_recommendations,
+        item_index=trial_context.item_index if trial_context is not None else None
+    ))
+    logger.debug(f"Kết quả đánh giá: P@{top_n_recommendations}: {metrics['precision_at_n']:.4f}, R@{top_n_recommendations}: {metrics['recall_at_n']:.4f}, NDCG@{top_n_recommendations}: {metrics['ndcg_at_n']:.4f}, MAP: {metrics['map']:.4f}")
+    return metrics
 
-    avg_precision = np.mean(precisions) if precisions else 0.0
-    avg_recall = np.mean(recalls) if recalls else 0.0
-    avg_ndcg = np.mean(ndcgs) if ndcgs else 0.0
-    avg_map = np.mean(maps) if maps else 0.0
 
-    logger.debug(f"Kết quả đánh giá: P@{top_n_recommendations}: {avg_precision:.4f}, R@{top_n_recommendations}: {avg_recall:.4f}, NDCG@{top_n_recommendations}: {avg_ndcg:.4f}, MAP: {avg_map:.4f}")
+class SuccessiveHalvingScheduler:
+    """
+    Quyết định nâng mức độ trung thực cho từng lần thử theo kiểu successive halving: ở mỗi mức (trừ mức cuối),
+    ứng viên chỉ được đánh giá tiếp nếu điểm (càng nhỏ càng tốt) nằm trong 1/eta điểm tốt nhất đã thấy ở mức đó.
+    Khi một mức chưa có đủ min_history kết quả thì mọi ứng viên đều được nâng mức.
+    """
 
-    return {
-        'precision_at_n': avg_precision,
-        'recall_at_n': avg_recall,
-        'ndcg_at_n': avg_ndcg,
-        'map': avg_map
-    }
+    def __init__(self, fractions: List[float] = BO_FIDELITY_FRACTIONS, eta: float = BO_FIDELITY_ETA,
+                 min_history: int = BO_FIDELITY_MIN_HISTORY):
+        fractions = sorted({min(max(float(f), 0.0), 1.0) for f in fractions if f > 0} | {1.0})
+        self.fractions = fractions
+        self.eta = max(float(eta), 1.0)
+        self.min_history = max(int(min_history), 1)
+        self.history: List[List[float]] = [[] for _ in fractions]
+        self.trial_fidelities: List[float] = []
+        self.last_rung_scores: List[float] = []
+
+    def should_promote(self, rung: int, score: float) -> bool:
+        scores = self.history[rung]
+        if len(scores) < self.min_history:
+            return True
+        return score <= float(np.quantile(scores, 1.0 / self.eta))
+
+    def record(self, rung_scores: List[float]):
+        """
+        Ghi nhận một lần thử. Mọi lần thử đều được ghi vào trial_fidelities (0.0 nếu bị loại bởi ràng buộc
+        trước khi đánh giá ai), để danh sách này khớp từng phần tử với các lần gọi objective.
+        """
+        for rung, score in enumerate(rung_scores):
+            self.history[rung].append(float(score))
+        self.trial_fidelities.append(self.fractions[len(rung_scores) - 1] if rung_scores else 0.0)
+        self.last_rung_scores = list(rung_scores)
+
+    def surrogate_value(self, rung_scores: List[float]) -> float:
+        """
+        Giá trị báo cho GP. Lần thử chạy đủ mọi mức: điểm ở mức cuối. Lần thử dừng sớm ở mức r chỉ cho biết
+        nó nằm ngoài 1/eta tốt nhất ở mức r, nên điểm độ trung thực thấp không được đưa vào như một lần đánh giá
+        đầy đủ: báo giá trị xấu nhất trong các điểm đầy đủ đã thấy (hoặc ở mức r nếu chưa có), không tốt hơn
+        điểm của chính nó. Gọi sau record.
+        """
+        score = float(rung_scores[-1])
+        if len(rung_scores) == len(self.fractions):
+            return score
+        reference = self.history[-1] or self.history[len(rung_scores) - 1]
+        return max(score, float(np.max(reference)))
+
+
+bo_fidelity_scheduler = SuccessiveHalvingScheduler()
 
 
 # Định nghĩa không gian tìm kiếm cho Bayesian Optimization
@@ -1377,7 +3785,7 @@ space = [
     Real(0.0, 0.5, name='final_hybrid_threshold'),
     # --- THAM SỐ MỚI ĐƯỢC THÊM VÀO ĐÂY ---
     Real(0.0, 1.0, name='cosine_threshold'), # Ngưỡng tương đồng cosine
-    Integer(5, 100, name='num_similar_items'), # top_k cho content-based và CF
+    Integer(5, BO_MAX_NUM_SIMILAR_ITEMS, name='num_similar_items'), # top_k cho content-based và CF
     Integer(5, 10, name='top_n_recommendations'), # top_n khuyến nghị trả về
     Real(0.0, 0.5, name='min_alpha_cold_start'), # <--- THAM SỐ MỚI ĐƯỢC THÊM VÀO VỚI KHOẢNG [0.0, 0.5]
 
@@ -1408,66 +3816,196 @@ def objective(
         'purchase': FIXED_PURCHASE_WEIGHT
     }
 
+    def reject_trial() -> float:
+        # Lần thử vi phạm ràng buộc vẫn được ghi nhận (độ trung thực 0) để trial_fidelities khớp với các lần thử
+        bo_fidelity_scheduler.record([])
+        return 1.0
+
     # Kiểm tra ràng buộc thứ tự cho trọng số phản hồi ngầm
     epsilon = 1e-6
     if not (current_weights['view'] < current_weights['wishlist'] - epsilon and
             current_weights['wishlist'] < current_weights['add_to_cart'] - epsilon and
             current_weights['add_to_cart'] < current_weights['purchase'] - epsilon):
         logger.warning(f"DEBUG_OBJ: Vi phạm ràng buộc thứ tự với trọng số ngầm: {current_weights}. Trả về 1.0.")
-        return 1.0 # Giá trị cao, nghĩa là tệ, để Bayesian Opt không chọn
+        return reject_trial() # Giá trị cao, nghĩa là tệ, để Bayesian Opt không chọn
 
     # Kiểm tra ràng buộc cho hybrid_alpha (đã được định nghĩa trong space, nhưng kiểm tra lại)
     if not (0.0 <= hybrid_alpha <= 1.0):
         logger.warning(f"DEBUG_OBJ: hybrid_alpha ({hybrid_alpha}) nằm ngoài khoảng [0, 1]. Trả về 1.0.")
-        return 1.0
+        return reject_trial()
 
     # Kiểm tra ràng buộc cho cold_start_threshold (đã được định nghĩa trong space)
     if not (1 <= cold_start_threshold <= 20):
         logger.warning(f"DEBUG_OBJ: cold_start_threshold ({cold_start_threshold}) nằm ngoài khoảng [1, 20]. Trả về 1.0.")
-        return 1.0
+        return reject_trial()
 
     # Kiểm tra ràng buộc cho cosine_threshold (đã được định nghĩa trong space)
     if not (0.0 <= cosine_threshold <= 1.0):
         logger.warning(f"DEBUG_OBJ: cosine_threshold ({cosine_threshold}) nằm ngoài khoảng [0, 1]. Trả về 1.0.")
-        return 1.0
+        return reject_trial()
 
     # Kiểm tra ràng buộc cho num_similar_items (đã được định nghĩa trong space)
-    if not (5 <= num_similar_items <= 100):
-        logger.warning(f"DEBUG_OBJ: num_similar_items ({num_similar_items}) nằm ngoài khoảng [5, 100]. Trả về 1.0.")
-        return 1.0
+    if not (5 <= num_similar_items <= BO_MAX_NUM_SIMILAR_ITEMS):
+        logger.warning(f"DEBUG_OBJ: num_similar_items ({num_similar_items}) nằm ngoài khoảng [5, {BO_MAX_NUM_SIMILAR_ITEMS}]. Trả về 1.0.")
+        return reject_trial()
 
     # Kiểm tra ràng buộc cho top_n_recommendations (đã được định nghĩa trong space)
     if not (5 <= top_n_recommendations <= 50):
         logger.warning(f"DEBUG_OBJ: top_n_recommendations ({top_n_recommendations}) nằm ngoài khoảng [5, 50]. Trả về 1.0.")
-        return 1.0
+        return reject_trial()
      # <--- KIỂM TRA RÀNG BUỘC CHO THAM SỐ MỚI min_alpha_cold_start
     if not (0.0 <= min_alpha_cold_start <= 0.5): # Kiểm tra ràng buộc
         logger.warning(f"DEBUG_OBJ: min_alpha_cold_start ({min_alpha_cold_start}) nằm ngoài khoảng [0, 0.5]. Trả về 1.0.")
-        return 1.0
+        return reject_trial()
     logger.info(f"DEBUG_OBJ: Đánh giá với trọng số: {current_weights}, alpha lai: {hybrid_alpha}, cold_start_threshold: {cold_start_threshold}, freq_decay: {frequency_decay_factor}, final_thresh: {final_hybrid_threshold}")
     logger.info(f"DEBUG_OBJ: cosine_threshold: {cosine_threshold}, num_similar_items: {num_similar_items}, top_n_recommendations: {top_n_recommendations}")
 
 
-    evaluation_metrics = evaluate_weights_for_similarity(
-        df_train_raw.copy(),
-        df_val_raw.copy(),
-        current_weights,
-        hybrid_alpha,
-        cold_start_threshold,
-        item_interaction_counts_global, # Sử dụng item_interaction_counts_global đã tính toán 1 lần
-        frequency_decay_factor,
-        final_hybrid_threshold,
-        # --- TRUYỀN THAM SỐ MỚI VÀO HÀM ĐÁNH GIÁ ---
-        cosine_threshold=cosine_threshold,
-        num_similar_items=num_similar_items,
-        top_n_recommendations=top_n_recommendations,
-        min_alpha_cold_start=min_alpha_cold_start, # <--- TRUYỀN THAM SỐ MỚI
+    # Đánh giá đa độ trung thực: các mẫu người dùng lồng nhau, mỗi mức chỉ đánh giá thêm người dùng mới;
+    # ứng viên không đủ tốt ở một mức thấp sẽ dừng sớm. Độ tương đồng lai (CF cosine + kết hợp) chỉ được tính
+    # cho các sản phẩm mà người dùng mới của mức đã mua và chưa được tính ở mức trước, nên lần thử dừng ở mức
+    # thấp chỉ tốn chi phí cho phần sản phẩm đó.
+    per_user_metrics = defaultdict(list, {'precision_at_n': [], 'recall_at_n': [], 'ndcg_at_n': [], 'map': []})
+    evaluated_users = set()
+    computed_items = set()
+    partial_tables = []
+    rung_scores = []
+    fractions = bo_fidelity_scheduler.fractions
+    for rung, fraction in enumerate(fractions):
+        rung_users = trial_context_global.stratified_users(fraction)
+        new_users = [u for u in rung_users if u not in evaluated_users]
+        evaluated_users.update(new_users)
+        rung_items = set().union(*(trial_context_global.user_train_purchases_map.get(u, ()) for u in new_users)) - computed_items
+        if rung_items:
+            partial_table = build_trial_hybrid_similarities(
+                df_train_raw,
+                current_weights,
+                hybrid_alpha,
+                cold_start_threshold,
+                item_interaction_counts_global, # Sử dụng item_interaction_counts_global đã tính toán 1 lần
+                frequency_decay_factor,
+                final_hybrid_threshold,
+                cosine_threshold=cosine_threshold,
+                num_similar_items=num_similar_items,
+                min_alpha_cold_start=min_alpha_cold_start,
+                trial_context=trial_context_global,
+                query_items=np.fromiter(rung_items, dtype=np.int64, count=len(rung_items)),
+            )
+            if partial_table:
+                partial_tables.append(partial_table)
+            computed_items |= rung_items
+        hybrid_similarities = SimilarityTable.concat(partial_tables)
+        if hybrid_similarities:
+            rung_metrics = evaluate_hybrid_recommendations(
+                hybrid_similarities,
+                trial_context_global.user_train_purchases_map,
+                trial_context_global.user_eval_actual_interactions,
+                new_users,
+                top_n_recommendations,
+                item_index=trial_context_global.item_index
+            )
+            for name, values in rung_metrics.items():
+                per_user_metrics[name].extend(values)
+        evaluation_metrics = average_user_metrics(per_user_metrics)
+        score_to_minimize = -evaluation_metrics['ndcg_at_n']
+        rung_scores.append(score_to_minimize)
+        if rung < len(fractions) - 1 and not bo_fidelity_scheduler.should_promote(rung, score_to_minimize):
+            break
 
+    bo_fidelity_scheduler.record(rung_scores)
+    objective_value = bo_fidelity_scheduler.surrogate_value(rung_scores)
+    logger.info(f"DEBUG_OBJ: NDCG@{top_n_recommendations}: {evaluation_metrics['ndcg_at_n']:.4f}, Optimization Score: {score_to_minimize:.4f} (báo cho GP: {objective_value:.4f}), fidelity: {fractions[len(rung_scores) - 1]:.2f} ({len(evaluated_users)}/{len(trial_context_global.users_to_evaluate)} người dùng, {len(computed_items)} sản phẩm, mức {len(rung_scores)}/{len(fractions)})")
+    return objective_value
+
+def _bo_worker_init(blas_threads: int):
+    """
+    Khởi tạo tiến trình worker: giới hạn số luồng BLAS để các worker không tranh nhau CPU.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=blas_threads)
+    except ImportError:
+        pass
+
+
+def _bo_evaluate_point(objective_fn, fidelity_history: List[List[float]], point: list) -> Tuple[float, List[float]]:
+    """
+    Chạy trong worker: dùng lịch sử successive halving của tiến trình cha (ngưỡng nâng mức tính ở phía cha),
+    đánh giá một điểm và trả về (giá trị, điểm của từng mức) để tiến trình cha ghi nhận.
+    """
+    bo_fidelity_scheduler.history = [list(scores) for scores in fidelity_history]
+    bo_fidelity_scheduler.last_rung_scores = [] # Điểm vi phạm ràng buộc không được đánh giá ở mức nào
+    value = objective_fn(point)
+    return value, bo_fidelity_scheduler.last_rung_scores
+
+
+def run_parallel_bayesian_optimization(
+    objective_fn,
+    dimensions: list,
+    n_calls: int = 100,
+    n_initial_points: int = 20,
+    random_state: int = 42,
+    n_jobs: int = BO_N_JOBS,
+    batch_size: int = BO_BATCH_SIZE,
+    fidelity_scheduler: SuccessiveHalvingScheduler = None
+):
+    """
+    Bayesian Optimization theo lô: mỗi vòng hỏi Optimizer q điểm (ask(n_points=q), chiến lược constant liar)
+    rồi đánh giá đồng thời trong ProcessPoolExecutor, sau đó tell toàn bộ kết quả theo đúng thứ tự đã hỏi.
+
+    Worker được tạo bằng fork nên dùng chung (copy-on-write) dữ liệu train/val, trial_context_global và
+    embeddings của tiến trình cha mà không cần pickle. Vì vậy tiến trình cha không được khởi tạo content encoder
+    (initialize_global_bert_model encode trong tiến trình con khi BO_N_JOBS > 1); nếu encoder đã được nạp
+    trong tiến trình này thì không fork mà đánh giá tuần tự. Với cùng random_state và objective tất định,
+    chuỗi điểm được thử và kết quả là tất định, không phụ thuộc thứ tự hoàn thành của các worker.
+    Nếu có fidelity_scheduler, mọi điểm trong một vòng dùng cùng ngưỡng nâng mức (lịch sử của tiến trình cha
+    tại đầu vòng) và kết quả từng mức được ghi nhận ở tiến trình cha theo thứ tự đã hỏi.
+    Trả về OptimizeResult giống gp_minimize (dùng được với plot_convergence).
+    """
+    n_jobs = max(1, int(n_jobs))
+    batch_size = int(batch_size) if batch_size and batch_size > 0 else n_jobs
+    optimizer = Optimizer(
+        dimensions,
+        base_estimator='GP',
+        n_initial_points=n_initial_points,
+        acq_func='gp_hedge',
+        random_state=random_state
     )
 
-    score_to_minimize = -evaluation_metrics['ndcg_at_n']
-    logger.info(f"DEBUG_OBJ: NDCG@{top_n_recommendations}: {evaluation_metrics['ndcg_at_n']:.4f}, Optimization Score: {score_to_minimize:.4f}")
-    return score_to_minimize
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning("Hệ điều hành không hỗ trợ fork. Đánh giá các điểm ứng viên tuần tự.")
+        n_jobs = 1
+    elif n_jobs > 1 and (GLOBAL_BERT_MODEL is not None or GLOBAL_ONNX_SESSION is not None):
+        logger.warning("Content encoder (TensorFlow/onnxruntime) đã được nạp trong tiến trình này; fork sau đó không an toàn. "
+                       "Đánh giá các điểm ứng viên tuần tự.")
+        n_jobs = 1
+
+    result = None
+    started = time.perf_counter()
+    pool = ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('fork'),
+                               initializer=_bo_worker_init, initargs=(BO_WORKER_BLAS_THREADS,)) if n_jobs > 1 else None
+    try:
+        n_done = 0
+        while n_done < n_calls:
+            q = min(batch_size, n_calls - n_done)
+            candidate_points = optimizer.ask(n_points=q) if q > 1 else [optimizer.ask()]
+            if pool is not None and fidelity_scheduler is not None:
+                evaluated = list(pool.map(partial(_bo_evaluate_point, objective_fn, fidelity_scheduler.history), candidate_points))
+                candidate_values = [value for value, _ in evaluated]
+                for _, rung_scores in evaluated:
+                    fidelity_scheduler.record(rung_scores)
+            elif pool is not None:
+                candidate_values = list(pool.map(objective_fn, candidate_points))
+            else:
+                candidate_values = [objective_fn(point) for point in candidate_points]
+            result = optimizer.tell(candidate_points, [float(v) for v in candidate_values])
+            n_done += q
+            logger.info(f"BO song song: {n_done}/{n_calls} lần gọi, giá trị tốt nhất {result.fun:.4f} ({time.perf_counter() - started:.1f}s, {n_jobs} tiến trình, {q} điểm/vòng).")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return result
+
 
 # --- THAY THẾ CÁC BIẾN TOÀN CỤC BẰNG BIẾN CỤC BỘ HOẶC THAM SỐ HÀM ---
 # Loại bỏ các dòng sau nếu chúng lấy giá trị từ APP_SETTINGS và bạn muốn tối ưu hóa chúng
@@ -1486,14 +4024,29 @@ if (('df_raw_events' in locals() and not df_raw_events.empty) and
     ('df_train_raw' in locals() and not df_train_raw.empty) and
     ('df_val_raw' in locals() and not df_val_raw.empty)):
     logger.info("Bắt đầu tối ưu hóa Bayesian...")
-    result = gp_minimize(
-        objective,
-        space,
-        n_calls=100, # Số lượng lần gọi hàm mục tiêu
-        n_random_starts=20, # Số lượng điểm khởi tạo ngẫu nhiên
-        random_state=42,
-        verbose=True
-    )
+    # Bảng đếm, content top-k (ở k lớn nhất) và các map người dùng chỉ tính một lần cho mọi lần thử
+    trial_context_global = TrialContext(df_train_raw, df_val_raw)
+    if BO_N_JOBS > 1:
+        # Đánh giá song song q điểm ứng viên mỗi vòng trên BO_N_JOBS tiến trình
+        result = run_parallel_bayesian_optimization(
+            objective,
+            space,
+            n_calls=100,
+            n_initial_points=20,
+            random_state=42,
+            n_jobs=BO_N_JOBS,
+            batch_size=BO_BATCH_SIZE,
+            fidelity_scheduler=bo_fidelity_scheduler
+        )
+    else:
+        result = gp_minimize(
+            objective,
+            space,
+            n_calls=100, # Số lượng lần gọi hàm mục tiêu
+            n_random_starts=20, # Số lượng điểm khởi tạo ngẫu nhiên
+            random_state=42,
+            verbose=True
+        )
 
     # Trích xuất trọng số tối ưu
     # Các chỉ số của result.x sẽ tương ứng với thứ tự trong 'space'
@@ -1548,6 +4101,8 @@ if (('df_raw_events' in locals() and not df_raw_events.empty) and
                 "optimal_top_n_recommendations": int(optimal_top_n_recommendations), # Lưu
                 "optimal_min_alpha_cold_start": optimal_min_alpha_cold_start, # <--- LƯU THAM SỐ MỚI
                 "best_ndcg": best_ndcg,
+                "fidelity_fractions": bo_fidelity_scheduler.fractions,
+                "trial_fidelities": bo_fidelity_scheduler.trial_fidelities,
                 "optimization_timestamp": timestamp
             }, f, indent=4)
         print(f"\n--- Trọng số lai tối ưu đã được lưu vào: {weights_file_name} ---")
@@ -1615,8 +4170,8 @@ final_evaluation_metrics = evaluate_weights_for_similarity(
     optimal_cosine_threshold,     # Tham số mới
     optimal_num_similar_items,    # Tham số mới
     optimal_top_n_recommendations,# Tham số mới
-    optimal_min_alpha_cold_start # <-- THÊM DÒNG NÀY
-
+    optimal_min_alpha_cold_start, # <-- THÊM DÒNG NÀY
+    df_train_counts=trial_context_global.train_counts if 'trial_context_global' in globals() else None
 )
 
 print(f"\n--- Hiệu suất mô hình cuối cùng trên tập Test Set với TOP_N={optimal_top_n_recommendations} ---")
@@ -1720,21 +4275,24 @@ if 'content_similarities_global' not in locals() or not content_similarities_glo
             logger.warning("Không có độ tương đồng Content-based được tính toán. Kiểm tra dữ liệu và TF-IDF.")
 
 
-# 2. Áp dụng trọng số tối ưu cho toàn bộ dữ liệu sự kiện thô để có 'implicit_score'
+# 2. Áp dụng trọng số tối ưu cho toàn bộ dữ liệu sự kiện để có 'implicit_score'
 print("\n--- Áp dụng trọng số tối ưu cho toàn bộ dữ liệu sự kiện ---")
-# Đảm bảo df_raw_events và optimal_weights đã được định nghĩa từ các cell trước.
 # optimal_weights được lấy từ Cell 4.
 if 'optimal_weights' not in locals():
     logger.error("optimal_weights chưa được định nghĩa. Hãy chạy Cell 4 trước.")
     raise NameError("optimal_weights is not defined. Please run Cell 4.")
 
+# Bảng đếm (user_id, product_id, event_type, interaction_count) đọc bằng stream từ user_events:
+# mô hình cuối không cần giữ bảng sự kiện thô trong bộ nhớ. Ở chế độ CF tăng dần, bảng đếm lấy từ
+# trạng thái CF vừa cập nhật (chỉ đọc các sự kiện mới hơn watermark) thay vì đọc lại toàn bộ user_events.
+if CF_INCREMENTAL_MODE:
+    cf_state_final = update_cf_state_incremental(optimal_weights, optimal_num_similar_items, optimal_cosine_threshold)
+    df_event_counts_final = cf_state_final['counts']
+else:
+    df_event_counts_final, _ = load_user_event_counts()
 
-# Trong Cell 6, trước dòng gọi assign_implicit_feedback_scores:
 print(f"\n--- DEBUG: Kiểm tra Event Types và Weights ---")
-if 'df_raw_events' in globals(): # Kiểm tra xem biến có tồn tại không
-    print("Unique event_types in df_raw_events:", df_raw_events['event_type'].unique())
-else:
-    logger.warning("df_raw_events không tồn tại khi kiểm tra event types.")
+print("Unique event_types in user_events:", df_event_counts_final['event_type'].unique())
 
 if 'optimal_weights' in globals(): # Kiểm tra xem biến có tồn tại không
     print("Keys in optimal_weights:", optimal_weights.keys())
@@ -1742,10 +4300,14 @@ else:
     logger.warning("optimal_weights không tồn tại khi kiểm tra event types.")
 
 
-df_weighted_events_for_final_model = assign_implicit_feedback_scores(df_raw_events.copy(), optimal_weights)
-logger.info(f"Tổng số sự kiện sau khi gán trọng số: {len(df_weighted_events_for_final_model)}")
-logger.info(f"Số lượng sự kiện có implicit_score > 0: {len(df_weighted_events_for_final_model[df_weighted_events_for_final_model['implicit_score'] > 0])}")
-print(f"\n--- DEBUG: Tham số đang được truyền vào assign_implicit_feedback_scores ---")
+# Mỗi dòng bảng đếm đại diện cho interaction_count sự kiện có cùng implicit_score
+df_weighted_events_for_final_model = df_event_counts_final.assign(
+    implicit_score=implicit_scores_from_counts(df_event_counts_final, optimal_weights)
+)
+event_multiplicity = df_weighted_events_for_final_model['interaction_count']
+logger.info(f"Tổng số sự kiện sau khi gán trọng số: {int(event_multiplicity.sum())}")
+logger.info(f"Số lượng sự kiện có implicit_score > 0: {int(event_multiplicity[df_weighted_events_for_final_model['implicit_score'] > 0].sum())}")
+print(f"\n--- DEBUG: Tham số đang được truyền vào implicit_scores_from_counts ---")
 print(f"Optimal Weights: {optimal_weights}")
 print(f"Optimal Frequency Decay Factor (from optimal_frequency_decay_factor): {optimal_frequency_decay_factor:.10f}") # In với độ chính xác cao
 print(f"Kiểu dữ liệu của optimal_frequency_decay_factor: {type(optimal_frequency_decay_factor)}")
@@ -1773,7 +4335,7 @@ print(f"\nGiá trị nhỏ nhất của implicit_score trong toàn bộ DataFram
 
 # Trực quan hóa phân bố điểm implicit_score
 plt.figure(figsize=(10, 6))
-sns.histplot(df_weighted_events_for_final_model['implicit_score'], bins=20, kde=True)
+sns.histplot(x=df_weighted_events_for_final_model['implicit_score'], weights=event_multiplicity, bins=20, kde=True)
 plt.title('Phân bố điểm Implicit Score (Toàn bộ dữ liệu)')
 plt.xlabel('Implicit Score')
 plt.ylabel('Số lượng sự kiện')
@@ -1782,17 +4344,18 @@ plt.show()
 
 
 print("\n--- Tính toán số lượng tương tác của sản phẩm cho Dynamic Weighting ---")
-# Sử dụng df_raw_events để lấy số lượng tương tác thô của từng sản phẩm.
-# Đây là dữ liệu gốc, chưa bị loại bỏ hay biến đổi.
-if 'df_raw_events' not in locals():
-    logger.error("df_raw_events chưa được định nghĩa. Hãy tải dữ liệu gốc trước.")
-    raise NameError("df_raw_events is not defined. Please ensure raw event data is loaded.")
-item_interaction_counts_for_final_model = df_raw_events['product_id'].value_counts().to_dict()
+# Số lượng tương tác thô của từng sản phẩm = tổng interaction_count của sản phẩm trong bảng đếm.
+item_interaction_counts_for_final_model = (df_event_counts_final.groupby('product_id')['interaction_count'].sum()
+                                           .sort_values(ascending=False, kind='mergesort').to_dict())
 logger.info(f"Đã tính số lượng tương tác cho {len(item_interaction_counts_for_final_model)} sản phẩm.")
 
 # 3. Tính toán độ tương đồng Collaborative Filtering từ toàn bộ dữ liệu
 print("\n--- Bắt đầu tính toán độ tương đồng Collaborative Filtering (CF) từ toàn bộ dữ liệu ---")
-collab_similarities_final = compute_sparse_similarity(df_weighted_events_for_final_model, optimal_num_similar_items, optimal_cosine_threshold)
+if CF_INCREMENTAL_MODE:
+    # Trạng thái CF đã được cập nhật ở bước 2 (xem update_cf_state_incremental)
+    collab_similarities_final = cf_similarities_from_state(cf_state_final)
+else:
+    collab_similarities_final = compute_sparse_similarity(df_weighted_events_for_final_model, optimal_num_similar_items, optimal_cosine_threshold)
 logger.info(f"Đã tính toán độ tương đồng CF cho {len(collab_similarities_final)} sản phẩm.")
 
 # 4. Kết hợp độ tương đồng CF và Content-based sử dụng alpha lai tối ưu
@@ -1832,27 +4395,12 @@ logger.info(f"Đã tính toán độ tương đồng Hybrid cho {len(final_hybri
 # <--- BẮT ĐẦU THÊM LOGIC LỌC FINAL_HYBRID_THRESHOLD Ở ĐÂY ---
 if optimal_final_hybrid_threshold > 0: # Chỉ lọc nếu ngưỡng > 0
     print(f"\n--- Đang lọc Hybrid Item Similarity bằng FINAL_HYBRID_THRESHOLD ({optimal_final_hybrid_threshold:.4f}) ---")
-    filtered_final_hybrid_similarities = {}
     items_before_filter = len(final_hybrid_similarities)
-    total_pairs_before_filter = sum(len(v) for v in final_hybrid_similarities.values())
-    
-    count_items_with_neighbors_after_filter = 0
-    total_pairs_after_filter = 0
-
-    for p1, neighbours in final_hybrid_similarities.items():
-        filtered_neighbours_for_p1 = []
-        for p2, hybrid_score, cf_score, content_score in neighbours:
-            if hybrid_score >= optimal_final_hybrid_threshold:
-                filtered_neighbours_for_p1.append((p2, hybrid_score, cf_score, content_score))
-        
-        if filtered_neighbours_for_p1:
-            filtered_final_hybrid_similarities[p1] = filtered_neighbours_for_p1
-            count_items_with_neighbors_after_filter += 1
-            total_pairs_after_filter += len(filtered_neighbours_for_p1)
-        # else: # Có thể giữ lại entry rỗng để biết sản phẩm đó vẫn được tính nhưng không có láng giềng phù hợp
-        #     filtered_final_hybrid_similarities[p1] = [] 
-
-    final_hybrid_similarities = filtered_final_hybrid_similarities # Cập nhật biến để sử dụng kết quả đã lọc
+    total_pairs_before_filter = final_hybrid_similarities.nnz
+
+    final_hybrid_similarities = final_hybrid_similarities.threshold(optimal_final_hybrid_threshold) # Cập nhật biến để sử dụng kết quả đã lọc
+    count_items_with_neighbors_after_filter = len(final_hybrid_similarities)
+    total_pairs_after_filter = final_hybrid_similarities.nnz
     logger.info(f"Số lượng sản phẩm có độ tương đồng Hybrid (sau khi lọc FINAL_HYBRID_THRESHOLD): {len(final_hybrid_similarities)}")
     logger.info(f"Tổng số cặp tương đồng trước lọc: {total_pairs_before_filter}, sau lọc: {total_pairs_after_filter}")
     logger.info(f"Số sản phẩm có láng giềng (trước lọc): {items_before_filter}, (sau lọc): {count_items_with_neighbors_after_filter}")
@@ -1873,13 +4421,9 @@ else:
             break
 
     # Trực quan hóa phân bố điểm số tương đồng lai (nếu có dữ liệu)
-    all_hybrid_scores = []
-    for pid, sim_list in final_hybrid_similarities.items():
-        # SỬA LỖI Ở ĐÂY: bóc tách đủ 4 giá trị và sử dụng hybrid_score
-        for _, hybrid_score, cf_score, content_score in sim_list:
-            all_hybrid_scores.append(hybrid_score) # Dùng hybrid_score để trực quan hóa
+    all_hybrid_scores = np.asarray(final_hybrid_similarities.hybrid)
 
-    if all_hybrid_scores:
+    if all_hybrid_scores.size:
         plt.figure(figsize=(10, 6))
         sns.histplot(all_hybrid_scores, bins=50, kde=True)
         plt.title('Phân bố điểm số tương đồng lai (Hybrid Item Similarity)')
@@ -1892,77 +4436,101 @@ else:
 
 
     # 5. Lưu trữ độ tương đồng lai vào cơ sở dữ liệu - SỬA ĐỔI QUAN TRỌNG
-    def persist_similarity(topk: Dict[int, List[Tuple[int, float, float, float]]]):
+    def persist_similarity_swap(pairs: Dict[str, np.ndarray]) -> int:
+        """
+        Nạp các cặp vào bảng tạm (không có index phụ, theo thứ tự khóa chính), tạo index sau khi nạp rồi
+        RENAME TABLE vào chỗ item_similarity. Người đọc không bao giờ thấy bảng rỗng hoặc nạp dở.
+        """
+        table_name = ItemSimilarity.__tablename__
+        staging_name = f"{table_name}_staging"
+        columns = ['product_id_1', 'product_id_2', 'score', 'cf_score', 'content_score']
+        order = np.lexsort((pairs['product_id_2'], pairs['product_id_1']))
+        rows = list(zip(*(pairs[col][order].tolist() for col in columns)))
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            index_clauses = create_staging_table(conn, table_name, staging_name)
+        try:
+            chunk_rows = ITEM_SIMILARITY_INSERT_ROWS * 50
+            for start in range(0, len(rows), chunk_rows):
+                with engine.begin() as conn:
+                    bulk_insert_rows(conn, staging_name, columns, rows[start:start + chunk_rows], ITEM_SIMILARITY_INSERT_ROWS)
+            with engine.begin() as conn:
+                add_table_indexes(conn, staging_name, index_clauses)
+                swap_staging_table(conn, table_name, staging_name)
+        except Exception:
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE IF EXISTS `{staging_name}`"))
+            raise
+        elapsed = time.perf_counter() - started
+        logger.info(f"Persisted {len(rows)} unique item similarities into {table_name} via staging table swap "
+                    f"in {elapsed:.2f}s ({len(rows) / max(elapsed, 1e-9):.0f} rows/s).")
+        return len(rows)
+
+    def persist_similarity(topk: SimilarityTable, mode: str = ITEM_SIMILARITY_PERSIST_MODE) -> Optional[Dict]:
+        """
+        Ghi các cặp vào item_similarity. Trả về dấu vân tay của lần ghi (record_similarity_fingerprint)
+        nếu thành công, None nếu lỗi.
+        """
+        # Cặp đã chuẩn hóa (product_id_1 < product_id_2), mỗi cặp một lần, không có cặp một item với chính nó
+        pairs = topk.unique_pairs()
+        if mode == 'swap':
+            try:
+                return record_similarity_fingerprint(engine, persist_similarity_swap(pairs))
+            except Exception as e:
+                logger.exception("Failed to persist item similarity: %s", e)
+            return None
+
         session = SessionLocal()
         try:
             session.execute(text(f"TRUNCATE TABLE {ItemSimilarity.__tablename__}"))
             session.commit()
             logger.info(f"Cleared existing data from {ItemSimilarity.__tablename__}.")
-            batch = []
-            row_count = 0
-            # THÊM MỘT SET ĐỂ LƯU TRỮ CÁC CẶP ĐÃ ĐƯỢC THÊM
-            processed_pairs = set()
-
-            for p1, neighbours in topk.items():
-                for p2, hybrid_score, cf_score, content_score in neighbours:
-                    # Đảm bảo p1 luôn nhỏ hơn hoặc bằng p2 để tạo cặp duy nhất
-                    # Sử dụng min/max để chuẩn hóa cặp
-                    prod_id_1_normalized = min(int(p1), int(p2))
-                    prod_id_2_normalized = max(int(p1), int(p2))
-
-                    # Bỏ qua các cặp mà hai sản phẩm là như nhau (độ tương đồng của một item với chính nó)
-                    if prod_id_1_normalized == prod_id_2_normalized:
-                        continue
-
-                    # Tạo một tuple đại diện cho cặp đã chuẩn hóa
-                    current_pair = (prod_id_1_normalized, prod_id_2_normalized)
-
-                    # Chỉ thêm vào batch nếu cặp này chưa được xử lý
-                    if current_pair not in processed_pairs:
-                        batch.append({
-                            'product_id_1': prod_id_1_normalized,
-                            'product_id_2': prod_id_2_normalized,
-                            'score': float(hybrid_score),
-                            'cf_score': float(cf_score),
-                            'content_score': float(content_score)
-                        })
-                        processed_pairs.add(current_pair) # Thêm cặp đã xử lý vào set
-                        row_count += 1
-
-                    if len(batch) >= BATCH_SIZE:
-                        try:
-                            session.bulk_insert_mappings(ItemSimilarity, batch)
-                            session.commit()
-                            logger.debug(f"Inserted {len(batch)} rows into {ItemSimilarity.__tablename__}.")
-                        except Exception as insert_e:
-                            session.rollback()
-                            logger.error(f"Lỗi khi bulk_insert_mappings: {insert_e}")
-                            raise # Re-raise để dừng quá trình nếu lỗi nghiêm trọng
-                        finally:
-                            batch.clear()
-
-            if batch: # Insert any remaining rows
+            row_count = len(pairs['product_id_1'])
+
+            for start in range(0, row_count, BATCH_SIZE):
+                batch = [
+                    {'product_id_1': p1, 'product_id_2': p2, 'score': hs, 'cf_score': cfs, 'content_score': cons}
+                    for p1, p2, hs, cfs, cons in zip(*(pairs[col][start:start + BATCH_SIZE].tolist() for col in
+                                                       ('product_id_1', 'product_id_2', 'score', 'cf_score', 'content_score')))
+                ]
                 try:
                     session.bulk_insert_mappings(ItemSimilarity, batch)
                     session.commit()
-                    logger.debug(f"Inserted {len(batch)} remaining rows into {ItemSimilarity.__tablename__}.")
+                    logger.debug(f"Inserted {len(batch)} rows into {ItemSimilarity.__tablename__}.")
                 except Exception as insert_e:
                     session.rollback()
-                    logger.error(f"Lỗi khi bulk_insert_mappings phần còn lại: {insert_e}")
+                    logger.error(f"Lỗi khi bulk_insert_mappings: {insert_e}")
                     raise # Re-raise để dừng quá trình nếu lỗi nghiêm trọng
 
             logger.info(f"Persisted {row_count} unique item similarities successfully into {ItemSimilarity.__tablename__}.")
+            return record_similarity_fingerprint(engine, row_count)
         except Exception as e:
             session.rollback()
             logger.exception("Failed to persist item similarity: %s", e)
+            return None
         finally:
             session.close()
 
     print("\n--- Bắt đầu lưu trữ độ tương đồng Hybrid Item Similarity vào cơ sở dữ liệu ---")
     # Đảm bảo `final_hybrid_similarities` đã được tính toán ở bước 4 của cell này
-    persist_similarity(final_hybrid_similarities)
+    similarity_fingerprint = persist_similarity(final_hybrid_similarities)
     print("--- Hoàn tất lưu trữ Hybrid Item Similarity ---")
 
+    # Lưu thêm bản mảng (.npy) để bước tạo đề xuất có thể nạp bằng mmap thay vì đọc lại từ DB.
+    # Lưu đúng dạng mà bước đó dựng từ item_similarity: các cặp duy nhất, thêm cả hai chiều.
+    # Chỉ lưu khi ghi DB thành công, kèm dấu vân tay của lần ghi đó để bước tạo đề xuất đối chiếu.
+    if similarity_fingerprint is None:
+        logger.warning(f"Ghi item_similarity thất bại: không cập nhật SimilarityTable tại {SIMILARITY_TABLE_DIR}.")
+    else:
+        try:
+            persisted_pairs = final_hybrid_similarities.unique_pairs()
+            SimilarityTable.from_symmetric_pairs(
+                persisted_pairs['product_id_1'], persisted_pairs['product_id_2'],
+                persisted_pairs['score'], persisted_pairs['cf_score'], persisted_pairs['content_score']
+            ).save(SIMILARITY_TABLE_DIR, fingerprint=similarity_fingerprint)
+        except Exception as e:
+            logger.warning(f"Không thể lưu SimilarityTable vào {SIMILARITY_TABLE_DIR}: {e}")
+
 # Cấu hình URL của Laravel API
 # Đảm bảo URL này khớp với nơi ứng dụng Laravel của bạn đang chạy
 # Ví dụ: nếu bạn đang chạy 'php artisan serve' ở cổng mặc định, nó sẽ là:
@@ -2037,15 +4605,15 @@ print("\n--- Hoàn tất quá trình tính toán và lưu trữ Hybrid Item Simi
 import pandas as pd
 from typing import Dict, List, Tuple, Set
 from collections import defaultdict
-from sqlalchemy import create_engine, text, Column, Integer, Float
+from sqlalchemy import create_engine, text, bindparam, Column, Integer, Float
 from sqlalchemy.ext.declarative import declarative_base
 import logging
 import json
 import os
 import glob
+import time
 import numpy as np
 import gc
-import sys # Import sys to check object size
 from sqlalchemy.orm import sessionmaker # Import sessionmaker for SessionLocal
 
 # --- Cấu hình Logger ---
@@ -2144,74 +4712,34 @@ logger.info(f"Sử dụng TOP_N_RECOMMENDATIONS: {optimal_top_n_recommendations}
 logger.info(f"Sử dụng Cold-Start Threshold: {cold_start_threshold}")
 logger.info(f"Sử dụng Final Hybrid Threshold (áp dụng cho từng loại score): {final_hybrid_threshold}")
 
-# --- Các hàm mmr_diversity và prepare_content_sim_for_lookup (giữ nguyên) ---
+# --- Hàm mmr_diversity (tra cứu độ tương đồng nội dung từ SimilarityTable) ---
 def mmr_diversity(candidate_items_with_scores: List[Tuple[int, float]],
-                  content_sim_lookup: Dict[int, Dict[int, float]],
+                  content_sim_lookup: SimilarityTable,
                   lambda_diversity: float,
                   top_n: int) -> List[Tuple[int, float]]:
     if not candidate_items_with_scores:
         return []
 
-    sorted_candidates = sorted(candidate_items_with_scores, key=lambda x: x[1], reverse=True)
-    selected_items = []
-    selected_item_ids = set()
-
     if top_n <= 0:
         return []
 
-    if sorted_candidates:
-        first_item_id, first_item_score = sorted_candidates[0]
-        selected_items.append((first_item_id, first_item_score))
-        selected_item_ids.add(first_item_id)
-
-    for _ in range(top_n - 1):
-        best_item = None
-        max_mmr_score = -1.0
-
-        remaining_candidates = [item for item in sorted_candidates if item[0] not in selected_item_ids]
-        if not remaining_candidates:
-            break
-
-        for candidate_id, candidate_score in remaining_candidates:
-            max_similarity_with_selected = 0.0
-            if selected_item_ids:
-                for selected_id in selected_item_ids:
-                    sim = content_sim_lookup.get(candidate_id, {}).get(selected_id, 0.0)
-                    max_similarity_with_selected = max(max_similarity_with_selected, sim)
-
-            mmr_score = lambda_diversity * candidate_score - (1 - lambda_diversity) * max_similarity_with_selected
-
-            if mmr_score > max_mmr_score:
-                max_mmr_score = mmr_score
-                best_item = (candidate_id, candidate_score)
-
-        if best_item:
-            selected_items.append(best_item)
-            selected_item_ids.add(best_item[0])
-        else:
-            break
+    sorted_candidates = sorted(candidate_items_with_scores, key=lambda x: x[1], reverse=True)
+    # Tra cứu độ tương đồng nội dung giữa các ứng viên một lần từ SimilarityTable rồi chọn bằng mmr_select
+    content_matrix = content_sim_lookup.submatrix([item_id for item_id, _ in sorted_candidates], column='content')
+    relevance = np.array([score for _, score in sorted_candidates], dtype=np.float64)
+    selected_positions = mmr_select(relevance, content_matrix, lambda_diversity, top_n, min_mmr_score=-1.0)
+    selected_items = [sorted_candidates[pos] for pos in selected_positions.tolist()]
     return selected_items
 
 
-def prepare_content_sim_for_lookup(content_sims_for_preparation: Dict[int, List[Tuple[int, float]]]) -> Dict[int, Dict[int, float]]:
-    logger.info("Bắt đầu chuẩn bị content_sim_lookup...")
-    lookup = {}
-    total_entries = 0
-    for pid, similarities in content_sims_for_preparation.items():
-        lookup[pid] = {target_pid: score for target_pid, score in similarities}
-        total_entries += len(similarities)
-    logger.info(f"Hoàn thành chuẩn bị content_sim_lookup với {len(lookup)} mục gốc và {total_entries} tổng số mục tương đồng.")
-    return lookup
-
-
 # --- Hàm generate_hybrid_recommendations_with_hard_thresholding (giữ nguyên) ---
 def generate_hybrid_recommendations_with_hard_thresholding(
     user_id: int,
     user_implicit_scores: List[Tuple[int, float]],
     user_interacted_products: Set[int],
     all_product_ids: Set[int],
-    hybrid_item_similarities: Dict[int, List[Tuple[int, float, float, float]]],
-    content_sim_lookup: Dict[int, Dict[int, float]],
+    hybrid_item_similarities: SimilarityTable,
+    content_sim_lookup: SimilarityTable,
     top_n: int = 10,
     prediction_threshold: float = 0.5,
     lambda_diversity: float = 0.5
@@ -2263,66 +4791,373 @@ def generate_hybrid_recommendations_with_hard_thresholding(
     logger.debug(f"Đã tạo {len(diverse_recommendations)} đề xuất đa dạng cho người dùng {user_id} sử dụng MMR.")
     return diverse_recommendations
     
+def generate_hybrid_recommendations_batch(
+    user_ids: List[int],
+    event_user_ids: np.ndarray,
+    event_product_ids: np.ndarray,
+    event_scores: np.ndarray,
+    all_product_ids: Set[int],
+    hybrid_item_similarities: SimilarityTable,
+    content_sim_lookup: SimilarityTable,
+    top_n: int = 10,
+    prediction_threshold: float = 0.5,
+    lambda_diversity: float = 0.5,
+    candidate_pool: int = RECOMMENDATION_CANDIDATE_POOL,
+    max_mmr_cells: int = 1 << 22
+) -> Dict[int, List[Tuple[int, float]]]:
+    """
+    Tạo đề xuất cho cả lô người dùng bằng các phép toán ma trận thưa thay vì gọi
+    generate_hybrid_recommendations_with_hard_thresholding cho từng người:
+
+    1. Ma trận điểm ngầm người dùng x item (từ các mảng event_*) nhân ma trận hybrid item x item
+       (sparse_candidate_scores), cộng dồn điểm giống vòng lặp dict.
+    2. Bỏ item đã tương tác và ứng viên dưới prediction_threshold (drop_sparse_entries).
+    3. Lấy candidate_pool ứng viên điểm cao nhất mỗi hàng (topk_from_csr; 0 = max(top_n * 5, 50), tối thiểu
+       top_n) và đa dạng hóa cùng lúc bằng mmr_diversity_batch, chia nhóm người dùng để ma trận tương đồng
+       giữa các ứng viên không vượt quá max_mmr_cells ô. Kết quả giống hệt hàm cho từng người dùng khi
+       candidate_pool không nhỏ hơn số ứng viên của người dùng đó.
+
+    Người dùng không có dữ liệu tương tác ngầm định vẫn đi theo nhánh cold-start của hàm cho từng người dùng.
+    """
+    recommendations: Dict[int, List[Tuple[int, float]]] = {}
+    if top_n <= 0 or not user_ids:
+        return recommendations
+    user_index = pd.Index(np.asarray(user_ids, dtype=np.int64))
+    user_rows = user_index.get_indexer(np.asarray(event_user_ids, dtype=np.int64))
+    item_rows = hybrid_item_similarities.row_of(event_product_ids)
+    n_users, n_items = len(user_index), hybrid_item_similarities.n_items
+
+    # Item đã tương tác nhưng không có trong bảng độ tương đồng không đóng góp điểm và không thể là ứng viên
+    in_table = (user_rows >= 0) & (item_rows >= 0)
+    implicit_matrix = csr_matrix(
+        (np.asarray(event_scores, dtype=np.float64)[in_table], (user_rows[in_table], item_rows[in_table])),
+        shape=(n_users, n_items)
+    )
+    implicit_matrix.sum_duplicates()
+    interacted_mask = implicit_matrix.copy()
+    interacted_mask.data[:] = 1.0
+
+    scores = sparse_candidate_scores(implicit_matrix, hybrid_item_similarities.to_csr('hybrid'))
+    scores.sort_indices()
+    candidates = drop_sparse_entries(scores, interacted_mask, keep=scores.data >= prediction_threshold)
+    candidate_counts = np.diff(candidates.indptr)
+    # Không bao giờ lấy "tất cả ứng viên": mảng (n_users x pool) dày sẽ hết bộ nhớ với danh mục lớn
+    pool = max(top_n, int(candidate_pool) if candidate_pool > 0 else max(top_n * 5, 50))
+    if candidates.nnz:
+        pool = min(pool, int(candidate_counts.max()))
+    pool_idx, _, pool_counts = topk_from_csr(candidates, pool, drop_diagonal=False)
+
+    # Điểm float64 chính xác của các ứng viên đã chọn (topk_from_csr trả về float32)
+    candidate_keys = _csr_entry_keys(candidates)
+    selected = pool_idx >= 0
+    relevance = np.full(pool_idx.shape, -np.inf)
+    if candidate_keys.size:
+        lookup_keys = np.arange(n_users, dtype=np.int64)[:, None] * n_items + np.maximum(pool_idx, 0)
+        relevance[selected] = candidates.data[np.searchsorted(candidate_keys, lookup_keys[selected])]
+    candidate_ids = np.where(selected, np.asarray(hybrid_item_similarities.item_ids)[np.maximum(pool_idx, 0)], -1)
+
+    users_with_candidates = np.flatnonzero(pool_counts > 0)
+    group_size = max(1, int(max_mmr_cells) // max(1, pool * pool))
+    for start in range(0, users_with_candidates.size, group_size):
+        group = users_with_candidates[start:start + group_size]
+        selected_ids, selected_scores = mmr_diversity_batch(
+            candidate_ids[group], relevance[group], content_sim_lookup, lambda_diversity, top_n, min_mmr_score=-1.0
+        )
+        for row, ids_row, scores_row in zip(group.tolist(), selected_ids.tolist(), selected_scores.tolist()):
+            recommendations[int(user_index[row])] = [(pid, score) for pid, score in zip(ids_row, scores_row) if pid >= 0]
+
+    # Người dùng không có dữ liệu tương tác ngầm định: giữ nhánh cold-start (ngẫu nhiên đa dạng) của hàm cũ
+    users_with_events = np.zeros(n_users, dtype=bool)
+    users_with_events[user_rows[user_rows >= 0]] = True
+    for row in np.flatnonzero(~users_with_events).tolist():
+        cold_recs = generate_hybrid_recommendations_with_hard_thresholding(
+            user_id=int(user_index[row]), user_implicit_scores=[], user_interacted_products=set(),
+            all_product_ids=all_product_ids, hybrid_item_similarities=hybrid_item_similarities,
+            content_sim_lookup=content_sim_lookup, top_n=top_n,
+            prediction_threshold=prediction_threshold, lambda_diversity=lambda_diversity
+        )
+        if cold_recs:
+            recommendations[int(user_index[row])] = cold_recs
+    logger.debug(f"Đã tạo đề xuất cho {len(recommendations)}/{n_users} người dùng trong lô.")
+    return recommendations
+
+
 # 7. Lưu trữ đề xuất người dùng vào cơ sở dữ liệu (Cập nhật để nhận 'engine')
-def save_recommendations(user_recs_to_save: Dict[int, List[Tuple[int, float]]], engine):
+def save_recommendations(
+    user_recs_to_save: Dict[int, List[Tuple[int, float]]],
+    engine,
+    insert_rows: int = RECOMMENDATION_INSERT_ROWS,
+    table_name: str = 'user_recommendations',
+    delete_existing: bool = True,
+    raise_on_error: bool = False
+) -> int:
+    """
+    Ghi đề xuất của nhiều người dùng trong một transaction bằng câu lệnh theo tập: xóa đề xuất cũ của cả
+    lô bằng DELETE ... WHERE user_id IN (...) (nếu delete_existing), rồi chèn bằng các câu INSERT nhiều dòng
+    (insert_rows dòng mỗi câu) với ON DUPLICATE KEY UPDATE. Trả về số dòng đã ghi.
+    Với raise_on_error=True lỗi được ném lại thay vì chỉ ghi log (dùng khi ghi vào một thế hệ mới).
+    """
     if not user_recs_to_save:
         logger.warning("Không có đề xuất nào để lưu trữ.")
-        return
+        return 0
+    rows = [(int(user_id), int(pid), float(score)) for user_id, recs in user_recs_to_save.items() for pid, score in recs]
+    user_ids = [int(user_id) for user_id in user_recs_to_save]
+    insert_rows = max(1, int(insert_rows))
+    delete_stmt = text(f"DELETE FROM `{table_name}` WHERE user_id IN :uids").bindparams(bindparam('uids', expanding=True))
+    started = time.perf_counter()
     try:
-        total_recs_saved = 0
         with engine.begin() as conn:
-            for user_id, recs in user_recs_to_save.items():
-                conn.execute(text("DELETE FROM user_recommendations WHERE user_id = :uid"), {'uid': user_id})
-                if recs:
-                    insert_values = [{'user_id': user_id, 'product_id': pid, 'score': float(score)} for pid, score in recs]
-                    conn.execute(
-                        text("INSERT INTO user_recommendations (user_id, product_id, score) VALUES (:user_id, :product_id, :score)"),
-                        insert_values
-                    )
-                    total_recs_saved += len(recs)
-        logger.debug(f"Đã lưu {total_recs_saved} đề xuất trong batch này.")
+            if delete_existing:
+                for start in range(0, len(user_ids), insert_rows):
+                    conn.execute(delete_stmt, {'uids': user_ids[start:start + insert_rows]})
+            bulk_insert_rows(conn, table_name, ['user_id', 'product_id', 'score'], rows, insert_rows,
+                             update_columns=['score'])
+        elapsed = time.perf_counter() - started
+        logger.info(f"Đã lưu {len(rows)} đề xuất cho {len(user_ids)} người dùng trong {elapsed:.2f}s "
+                    f"({len(rows) / max(elapsed, 1e-9):.0f} dòng/giây).")
+        return len(rows)
     except Exception as e:
         logger.exception("Lỗi khi lưu đề xuất người dùng: %s", e)
+        if raise_on_error:
+            raise
+        return 0
 
 
-print("\n--- Bắt đầu tạo đề xuất lai (Hybrid Recommendations) cho người dùng ---")
+# --- Làm mới user_recommendations theo thế hệ (bảng mới mỗi lượt chạy + RENAME TABLE) ---
+USER_RECS_TABLE = 'user_recommendations'
+USER_RECS_RUNS_TABLE = 'user_recommendation_runs'
 
-# --- ĐỌC DỮ LIỆU ĐỘ TƯƠNG ĐỒNG TỪ DB (Chỉ chạy một lần duy nhất) ---
-# Đây là những đối tượng có khả năng lớn
-hybrid_item_similarities: Dict[int, List[Tuple[int, float, float, float]]] = defaultdict(list)
-content_sims_for_preparation: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
 
-try:
-    with engine.connect() as conn:
-        # Đảm bảo bảng item_similarity tồn tại và có dữ liệu trong MySQL thesis DB
-        sim_rows = conn.execute(text("SELECT product_id_1, product_id_2, score, cf_score, content_score FROM item_similarity")).fetchall()
-        logger.info(f"Đã đọc {len(sim_rows)} cặp độ tương đồng lai từ cơ sở dữ liệu.")
+def _ensure_recommendation_runs_table(conn):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS `{USER_RECS_RUNS_TABLE}` ("
+        "run_id VARCHAR(32) NOT NULL PRIMARY KEY, table_name VARCHAR(64) NOT NULL, "
+        "status VARCHAR(16) NOT NULL, created_at DATETIME NOT NULL, activated_at DATETIME NULL, "
+        "n_users INT NULL, n_rows BIGINT NULL)"
+    ))
 
-        for p1, p2, hybrid_s, cf_s, cb_s in sim_rows:
-            hybrid_item_similarities[p1].append((p2, float(hybrid_s), float(cf_s), float(cb_s)))
-            hybrid_item_similarities[p2].append((p1, float(hybrid_s), float(cf_s), float(cb_s))) # Thêm đối xứng
-            
-            content_sims_for_preparation[p1].append((p2, float(cb_s)))
-            content_sims_for_preparation[p2].append((p1, float(cb_s))) # Thêm đối xứng cho content sim
 
-except Exception as e:
-    logger.error(f"Lỗi khi đọc dữ liệu độ tương đồng từ DB: {e}")
-    raise
+def _new_recommendation_run_id() -> str:
+    """
+    run_id sắp xếp được theo thời gian (đến micro giây) cộng 8 ký tự ngẫu nhiên: hai lượt chạy trong cùng
+    một giây (hoặc trên hai máy) không bao giờ trùng run_id/tên bảng.
+    """
+    return f"{pd.Timestamp.now().strftime('%Y%m%d%H%M%S%f')}{uuid.uuid4().hex[:8]}"
+
+
+def reconcile_recommendation_runs(conn):
+    """
+    Đối chiếu user_recommendation_runs với các bảng thực có trong DB. RENAME TABLE/DROP TABLE tự commit
+    nên các UPDATE trạng thái ngay sau đó có thể bị mất nếu tiến trình dừng giữa chừng. Khi còn là thế hệ
+    'live', bảng của run đã được đổi tên thành user_recommendations nên table_name của nó không tồn tại;
+    ngược lại bảng của run 'building'/'archived' phải tồn tại. Vì vậy:
+    - run 'building'/'archived' mất bảng = RENAME đã chạy (activate/rollback): chính là thế hệ đang dùng;
+    - run 'live' còn bảng = đã bị thay thế ('archived' sau activate, 'rolled_back' sau rollback).
+    """
+    existing_tables = {row[0] for row in conn.execute(text(
+        "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME LIKE :prefix"
+    ), {'prefix': f"{USER_RECS_TABLE}%"}).fetchall()}
+    runs = conn.execute(text(
+        f"SELECT run_id, table_name, status FROM `{USER_RECS_RUNS_TABLE}` WHERE status IN ('building', 'archived', 'live')"
+    )).fetchall()
+    promoted = [(run_id, status) for run_id, table_name, status in runs
+                if status in ('building', 'archived') and table_name not in existing_tables]
+    if len(promoted) > 1:
+        logger.error(f"Không xác định được thế hệ đề xuất đang dùng: nhiều run mất bảng {[r for r, _ in promoted]}. Bỏ qua đối chiếu.")
+        return
+    replaced_status = 'rolled_back' if promoted and promoted[0][1] == 'archived' else 'archived'
+    for run_id, table_name, status in runs:
+        if status == 'live' and table_name in existing_tables:
+            conn.execute(text(f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = :status WHERE run_id = :run_id"),
+                         {'status': replaced_status, 'run_id': run_id})
+            logger.warning(f"Đối chiếu thế hệ đề xuất: {run_id} không còn là bảng đang dùng, chuyển sang '{replaced_status}'.")
+    if promoted:
+        run_id = promoted[0][0]
+        n_rows = conn.execute(text(f"SELECT COUNT(*) FROM `{USER_RECS_TABLE}`")).scalar()
+        conn.execute(text(
+            f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = 'live', activated_at = NOW(), n_rows = :n_rows WHERE run_id = :run_id"
+        ), {'run_id': run_id, 'n_rows': int(n_rows)})
+        logger.warning(f"Đối chiếu thế hệ đề xuất: {run_id} đã được đổi tên thành {USER_RECS_TABLE} nhưng chưa được ghi nhận. Đánh dấu 'live'.")
+    # Bảng của các run đã đánh dấu 'failed'/'dropped' nhưng chưa kịp xóa
+    leftovers = conn.execute(text(
+        f"SELECT table_name FROM `{USER_RECS_RUNS_TABLE}` WHERE status IN ('failed', 'dropped')"
+    )).fetchall()
+    for (table_name,) in leftovers:
+        if table_name in existing_tables:
+            conn.execute(text(f"DROP TABLE IF EXISTS `{table_name}`"))
+
+
+def begin_recommendation_generation(engine) -> Dict:
+    """
+    Bắt đầu một thế hệ đề xuất mới: đối chiếu trạng thái các thế hệ với bảng thực (reconcile_recommendation_runs),
+    tạo bảng user_recommendations_g<run_id> rỗng (cùng cấu trúc, chưa có index phụ) và ghi run vào
+    user_recommendation_runs với trạng thái 'building'. Các thế hệ 'building' còn sót lại từ lượt chạy lỗi
+    trước được đánh dấu 'failed' rồi xóa bảng.
+    """
+    run_id = _new_recommendation_run_id()
+    table_name = f"{USER_RECS_TABLE}_g{run_id}"
+    with engine.begin() as conn:
+        _ensure_recommendation_runs_table(conn)
+        reconcile_recommendation_runs(conn)
+        stale_runs = conn.execute(text(f"SELECT run_id, table_name FROM `{USER_RECS_RUNS_TABLE}` WHERE status = 'building'")).fetchall()
+        for stale_run_id, stale_table in stale_runs:
+            # Ghi trạng thái trước: DROP TABLE tự commit, nếu dừng giữa chừng lần đối chiếu sau sẽ xóa nốt bảng
+            conn.execute(text(f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = 'failed' WHERE run_id = :run_id"), {'run_id': stale_run_id})
+            conn.execute(text(f"DROP TABLE IF EXISTS `{stale_table}`"))
+            logger.warning(f"Đã xóa thế hệ đề xuất dang dở {stale_run_id} ({stale_table}).")
+        index_clauses = create_staging_table(conn, USER_RECS_TABLE, table_name)
+        conn.execute(text(
+            f"INSERT INTO `{USER_RECS_RUNS_TABLE}` (run_id, table_name, status, created_at) VALUES (:run_id, :table_name, 'building', NOW())"
+        ), {'run_id': run_id, 'table_name': table_name})
+    logger.info(f"Bắt đầu thế hệ đề xuất {run_id}: ghi vào bảng {table_name}.")
+    return {'run_id': run_id, 'table_name': table_name, 'index_clauses': index_clauses}
+
+
+def _prune_recommendation_generations(conn, keep: int):
+    archived = conn.execute(text(
+        f"SELECT run_id, table_name FROM `{USER_RECS_RUNS_TABLE}` WHERE status = 'archived' ORDER BY activated_at DESC, run_id DESC"
+    )).fetchall()
+    for run_id, table_name in archived[max(0, int(keep)):]:
+        conn.execute(text(f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = 'dropped' WHERE run_id = :run_id"), {'run_id': run_id})
+        conn.execute(text(f"DROP TABLE IF EXISTS `{table_name}`"))
+        logger.info(f"Đã xóa thế hệ đề xuất cũ {run_id} ({table_name}).")
+
+
+def activate_recommendation_generation(engine, generation: Dict, n_users: int, keep_generations: int = USER_RECS_KEEP_GENERATIONS):
+    """
+    Đưa thế hệ đã ghi xong vào sử dụng: tạo index phụ rồi đổi tên nguyên tử
+    user_recommendations -> bảng của thế hệ đang dùng (lưu trữ để rollback), bảng mới -> user_recommendations.
+    Chỉ giữ keep_generations thế hệ lưu trữ gần nhất.
+    """
+    run_id, table_name = generation['run_id'], generation['table_name']
+    with engine.begin() as conn:
+        add_table_indexes(conn, table_name, generation['index_clauses'])
+        n_rows = conn.execute(text(f"SELECT COUNT(*) FROM `{table_name}`")).scalar()
+        live = conn.execute(text(f"SELECT run_id, table_name FROM `{USER_RECS_RUNS_TABLE}` WHERE status = 'live'")).fetchone()
+        if live is None:
+            # Bảng đang dùng chưa thuộc thế hệ nào (tạo trước khi có cơ chế này): lưu trữ nó như một thế hệ
+            live = (f"legacy{run_id[:20]}", f"{USER_RECS_TABLE}_glegacy{run_id[:20]}")
+            conn.execute(text(
+                f"INSERT INTO `{USER_RECS_RUNS_TABLE}` (run_id, table_name, status, created_at, activated_at) VALUES (:run_id, :table_name, 'live', NOW(), NOW())"
+            ), {'run_id': live[0], 'table_name': live[1]})
+        conn.execute(text(f"RENAME TABLE `{USER_RECS_TABLE}` TO `{live[1]}`, `{table_name}` TO `{USER_RECS_TABLE}`"))
+        conn.execute(text(f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = 'archived' WHERE run_id = :run_id"), {'run_id': live[0]})
+        conn.execute(text(
+            f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = 'live', activated_at = NOW(), n_users = :n_users, n_rows = :n_rows WHERE run_id = :run_id"
+        ), {'run_id': run_id, 'n_users': int(n_users), 'n_rows': int(n_rows)})
+        _prune_recommendation_generations(conn, keep_generations)
+    logger.info(f"Đã đưa thế hệ đề xuất {run_id} vào sử dụng ({n_rows} dòng, {n_users} người dùng); thế hệ trước {live[0]} được lưu trữ.")
+
+
+def rollback_recommendation_generation(engine) -> Optional[str]:
+    """
+    Quay lại thế hệ lưu trữ gần nhất bằng một RENAME TABLE (thế hệ đang dùng được đánh dấu 'rolled_back').
+    Trả về run_id đã khôi phục, hoặc None nếu không có thế hệ nào để quay lại.
+    """
+    with engine.begin() as conn:
+        _ensure_recommendation_runs_table(conn)
+        reconcile_recommendation_runs(conn)
+        live = conn.execute(text(f"SELECT run_id, table_name FROM `{USER_RECS_RUNS_TABLE}` WHERE status = 'live'")).fetchone()
+        previous = conn.execute(text(
+            f"SELECT run_id, table_name FROM `{USER_RECS_RUNS_TABLE}` WHERE status = 'archived' ORDER BY activated_at DESC, run_id DESC LIMIT 1"
+        )).fetchone()
+        if live is None or previous is None:
+            logger.warning("Không có thế hệ đề xuất nào để quay lại.")
+            return None
+        conn.execute(text(f"RENAME TABLE `{USER_RECS_TABLE}` TO `{live[1]}`, `{previous[1]}` TO `{USER_RECS_TABLE}`"))
+        conn.execute(text(f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = 'rolled_back' WHERE run_id = :run_id"), {'run_id': live[0]})
+        conn.execute(text(f"UPDATE `{USER_RECS_RUNS_TABLE}` SET status = 'live', activated_at = NOW() WHERE run_id = :run_id"), {'run_id': previous[0]})
+    logger.info(f"Đã quay lại thế hệ đề xuất {previous[0]} (thế hệ {live[0]} bị thay thế).")
+    return previous[0]
 
-logger.info(f"Kích thước hiện tại của hybrid_item_similarities: {sys.getsizeof(hybrid_item_similarities)} bytes")
-logger.info(f"Kích thước hiện tại của content_sims_for_preparation: {sys.getsizeof(content_sims_for_preparation)} bytes")
 
+print("\n--- Bắt đầu tạo đề xuất lai (Hybrid Recommendations) cho người dùng ---")
 
-# Chuẩn bị content_sim_lookup (Chỉ chạy một lần duy nhất)
-if content_sims_for_preparation:
-    content_sim_lookup = prepare_content_sim_for_lookup(content_sims_for_preparation)
-    logger.info(f"Đã tạo content_sim_lookup với {len(content_sim_lookup)} mục gốc.")
-    del content_sims_for_preparation # Giải phóng bộ nhớ vì nó đã được chuyển đổi thành lookup
-    gc.collect()
-    logger.info(f"Kích thước hiện tại của content_sim_lookup: {sys.getsizeof(content_sim_lookup)} bytes sau khi xóa content_sims_for_preparation.")
+# --- Đọc item_similarity theo chunk (server-side cursor) thẳng vào các cột NumPy ---
+def load_item_similarity_table(engine, chunk_size: int = SIMILARITY_READ_CHUNK_SIZE) -> SimilarityTable:
+    """
+    Đọc bảng item_similarity qua server-side cursor (stream_results, fetchmany) vào các mảng NumPy đã cấp
+    phát trước theo COUNT(*) (mở rộng gấp đôi nếu bảng có thêm dòng trong lúc đọc), rồi dựng SimilarityTable
+    đối xứng trong một lượt vector hóa. Không tạo danh sách tuple cho toàn bộ bảng.
+    """
+    with engine.connect() as conn:
+        expected_rows = int(conn.execute(text("SELECT COUNT(*) FROM item_similarity")).scalar() or 0)
+        capacity = max(expected_rows, 1)
+        p1 = np.empty(capacity, dtype=np.int64)
+        p2 = np.empty(capacity, dtype=np.int64)
+        scores = np.empty((capacity, 3), dtype=np.float32)
+        n_rows = 0
+        result = conn.execution_options(stream_results=True).execute(
+            text("SELECT product_id_1, product_id_2, score, cf_score, content_score FROM item_similarity")
+        )
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = np.array(rows, dtype=np.float64)
+            end = n_rows + len(chunk)
+            if end > p1.size:
+                capacity = max(end, 2 * p1.size)
+                p1, p2 = np.resize(p1, capacity), np.resize(p2, capacity)
+                scores = np.resize(scores, (capacity, 3))
+            p1[n_rows:end] = chunk[:, 0]
+            p2[n_rows:end] = chunk[:, 1]
+            scores[n_rows:end] = chunk[:, 2:5]
+            n_rows = end
+        result.close()
+    logger.info(f"Đã đọc {n_rows} cặp độ tương đồng lai từ cơ sở dữ liệu (server-side cursor, {chunk_size} dòng mỗi lần).")
+    return SimilarityTable.from_symmetric_pairs(p1[:n_rows], p2[:n_rows], scores[:n_rows, 0], scores[:n_rows, 1], scores[:n_rows, 2])
+
+
+def similarity_snapshot_is_current(engine, directory: str = SIMILARITY_TABLE_DIR) -> bool:
+    """
+    Bản mảng trong directory chỉ được dùng khi dấu vân tay trong meta trùng với lần ghi item_similarity
+    gần nhất trong DB (cùng run_id, cùng số dòng và bảng hiện vẫn có đúng số dòng đó).
+    """
+    meta = SimilarityTable.read_meta(directory)
+    snapshot_fingerprint = (meta or {}).get('fingerprint')
+    if not snapshot_fingerprint:
+        return False
+    try:
+        db_fingerprint = read_similarity_fingerprint(engine)
+    except Exception as e:
+        logger.warning(f"Không đọc được dấu vân tay item_similarity từ DB: {e}")
+        return False
+    if db_fingerprint is None:
+        return False
+    if (snapshot_fingerprint.get('run_id') != db_fingerprint['run_id']
+            or int(snapshot_fingerprint.get('row_count', -1)) != db_fingerprint['row_count']
+            or db_fingerprint['current_rows'] != db_fingerprint['row_count']):
+        logger.warning(f"SimilarityTable tại {directory} (run {snapshot_fingerprint.get('run_id')}) không khớp item_similarity "
+                       f"trong DB (run {db_fingerprint['run_id']}, {db_fingerprint['current_rows']} dòng). Đọc lại từ DB.")
+        return False
+    return True
+
+
+# --- ĐỌC DỮ LIỆU ĐỘ TƯƠNG ĐỒNG (Chỉ chạy một lần duy nhất) ---
+# Bảng đối xứng dạng CSR (SimilarityTable): dùng cho cả điểm hybrid và tra cứu content trong MMR.
+# Ưu tiên bản mảng do Cell 6 lưu (nạp bằng mmap) nếu nó khớp với item_similarity hiện tại, nếu không thì
+# dựng từ bảng item_similarity.
+hybrid_item_similarities = None
+if similarity_snapshot_is_current(engine, SIMILARITY_TABLE_DIR):
+    hybrid_item_similarities = SimilarityTable.load(SIMILARITY_TABLE_DIR, mmap=True)
+if hybrid_item_similarities is not None:
+    logger.info(f"Đã nạp SimilarityTable từ {SIMILARITY_TABLE_DIR} (mmap) với {hybrid_item_similarities.nnz} cặp (hai chiều).")
 else:
+    try:
+        # Đảm bảo bảng item_similarity tồn tại và có dữ liệu trong MySQL thesis DB
+        hybrid_item_similarities = load_item_similarity_table(engine) # Thêm đối xứng
+        gc.collect()
+    except Exception as e:
+        logger.error(f"Lỗi khi đọc dữ liệu độ tương đồng từ DB: {e}")
+        raise
+
+logger.info(f"Kích thước hiện tại của hybrid_item_similarities: {hybrid_item_similarities.memory_bytes()} bytes")
+
+# Tra cứu content cho MMR dùng chung bảng (cột content), không tạo thêm bản sao
+content_sim_lookup = hybrid_item_similarities
+if hybrid_item_similarities.nnz == 0:
     logger.warning("Không có dữ liệu để tạo content_sim_lookup. MMR có thể không hoạt động hiệu quả.")
-    content_sim_lookup = {}
 
 # --- Tải product_df và tạo set các product_id (Chỉ chạy một lần duy nhất) ---
 try:
@@ -2362,12 +5197,33 @@ except Exception as e:
 
 logger.info(f"Tổng số người dùng cần tạo đề xuất: {len(all_users)}")
 
-# Kích thước mỗi batch. Đã giảm BATCH_SIZE
-BATCH_SIZE = 50 # Bạn có thể giảm thêm: 20, 10, hoặc 5 nếu vẫn bị OOM
+# Kích thước mỗi batch người dùng (đề xuất được tạo cho cả batch bằng phép toán ma trận thưa)
+BATCH_SIZE = RECOMMENDATION_USER_BATCH_SIZE
 
 user_recs_for_batch: Dict[int, List[Tuple[int, float]]] = {}
 
+# Chế độ 'generation': cả lượt chạy được ghi vào bảng mới, chỉ thay bảng đang dùng khi đã ghi xong
+recommendation_generation = begin_recommendation_generation(engine) if USER_RECS_REFRESH_MODE == 'generation' else None
+save_kwargs = {'table_name': recommendation_generation['table_name'], 'delete_existing': False, 'raise_on_error': True} if recommendation_generation else {}
+
+
+def flush_recommendations(user_recs: Dict[int, List[Tuple[int, float]]], engine, **save_kwargs) -> int:
+    """
+    Lưu các đề xuất đã gom (save_recommendations) rồi xóa khỏi bộ nhớ. Trả về số người dùng thực sự
+    được ghi: 0 nếu lưu lỗi (chế độ in_place chỉ ghi log lỗi và trả về 0 dòng).
+    """
+    expected_rows = sum(len(recs) for recs in user_recs.values())
+    saved_rows = save_recommendations(user_recs, engine, **save_kwargs)
+    n_saved_users = len(user_recs) if saved_rows == expected_rows else 0
+    if n_saved_users == 0 and user_recs:
+        logger.error(f"Không lưu được đề xuất cho {len(user_recs)} người dùng ({expected_rows} dòng).")
+    user_recs.clear()
+    gc.collect()
+    return n_saved_users
+
+
 total_users_processed = 0
+total_users_failed = 0
 for i in range(0, len(all_users), BATCH_SIZE):
     current_users_batch = all_users[i : i + BATCH_SIZE]
     logger.info(f"Đang xử lý batch người dùng {i // BATCH_SIZE + 1} ({len(current_users_batch)} người dùng).")
@@ -2379,14 +5235,9 @@ for i in range(0, len(all_users), BATCH_SIZE):
         
         with engine.connect() as conn:
             batch_rows = conn.execute(query).fetchall()
-        
-        current_batch_implicit_feedback_dict: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
-        current_batch_interacted_products_dict: Dict[int, Set[int]] = defaultdict(set)
 
-        for row in batch_rows:
-            uid, pid, score = int(row[0]), int(row[1]), float(row[2])
-            current_batch_implicit_feedback_dict[uid].append((pid, score))
-            current_batch_interacted_products_dict[uid].add(pid)
+        # Chuyển thẳng sang các cột NumPy (user_id, product_id, implicit_score)
+        batch_events = np.array(batch_rows, dtype=np.float64).reshape(-1, 3)
         
         # Rất quan trọng: Xóa batch_rows ngay sau khi chuyển đổi để giải phóng bộ nhớ
         del batch_rows
@@ -2396,39 +5247,45 @@ for i in range(0, len(all_users), BATCH_SIZE):
 
     except Exception as e:
         logger.error(f"Lỗi khi tải dữ liệu tương tác cho batch người dùng từ DB: {e}")
+        if recommendation_generation is not None:
+            raise # Không đưa một thế hệ thiếu người dùng vào sử dụng
         continue # Bỏ qua batch lỗi và tiếp tục
 
-    # Lặp qua từng người dùng trong batch để tạo đề xuất
-    for u_id in current_users_batch:
-        current_user_implicit_scores = current_batch_implicit_feedback_dict.get(u_id, [])
-        current_user_interacted_products = current_batch_interacted_products_dict.get(u_id, set())
-
-        recommendations_for_user = generate_hybrid_recommendations_with_hard_thresholding(
-            user_id=u_id,
-            user_implicit_scores=current_user_implicit_scores,
-            user_interacted_products=current_user_interacted_products,
-            all_product_ids=all_product_ids_set,
-            hybrid_item_similarities=hybrid_item_similarities,
-            content_sim_lookup=content_sim_lookup,
-            top_n=optimal_top_n_recommendations,
-            prediction_threshold=final_hybrid_threshold,
-            lambda_diversity=0.5
-        )
-        if recommendations_for_user:
-            user_recs_for_batch[u_id] = recommendations_for_user
-    
-    # Sau khi xử lý xong một batch, LƯU VÀO DB VÀ XÓA KHỎI BỘ NHỚ
-    if user_recs_for_batch:
-        save_recommendations(user_recs_for_batch, engine)
-        total_users_processed += len(user_recs_for_batch)
-        user_recs_for_batch.clear()
-        
-        del current_batch_implicit_feedback_dict
-        del current_batch_interacted_products_dict
-        gc.collect()
-        logger.info(f"Đã lưu và xóa đề xuất cho {len(current_users_batch)} người dùng trong batch này. Tổng cộng {total_users_processed} người dùng đã được xử lý.")
+    # Tạo đề xuất cho cả batch cùng lúc
+    user_recs_for_batch.update(generate_hybrid_recommendations_batch(
+        user_ids=current_users_batch,
+        event_user_ids=batch_events[:, 0].astype(np.int64),
+        event_product_ids=batch_events[:, 1].astype(np.int64),
+        event_scores=batch_events[:, 2],
+        all_product_ids=all_product_ids_set,
+        hybrid_item_similarities=hybrid_item_similarities,
+        content_sim_lookup=content_sim_lookup,
+        top_n=optimal_top_n_recommendations,
+        prediction_threshold=final_hybrid_threshold,
+        lambda_diversity=0.5
+    ))
+    del batch_events
+
+    # Gom đề xuất của nhiều batch rồi LƯU VÀO DB bằng một lần ghi theo tập và XÓA KHỎI BỘ NHỚ
+    if len(user_recs_for_batch) >= RECOMMENDATION_SAVE_USERS:
+        n_batch_users = len(user_recs_for_batch)
+        n_saved_users = flush_recommendations(user_recs_for_batch, engine, **save_kwargs)
+        total_users_processed += n_saved_users
+        total_users_failed += n_batch_users - n_saved_users
+        logger.info(f"Đã lưu và xóa đề xuất đã gom. Tổng cộng {total_users_processed} người dùng đã được xử lý.")
+
+if user_recs_for_batch:
+    n_batch_users = len(user_recs_for_batch)
+    n_saved_users = flush_recommendations(user_recs_for_batch, engine, **save_kwargs)
+    total_users_processed += n_saved_users
+    total_users_failed += n_batch_users - n_saved_users
+
+if recommendation_generation is not None:
+    activate_recommendation_generation(engine, recommendation_generation, n_users=total_users_processed)
 
 print(f"Đã tạo và lưu đề xuất lai cho {total_users_processed} người dùng với TOP_N={optimal_top_n_recommendations}.")
+if total_users_failed:
+    logger.warning(f"{total_users_failed} người dùng không được lưu đề xuất do lỗi ghi DB (xem log ở trên).")
 
 print("\n--- Toàn bộ quy trình đề xuất lai đã hoàn thành thành công! ---")
 